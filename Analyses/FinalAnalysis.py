@@ -20,7 +20,7 @@ from Containers.Kinfit4PiContainer import Kinfit4PiContainer
 from Containers.FinalContainer import FinalContainer
 
 class FinalAnalysis(Analysis):
-    def __init__(self, input_path, kinfit_2k2pi_path, kinfit_4pi_path, *, analysis_path = None, output_path = None, log_path = None):
+    def __init__(self, input_path, kinfit_2k2pi_path, kinfit_4pi_path, *, analysis_path = None, output_path = None, log_path = None, kinfit_index = None, output_keep = None, output_drop = None, output_skim = False, output_layout = None):
         Analysis.__init__(self, analysis_path, logname = "final_cut", logpath = log_path)
         
         size_variables = { # needed to define variables in self.Variables
@@ -114,6 +114,8 @@ class FinalAnalysis(Analysis):
             "KmTrackIndex":                 Variable("KmTrackIndex",    "B"),
             "PipTrackIndex":                Variable("PipTrackIndex",   "B"),
             "PimTrackIndex":                Variable("PimTrackIndex",   "B"),
+            "TrackPiLklhds":                Variable("TrackPiLklhds",   "f", sizes = (size_variables["nt"],)),
+            "TrackKLklhds":                 Variable("TrackKLklhds",    "f", sizes = (size_variables["nt"],)),
             
             "PipPimPipPimMissMass":         TriggerVariable("PipPimPipPimMissMass",  "f", self.calculatePipPimPipPimMissMass),
             "PiPiPiMissMass":               TriggerVariable("PiPiPiMissMass",        "f", self.calculatePiPiPiMissMass),
@@ -145,7 +147,15 @@ class FinalAnalysis(Analysis):
             Kinfit2K2PiContainer(kinfit_2k2pi_path, self.Variables),
             Kinfit4PiContainer(kinfit_4pi_path, self.Variables),
         ]
-        self.OutputContainers = [FinalContainer(output_path, "recreate", self.Variables)]
+        ## Kinfit trees are read as friends of the preliminary one, kinfit_index = ("runnum", "evnum") for reordered or partial kinfit outputs
+        self.joinInputContainers(index_names = kinfit_index)
+        ## Preliminary files written before the per-track likelihoods were added are read without them
+        missing_branches = self.InputContainers[0].MissingBranches
+        if missing_branches: self.Logger.info(f"Branches missing from {input_path}, not read and not written: {', '.join(missing_branches)}")
+        if output_path: self.OutputContainers = [FinalContainer(
+            output_path, "recreate", self.Variables, keep = output_keep, drop = (output_drop or []) + missing_branches, parent = self.InputContainers[0] if output_skim else None,
+            layout = output_layout,
+        ),]
 
         cuts_available = {
             'KpKmPipPimLklhd': lambda: (
@@ -17,7 +17,7 @@ from Base.Analysis import Analysis, CutDispatcher, HistogramDispatcher, EHists
 from Containers.PreliminaryContainer import PreliminaryContainer
 
 class IntermediateAnalysis(Analysis):
-    def __init__(self, input_path, *, analysis_path = None, output_path = None, log_path = None):
+    def __init__(self, input_path, *, analysis_path = None, output_path = None, log_path = None, output_keep = None, output_drop = None, output_skim = False, output_layout = None):
         Analysis.__init__(self, analysis_path, logname = "final_cut", logpath = log_path)
 
         size_variables = { # needed to define variables in self.Variables
@@ -111,6 +111,8 @@ class IntermediateAnalysis(Analysis):
             "KmTrackIndex":                 Variable("KmTrackIndex",    "B"),
             "PipTrackIndex":                Variable("PipTrackIndex",   "B"),
             "PimTrackIndex":                Variable("PimTrackIndex",   "B"),
+            "TrackPiLklhds":                Variable("TrackPiLklhds",   "f", sizes = (size_variables["nt"],)),
+            "TrackKLklhds":                 Variable("TrackKLklhds",    "f", sizes = (size_variables["nt"],)),
             
             "PiPiPiPiMissMass2":            TriggerVariable("PiPiPiPiMissMass2",      "f", self.calculatePiPiPiPiMissMass2),
             "KPiPiPiMissMass2":            TriggerVariable("KPiPiPiMissMass2",      "f", self.calculateKPiPiPiMissMass2),
@@ -125,7 +127,13 @@ class IntermediateAnalysis(Analysis):
         self.Variables.update(size_variables)
 
         self.InputContainers = [PreliminaryContainer(input_path, "read", self.Variables),]
-        if output_path: self.OutputContainers = [PreliminaryContainer(output_path, "recreate", self.Variables),]
+        ## Preliminary files written before the per-track likelihoods were added are read without them
+        missing_branches = self.InputContainers[0].MissingBranches
+        if missing_branches: self.Logger.info(f"Branches missing from {input_path}, not read and not written: {', '.join(missing_branches)}")
+        if output_path: self.OutputContainers = [PreliminaryContainer(
+            output_path, "recreate", self.Variables, keep = output_keep, drop = (output_drop or []) + missing_branches, parent = self.InputContainers[0] if output_skim else None,
+            layout = output_layout,
+        ),]
 
         cuts_available = {
             'nph': lambda: self.Variables["nph"].Content > 1,
@@ -224,6 +232,34 @@ class IntermediateAnalysis(Analysis):
                     'x-variable': self.Variables["KpKmPipPimLklhd"],
                 },
             },
+            'h_tptot_TrackPiLklhds': {
+                'type': EHists.TH2F,
+                'args': {
+                    'title': "Track #pi hypothesis likelihood vs track momentum",
+                    'x-axis-title': "P_{track}, MeV/c",
+                    'x-axis-nbins': 1000,
+                    'x-axis-range': (0., 1000.),
+                    'x-variable': self.Variables["tptot"],
+                    'y-axis-title': "Likelihood_{#pi}",
+                    'y-axis-nbins': 150,
+                    'y-axis-range': (-15., 0.),
+                    'y-variable': self.Variables["TrackPiLklhds"],
+                },
+            },
+            'h_tptot_TrackKLklhds': {
+                'type': EHists.TH2F,
+                'args': {
+                    'title': "Track K hypothesis likelihood vs track momentum",
+                    'x-axis-title': "P_{track}, MeV/c",
+                    'x-axis-nbins': 1000,
+                    'x-axis-range': (0., 1000.),
+                    'x-variable': self.Variables["tptot"],
+                    'y-axis-title': "Likelihood_{K}",
+                    'y-axis-nbins': 150,
+                    'y-axis-range': (-15., 0.),
+                    'y-variable': self.Variables["TrackKLklhds"],
+                },
+            },
             'h_TotalP_DeltaE': {
                 'type': EHists.TH2F,
                 'args': {
@@ -363,6 +399,7 @@ class IntermediateAnalysis(Analysis):
                 },
             },
         }
+        for branch_name in missing_branches: histograms_available.pop(f"h_tptot_{branch_name}", None)
         self.HistogramDispatcher = HistogramDispatcher(histograms_available)
 
 
@@ -17,9 +17,10 @@ from Base.Analysis import Analysis, CutDispatcher, HistogramDispatcher, EHists
 from Containers.PreliminaryContainer import PreliminaryContainer
 from Containers.Kinfit2K2PiContainer import Kinfit2K2PiContainer
 from Containers.Kinfit4PiContainer   import Kinfit4PiContainer
+from Containers.NativeKinfitContainer import NativeKinfit2K2PiContainer, NativeKinfit4PiContainer
 
 class KinfitAnalysis(Analysis):
-    def __init__(self, input_path, kf_2k2pi_path, kf_4pi_path, analysis_path, log_path = None):
+    def __init__(self, input_path, kf_2k2pi_path, kf_4pi_path, analysis_path, log_path = None, *, kinfit_type = "DCLklhd", kinfit_index = None, kinfit_column_cache = False):
         Analysis.__init__(self, analysis_path, logname = "final_cut", logpath = log_path)
 
         size_variables = { # needed to define variables in self.Variables
@@ -50,6 +51,8 @@ class KinfitAnalysis(Analysis):
             "KmTrackIndex":                 Variable("KmTrackIndex",    "B"),
             "PipTrackIndex":                Variable("PipTrackIndex",   "B"),
             "PimTrackIndex":                Variable("PimTrackIndex",   "B"),
+            "TrackPiLklhds":                Variable("TrackPiLklhds",   "f", sizes = (size_variables["nt"],)),
+            "TrackKLklhds":                 Variable("TrackKLklhds",    "f", sizes = (size_variables["nt"],)),
 
             "KpKmPipPimKinfitIsConverged":   Variable("KpKmPipPimKinfitIsConverged",   "B"),
             "KpKmPipPimKinfitChi2":          Variable("KpKmPipPimKinfitChi2",          "f"),
@@ -89,7 +92,14 @@ class KinfitAnalysis(Analysis):
         }
         self.Variables.update(size_variables)
 
-        self.InputContainers = [PreliminaryContainer(input_path, "read", self.Variables), Kinfit2K2PiContainer(kf_2k2pi_path, self.Variables), Kinfit4PiContainer(kf_4pi_path, self.Variables),]
+        ## Kinfit results are calculated in-process if kinfit paths are None, fit inputs read from a ColumnCache with kinfit_column_cache
+        self.InputContainers = [
+            PreliminaryContainer(input_path, "read", self.Variables),
+            Kinfit2K2PiContainer(kf_2k2pi_path, self.Variables) if kf_2k2pi_path else NativeKinfit2K2PiContainer(input_path, self.Variables, kinfit_type = kinfit_type, column_cache = kinfit_column_cache),
+            Kinfit4PiContainer(kf_4pi_path, self.Variables) if kf_4pi_path else NativeKinfit4PiContainer(input_path, self.Variables, column_cache = kinfit_column_cache),
+        ]
+        ## Kinfit trees are read as friends of the preliminary one, kinfit_index = ("runnum", "evnum") for reordered or partial kinfit outputs
+        self.joinInputContainers(index_names = kinfit_index)
 
         cuts_available = {
             'KpKmPipPimKinfitChi2': lambda: self.Variables["KpKmPipPimKinfitChi2"].Content > 200.,
@@ -20,13 +20,18 @@ from Base.Analysis import Analysis, CutDispatcher, HistogramDispatcher, EHists
 from Containers.CMD3ContainerV9 import CMD3ContainerV9
 from Containers.PreliminaryContainer import PreliminaryContainer
 
+## dE/dx likelihood functions, the copy in the repository is used outside the cluster (e.g. by benchmarks on synthetic trees)
+DEDX_HEADER_PATH = "/spoolA/idpershin/analysis/kpkmpippim/python/k_pi_dedx_v9_2025_par.h"
+if not os.path.exists(DEDX_HEADER_PATH):
+    DEDX_HEADER_PATH = f"{os.path.dirname(os.path.dirname(os.path.abspath(__file__)))}/k_pi_dedx_v9_2025_par.h"
+
 class PreliminaryAnalysis(Analysis):
-    def __init__(self, input_path, *, analysis_path = None, output_path = None, log_path = None, is_sim = False):
+    def __init__(self, input_path, *, analysis_path = None, output_path = None, log_path = None, is_sim = False, output_keep = None, output_drop = None, output_skim = False, output_layout = None):
         if not analysis_path and not output_path: raise ValueError("Analysis path and output path cannot be None at the same time")
         Analysis.__init__(self, analysis_path, logname = "preliminary_analysis", logpath = log_path)
         
         ## Likelihood calculation inclusion
-        gInterpreter.ProcessLine('#include "/spoolA/idpershin/analysis/kpkmpippim/python/k_pi_dedx_v9_2025_par.h"')
+        gInterpreter.ProcessLine(f'#include "{DEDX_HEADER_PATH}"')
         self.isSimulated = is_sim
 
         size_variables = { # needed to define variables in self.Variables
@@ -119,11 +124,16 @@ class PreliminaryAnalysis(Analysis):
             "KmTrackIndex":                 TriggerVariable("KmTrackIndex",    "B", self.calculateKpKmPipPimLklhd),
             "PipTrackIndex":                TriggerVariable("PipTrackIndex",   "B", self.calculateKpKmPipPimLklhd),
             "PimTrackIndex":                TriggerVariable("PimTrackIndex",   "B", self.calculateKpKmPipPimLklhd),
+            "TrackPiLklhds":                TriggerVariable("TrackPiLklhds",   "f", self.calculateKpKmPipPimLklhd, sizes = (size_variables["nt"],)), ## per-track pi hypothesis log-likelihood
+            "TrackKLklhds":                 TriggerVariable("TrackKLklhds",    "f", self.calculateKpKmPipPimLklhd, sizes = (size_variables["nt"],)), ## per-track K hypothesis log-likelihood
         }
         self.Variables.update(size_variables)
 
         self.InputContainers.append(CMD3ContainerV9(input_path, self.Variables))
-        if output_path: self.OutputContainers.append(PreliminaryContainer(output_path, "recreate", self.Variables))
+        if output_path: self.OutputContainers.append(PreliminaryContainer(
+            output_path, "recreate", self.Variables, keep = output_keep, drop = output_drop, parent = self.InputContainers[0] if output_skim else None,
+            layout = output_layout,
+        ))
 
         cuts_available = {
             'nt': lambda: self.Variables["nt"].Content != 4,
@@ -308,11 +318,17 @@ class PreliminaryAnalysis(Analysis):
         pars = LklhdParsType(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
 
         ## Calculating likelihood functions in K and pi hypotheses for every track
+        runnum = self.Variables["runnum"].Content
+        tracks_pi_lklhds, tracks_k_lklhds = [], []
+        for (p, dedx) in zip(self.Variables["tptot"].Content, self.Variables["tdedx"].Content):
+            tracks_pi_lklhds.append(ROOT.test_k(p, dedx, runnum, pars, self.isSimulated, False)) ## pi
+            tracks_k_lklhds.append(ROOT.test_k(p, dedx, runnum, pars, self.isSimulated, True)) ## K
+        self.Variables["TrackPiLklhds"].Content = tracks_pi_lklhds
+        self.Variables["TrackKLklhds"].Content = tracks_k_lklhds
+
         lklhds_by_tracks = ([-inf, -inf], [-inf, -inf], [-inf, -inf], [-inf, -inf]) ## tracks likelihoods (lklhd index = track index in tr_ph)
-        for (track_lklhds, p, dedx) in zip(lklhds_by_tracks, self.Variables["tptot"].Content, self.Variables["tdedx"].Content):
-            ## likelihood in pi and K hypotheses
-            track_lklhds[0] = ROOT.test_k(p, dedx, self.Variables["runnum"].Content, pars, self.isSimulated, False) ## pi
-            track_lklhds[1] = ROOT.test_k(p, dedx, self.Variables["runnum"].Content, pars, self.isSimulated, True) ## K
+        for (track_lklhds, pi_lklhd, k_lklhd) in zip(lklhds_by_tracks, tracks_pi_lklhds, tracks_k_lklhds):
+            track_lklhds[0], track_lklhds[1] = pi_lklhd, k_lklhd
 
         ## Permutating tracks indices so that the charges is arranged as (+, -, +, -)
         tracks_indices = (0, 1, 2, 3)
@@ -9,13 +9,18 @@ import logging
 from logging import getLogger, StreamHandler, FileHandler, Formatter
 
 import sys
+from time import perf_counter
 
 import ROOT
 from ROOT import TFile
-from ROOT import TH1I, TH1F, TH2F, TGraph, TCanvas
+from ROOT import TH1I, TH1F, TH2F, TGraph, TCanvas, TObjString
 from ROOT import gROOT
 
 from .Container import Container
+from .Variable import TriggerVariable
+from .MemoryGuard import is_low_memory_mode
+from .LoopTimer import LoopTimer, is_timing_mode
+from .ProgressMeter import ProgressMeter, get_metrics_path
 
 EHists = Enum('EHists', ['TH1I', 'TH1F', 'TH2F'])
 
@@ -31,9 +36,11 @@ class CutDispatcher:
         self.CutsCounter = 0
         self.CutsDone = OrderedDict()
         self.CutsDone.update({'no_cut': n_entries_full}) ## {name: n_entries_selected}
+        self.CutsTotals = OrderedDict() ## {name: final ProgressMeter record of the loop}
         self.GraphEntriesSelected = None
         self.GraphEntriesPercentage = None
         self.GraphCutPercentage = None
+        self.GraphCutWallTime = None
         
         
     ## Operations with available cuts
@@ -89,8 +96,9 @@ class CutDispatcher:
     def isCutDone(self, cut_name):
         return cut_name in self.CutsDone
 
-    def update(self):
+    def update(self, totals = None):
         self.CutsDone.update({self.formFullCutName(): self.getEntriesSelected()})
+        if totals: self.CutsTotals[self.formFullCutName()] = totals
         self.CutsCounter += 1
         self.CutsCurrent = {}
     
@@ -120,6 +128,14 @@ class CutDispatcher:
             self.GraphCutPercentage.SetPoint(i, i, cut_item[1] / n_entries_prev if n_entries_prev != 0 else 0.)
             n_entries_prev = cut_item[1]
 
+        if not self.CutsTotals: return
+        self.GraphCutWallTime = TGraph(n_cuts)
+        self.GraphCutWallTime.SetName('g_cut_wall_time')
+        self.GraphCutWallTime.SetTitle('Wall time of cut loop, s')
+        self.GraphCutWallTime.GetXaxis().SetTitle('Cut')
+        for i, cut_name in enumerate(self.CutsDone):
+            self.GraphCutWallTime.SetPoint(i, i, self.CutsTotals[cut_name]['wall-time'] if cut_name in self.CutsTotals else 0.)
+
 
     def formDirectoryName(self):
         if not self.CutsCurrent: return str(self.CutsCounter)
@@ -198,10 +214,16 @@ class HistogramDispatcher:
 
     def clearHistogramsCurrent(self):
         self.HistogramsCurrent = {}
+
+    def dropHistograms(self):
+        ## Saved histograms are detached from their file, so that they are deleted instead of being reset by the next stage
+        for hist in self.HistogramsBuilt.values(): hist[0].SetDirectory(ROOT.nullptr)
+        self.HistogramsCurrent = {}
+        self.HistogramsBuilt = {}
     
 
 class Analysis:
-    def __init__(self, path = None, *, logname = "analysis", logpath = None, logmode = 'w'):
+    def __init__(self, path = None, *, logname = "analysis", logpath = None, logmode = 'w', metrics_path = None):
         self.InputContainers = []
         self.OutputContainers = []
         self.AnalysisFile = TFile.Open(path, 'recreate') if path else None
@@ -220,6 +242,18 @@ class Analysis:
         
         self.CutDispatcher = None
         self.HistogramDispatcher = None
+
+        ## Per-category selections, see splitBy()
+        self.SplitVariable = None
+        self.SplitCategories = {}
+
+        ## Timing of the loop parts, see enableTiming()
+        self.LoopTimer = None
+        self.TimingPath = None
+
+        ## Progress records of the loops are appended to the metrics file only if it is given here or by the pipeline task
+        self.ProgressInterval = 60.
+        self.MetricsPath = metrics_path if metrics_path else get_metrics_path()
         
 
     ## Operations with cuts
@@ -231,8 +265,15 @@ class Analysis:
         
     ## Operations with histograms
     def addHistogram(self, hist_name):
-        if not self.AnalysisFile: return
-        self.HistogramDispatcher.addHistogram(hist_name)
+        ## Categories with their own analysis files get histograms without the inclusive analysis file as well
+        if self.AnalysisFile:
+            self.AnalysisFile.cd()
+            self.HistogramDispatcher.addHistogram(hist_name)
+        for category in self.SplitCategories.values():
+            if not category['histogram-dispatcher']: continue
+            category['analysis-file'].cd()
+            category['histogram-dispatcher'].addHistogram(hist_name)
+        if self.AnalysisFile: self.AnalysisFile.cd()
 
     def getHistogramsCurrent(self):
         if not self.AnalysisFile: return {}
@@ -242,26 +283,88 @@ class Analysis:
         if not self.AnalysisFile: return []
         return self.HistogramDispatcher.getHistogramsCurrentList()
 
-    def saveHistograms(self, hists, directory_name):
-        if not self.AnalysisFile: return
-        if not self.AnalysisFile.GetDirectory(directory_name):
-            self.AnalysisFile.mkdir(directory_name)
-        self.AnalysisFile.GetDirectory(directory_name).cd()
+    def saveHistograms(self, hists, directory_name, analysis_file = None):
+        analysis_file = analysis_file or self.AnalysisFile
+        if not analysis_file: return
+        if not analysis_file.GetDirectory(directory_name):
+            analysis_file.mkdir(directory_name)
+        analysis_file.GetDirectory(directory_name).cd()
         for hist in hists.values(): hist[0].Write()
-        self.AnalysisFile.Save()
-        self.AnalysisFile.cd()
+        analysis_file.Save()
+        analysis_file.cd()
+
+    def fillHistograms(self, hists):
+        for hist_name, hist in hists.items():
+            if self.LoopTimer: start_time = perf_counter()
+            ## Example: (MomentumVariable, ThetaVariable, ...)
+            ## -> ([momentum1, momentum2, ..., momentumN], [theta1, theta2, ..., thetaN], ...)
+            ## -> ((momentum1, theta1, ...), (momentum2, theta2, ...), ..., (momentumN, thetaN, ...))
+            variables_values_by_tuples = list(zip(
+                *map(lambda a: [a.Content] if a.Sizes == (1,) else a.Content, hist[1:])
+            ))
+            for values in variables_values_by_tuples: hist[0].Fill(*values)
+            if self.LoopTimer: self.LoopTimer.add('histogram', hist_name, perf_counter() - start_time)
 
     def clearHistogramsCurrent(self):
-        if not self.AnalysisFile: return
-        return self.HistogramDispatcher.clearHistogramsCurrent()
+        ## Categories with their own analysis files have histograms without the inclusive analysis file as well
+        for category in self.SplitCategories.values():
+            if category['histogram-dispatcher']: category['histogram-dispatcher'].clearHistogramsCurrent()
+        if self.AnalysisFile: self.HistogramDispatcher.clearHistogramsCurrent()
+
+    def dropHistograms(self):
+        ## Low-memory mode: histograms of a stage are kept only until they are saved
+        if self.AnalysisFile: self.HistogramDispatcher.dropHistograms()
+        for category in self.SplitCategories.values():
+            if category['histogram-dispatcher']: category['histogram-dispatcher'].dropHistograms()
+
+    ## Operations with categories
+    """
+    Routes every selected entry by the value of a category variable (e.g. finalstate_id)
+    into per-category histograms and output containers in the same pass as the inclusive selection
+    analysis_paths: {category: histograms path}, output_containers: {category: [container, ...]}
+    """
+    def splitBy(self, variable_name, categories, *, analysis_paths = None, output_containers = None):
+        self.SplitVariable = self.Variables[variable_name]
+        for category in categories:
+            analysis_file = TFile.Open(analysis_paths[category], 'recreate') if analysis_paths and category in analysis_paths else None
+            self.SplitCategories[category] = {
+                'analysis-file': analysis_file,
+                'histogram-dispatcher': HistogramDispatcher(self.HistogramDispatcher.HistogramsAvailable) if analysis_file and self.HistogramDispatcher else None,
+                'output-containers': output_containers.get(category, []) if output_containers else [],
+                'cuts-done': OrderedDict(), ## {name: n_entries_selected}
+            }
+        if self.AnalysisFile: self.AnalysisFile.cd()
+
+    def getSplitCategory(self):
+        if not self.SplitCategories: return None
+        return self.SplitCategories.get(self.SplitVariable.Content)
         
+    ## Operations with input containers
+    def joinInputContainers(self, *, index_names = None):
+        ## Attaching trees of auxiliary input containers to the first one as friends: one GetEntry reads all of them
+        main_container, *auxiliary_containers = self.InputContainers
+        self.InputContainers = [main_container]
+        for container in auxiliary_containers:
+            if isinstance(container, Container):
+                main_container.addFriend(container, index_names = index_names)
+            else:
+                self.InputContainers.append(container)
+
     ## Operations with entries
-    def getEntry(self, n_entry):
+    def getEntry(self, n_entry) -> bool:
+        ## False if the entry has no match in a friend tree joined by index, see Container.getEntry
         for container in self.InputContainers:
             container.getEntry(n_entry)
+        return all(container.IsMatched for container in self.InputContainers if isinstance(container, Container))
 
     def getEntries(self):
         return self.InputContainers[0].getEntries()
+
+    def getInputBranches(self):
+        ## Branches read from the input trees, including friends and inputs of in-process containers (e.g. NativeKinfitContainer)
+        branch_names = set()
+        for container in self.InputContainers: branch_names.update(container.getBranchNames())
+        return sorted(branch_names)
             
     def fillEntry(self):
         for container in self.OutputContainers:
@@ -270,23 +373,74 @@ class Analysis:
     def calculateEntry(self):
         pass
 
+    ## Timing
+    def enableTiming(self, *, path = None):
+        """
+        Collects time of getEntry, cuts, TriggerVariable functions, histograms filling and output in every loop,
+        the summary is logged after each stage and saved as JSON to path or, by default, to the 'timing' string of the analysis file
+        Parts of the loop are timed by wrapping them, nothing is added to the loop while timing is disabled
+        """
+        if self.LoopTimer: return
+        self.LoopTimer = LoopTimer()
+        self.TimingPath = path
+        self.getEntry = self.LoopTimer.wrap('io', 'getEntry', self.getEntry)
+        self.calculateEntry = self.LoopTimer.wrap('output', 'calculateEntry', self.calculateEntry)
+        self.fillEntry = self.LoopTimer.wrap('output', 'fillEntry', self.fillEntry)
+
+        ## One function may calculate several variables (e.g. calculateKpKmPipPimLklhd)
+        timed_funcs = {}
+        for variable in self.Variables.values():
+            if not isinstance(variable, TriggerVariable): continue
+            if variable.TrigFunc not in timed_funcs:
+                func_name = getattr(variable.TrigFunc, '__name__', '<lambda>')
+                timed_funcs[variable.TrigFunc] = self.LoopTimer.wrap(
+                    'trigger', func_name if func_name != '<lambda>' else variable.Name, variable.TrigFunc
+                )
+            variable.TrigFunc = timed_funcs[variable.TrigFunc]
+
+    def logTiming(self, stage_name):
+        for line in self.LoopTimer.formSummary(stage_name): self.Logger.info(line)
+
     ## Processing loop
     def loop(self, *, directory_name = None):
         if not directory_name:
             directory_name = self.CutDispatcher.formDirectoryName() 
+        if is_timing_mode(): self.enableTiming()
 
         ## hists: {'hist_name': (THist, Variable1, Variable2, ...), ...}
         hists = self.getHistogramsCurrent()
         
+        ## categories_hists: {category: {'hist_name': (THist, Variable1, Variable2, ...), ...}, ...}
+        categories_hists = {
+            category_value: category['histogram-dispatcher'].getHistogramsCurrent() if category['histogram-dispatcher'] else {}
+            for category_value, category in self.SplitCategories.items()
+        }
+        categories_entries_selected = dict.fromkeys(self.SplitCategories, 0)
+        
         cut_set_name = self.CutDispatcher.formFullCutName()
         self.Logger.info(f"Starting '{cut_set_name}' cut")
         n_entries_prev = self.CutDispatcher.getEntriesSelected()
-        for n_entry in range(self.getEntries()):
+        n_entries = self.getEntries()
+        n_entries_passed = 0
+        n_entries_unmatched = 0
+        progress_meter = ProgressMeter(
+            cut_set_name, n_entries, logger = self.Logger, interval = self.ProgressInterval, metrics_path = self.MetricsPath
+        )
+        cuts_current = self.CutDispatcher.getCutsCurrent()
+        if self.LoopTimer:
+            self.LoopTimer.startStage()
+            cuts_current = {cut_name: self.LoopTimer.wrap('cut', cut_name, cut_func) for cut_name, cut_func in cuts_current.items()}
+        for n_entry in range(n_entries):
+            if n_entry % 1000 == 0 and progress_meter.isDue(): progress_meter.report(n_entry, n_entries_passed)
             if not self.CutDispatcher.checkEntryInChecklist(n_entry): continue
-            self.getEntry(n_entry)
+            if not self.getEntry(n_entry):
+                ## Entries missing from friend trees are not selected, e.g. events without kinfit results
+                self.CutDispatcher.deleteEntryFromChecklist(n_entry)
+                n_entries_unmatched += 1
+                continue
 
             ## Executing cuts
-            for cut_name, cut_func in self.CutDispatcher.getCutsCurrent().items():
+            for cut_name, cut_func in cuts_current.items():
                 is_inversed = self.CutDispatcher.isCutInversed(cut_name)
                 if not is_inversed and cut_func():
                     self.CutDispatcher.deleteEntryFromChecklist(n_entry)
@@ -298,22 +452,38 @@ class Analysis:
                 
             else:
                 ## Filling histograms
-                for hist in hists.values():
-                    ## Example: (MomentumVariable, ThetaVariable, ...)
-                    ## -> ([momentum1, momentum2, ..., momentumN], [theta1, theta2, ..., thetaN], ...)
-                    ## -> ((momentum1, theta1, ...), (momentum2, theta2, ...), ..., (momentumN, thetaN, ...))
-                    variables_values_by_tuples = list(zip(
-                        *map(lambda a: [a.Content] if a.Sizes == (1,) else a.Content, hist[1:])
-                    ))
-                    for values in variables_values_by_tuples: hist[0].Fill(*values)
+                n_entries_passed += 1
+                self.fillHistograms(hists)
+                if self.SplitCategories:
+                    category_value = self.SplitVariable.Content
+                    if category_value in categories_hists:
+                        categories_entries_selected[category_value] += 1
+                        self.fillHistograms(categories_hists[category_value])
 
         ## Logging cut results, clearing CutsCurrent and HistogramsCurrent
-        self.Logger.info(f"'{cut_set_name}' cut finished. {self.CutDispatcher.getEntriesSelected()} entries out of {n_entries_prev} selected")
-        self.CutDispatcher.update()
+        totals = progress_meter.finish(n_entries_passed)
+        if n_entries_unmatched: self.Logger.info(f"'{cut_set_name}' cut: {n_entries_unmatched} entries without match in friend trees skipped")
+        self.Logger.info(
+            f"'{cut_set_name}' cut finished. {self.CutDispatcher.getEntriesSelected()} entries out of {n_entries_prev} selected "
+            f"in {totals['wall-time']:.1f} s ({totals['events-per-second']:.0f} events/s, {totals['mb-per-second']:.1f} MB/s)"
+        )
+        for category_value, category in self.SplitCategories.items():
+            self.Logger.info(f"'{cut_set_name}' cut, {self.SplitVariable.Name} = {category_value}: {categories_entries_selected[category_value]} entries selected")
+            category['cuts-done'][cut_set_name] = categories_entries_selected[category_value]
+        if self.LoopTimer:
+            self.LoopTimer.endStage(directory_name)
+            self.logTiming(directory_name)
+        self.CutDispatcher.update(totals)
         self.clearHistogramsCurrent()
 
         ## Saving histograms to directory
         self.saveHistograms(hists, directory_name)
+        for category_value, category in self.SplitCategories.items():
+            self.saveHistograms(categories_hists[category_value], directory_name, category['analysis-file'])
+        if is_low_memory_mode():
+            ## References of the loop go as well, so that the histograms are deleted
+            del hists, categories_hists
+            self.dropHistograms()
         
         
     def dumpToFile(self):
@@ -323,18 +493,49 @@ class Analysis:
             self.CutDispatcher.GraphEntriesSelected.Write()
             self.CutDispatcher.GraphEntriesPercentage.Write()
             self.CutDispatcher.GraphCutPercentage.Write()
+            if self.CutDispatcher.GraphCutWallTime: self.CutDispatcher.GraphCutWallTime.Write()
             self.AnalysisFile.Save()
 
-        if self.OutputContainers:
+        for category in self.SplitCategories.values():
+            ## Cut flow graphs of a category need its entries number before cuts
+            if not category['analysis-file'] or not category['cuts-done'].get('no_cut'): continue
+            category_cut_dispatcher = CutDispatcher({})
+            category_cut_dispatcher.CutsDone = category['cuts-done']
+            category_cut_dispatcher.buildGraphs()
+            category['analysis-file'].cd()
+            category_cut_dispatcher.GraphEntriesSelected.Write()
+            category_cut_dispatcher.GraphEntriesPercentage.Write()
+            category_cut_dispatcher.GraphCutPercentage.Write()
+            category['analysis-file'].Save()
+
+        categories_output_containers = [
+            container for category in self.SplitCategories.values() for container in category['output-containers']
+        ]
+        if self.OutputContainers or categories_output_containers:
+            if self.LoopTimer: self.LoopTimer.startStage()
             for n_entry in range(self.getEntries()):
                 if not self.CutDispatcher.checkEntryInChecklist(n_entry): continue
                 
                 self.getEntry(n_entry)
                 self.calculateEntry()
                 self.fillEntry()
+                category = self.getSplitCategory()
+                if category:
+                    for container in category['output-containers']: container.fillEntry()
 
-            for container in self.OutputContainers:
+            for container in self.OutputContainers + categories_output_containers:
                 container.dumpToFile()
+            if self.LoopTimer:
+                self.LoopTimer.endStage('output')
+                self.logTiming('output')
+
+        if self.LoopTimer and self.TimingPath:
+            self.LoopTimer.save(self.TimingPath)
+        elif self.LoopTimer and self.AnalysisFile:
+            ## Not a directory, so the cut directories listed by pershin_aggregate.py stay the same
+            self.AnalysisFile.cd()
+            TObjString(self.LoopTimer.formJSON()).Write('timing', ROOT.TObject.kOverwrite)
+            self.AnalysisFile.Save()
 
                 
     def close(self):
@@ -343,6 +544,9 @@ class Analysis:
             del self.HistogramDispatcher
         for container in self.InputContainers: container.close()
         for container in self.OutputContainers: container.close()
+        for category in self.SplitCategories.values():
+            if category['analysis-file']: category['analysis-file'].Close()
+            for container in category['output-containers']: container.close()
         del self.CutDispatcher
         self.Logger.removeHandler(self.LogHandler)
         self.LogHandler.close()
@@ -0,0 +1,76 @@
+from .Variable import Variable
+
+## pyarrow is needed only for exporting, the analyses run without it
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+## Correspondence between Variable typecodes and Arrow types
+ArrowTypes = {
+    'as': 'int32',
+    'i': 'int32',
+    'f': 'float32',
+    'b': 'int8',
+    'B': 'uint8',
+    'h': 'int16',
+    'H': 'uint16',
+}
+
+def get_arrow_type(variable):
+    ## Size variables give list columns (e.g. tptot[nt] -> list<float>), fixed sizes give fixed-size lists (terr[nt][3][3] -> list<list<list<float, 3>, 3>>)
+    arrow_type = getattr(pyarrow, ArrowTypes[variable.Typecode])()
+    if variable.Sizes == (1,): return arrow_type
+    for size in reversed(variable.Sizes):
+        arrow_type = pyarrow.list_(arrow_type) if isinstance(size, Variable) else pyarrow.list_(arrow_type, size)
+    return arrow_type
+
+
+class ArrowExporter:
+    """
+    Output container writing the contents of variables (branch and TriggerVariable ones) to a Parquet or Arrow IPC file
+    Entries are buffered and written by row groups of row_group_size entries, so the memory does not grow with the output
+    Filled like the other output containers: Analysis.dumpToFile calls fillEntry for every selected entry, e.g.
+        analysis.OutputContainers.append(ArrowExporter(path, {name: analysis.Variables[name] for name in names}))
+    """
+    def __init__(self, path: str, variables, *, file_format: str = None, row_group_size: int = 65536, compression: str = "zstd"):
+        if not pyarrow: raise ImportError("pyarrow is required for exporting to Parquet/Arrow")
+        self.Path = path
+        self.FileFormat = file_format if file_format else ("arrow" if path.endswith((".arrow", ".feather")) else "parquet")
+        if self.FileFormat not in ("parquet", "arrow"): raise ValueError(f"Wrong file format: '{self.FileFormat}'")
+        self.RowGroupSize = row_group_size
+        self.CurrentEntry = -1
+
+        self.Variables = variables
+        self.Schema = pyarrow.schema([(name, get_arrow_type(variable)) for name, variable in self.Variables.items()])
+        self.Columns = {name: [] for name in self.Variables} ## entries of the current row group
+        if self.FileFormat == "parquet":
+            self.Writer = pyarrow.parquet.ParquetWriter(path, self.Schema, compression = compression)
+        else:
+            self.Writer = pyarrow.ipc.new_file(path, self.Schema, options = pyarrow.ipc.IpcWriteOptions(compression = compression))
+
+    def getEntries(self) -> int:
+        return self.CurrentEntry + 1
+
+    def fillEntry(self):
+        for name, variable in self.Variables.items():
+            self.Columns[name].append(variable.Content)
+        self.CurrentEntry += 1
+        if len(self.Columns[next(iter(self.Columns))]) >= self.RowGroupSize: self.writeRowGroup()
+
+    def writeRowGroup(self):
+        if not self.Columns or not self.Columns[next(iter(self.Columns))]: return
+        table = pyarrow.Table.from_pydict(self.Columns, schema = self.Schema)
+        self.Writer.write_table(table)
+        self.Columns = {name: [] for name in self.Variables}
+
+    def dumpToFile(self):
+        self.writeRowGroup()
+
+    def close(self):
+        if not self.Writer: return
+        self.writeRowGroup()
+        self.Writer.close()
+        self.Writer = None
@@ -0,0 +1,200 @@
+import json
+import shutil
+
+import os
+
+import numpy as np
+
+from .Container import Container
+from .StageCache import get_file_identity
+from .Variable import Variable
+
+## Correspondence between Variable typecodes and numpy dtypes of the columns
+Dtypes = {
+    'as': np.int32,
+    'i': np.int32,
+    'f': np.float32,
+    'b': np.int8,
+    'B': np.uint8,
+    'h': np.int16,
+    'H': np.uint16,
+}
+
+class ColumnCache:
+    """
+    Decoded branches of a tr_ph tree stored as .npy columns next to the tree ('<path>.columns/') and read memory-mapped:
+    - fixed-size branches as arrays of shape (entries, *sizes);
+    - branches with a size variable first (e.g. [nt], [nt][3][3]) as offsets of shape (entries + 1,)
+      and values of shape (sum of sizes, *maximum fixed sizes)
+    The cache is valid while the source file has the same size and modification time or, if these changed, the same hash
+    Columns missing from the cache are read from the tree once and added to it
+    """
+    def __init__(self, path: str, branches_variables, *, cache_dir: str = None):
+        self.Path = path
+        self.CacheDir = cache_dir if cache_dir else f"{path}.columns"
+        self.Variables = branches_variables
+        self.Manifest = None
+        self.Columns = {} ## {branch name: array or (offsets, values)}, memory-mapped
+
+    def getManifestPath(self):
+        return f"{self.CacheDir}/manifest.json"
+
+    def getColumnPath(self, branch_name, part = 'values'):
+        return f"{self.CacheDir}/{branch_name}.{part}.npy"
+
+    def loadManifest(self):
+        if not os.path.exists(self.getManifestPath()): return None
+        with open(self.getManifestPath(), 'r') as file_manifest:
+            return json.load(file_manifest)
+
+    def saveManifest(self):
+        ## Written last and atomically, so that an interrupted build leaves no valid cache
+        manifest_path_tmp = f"{self.getManifestPath()}.tmp"
+        with open(manifest_path_tmp, 'w') as file_manifest:
+            json.dump(self.Manifest, file_manifest, indent = 2)
+        os.replace(manifest_path_tmp, self.getManifestPath())
+
+    def getColumnRecord(self, branch_name):
+        variable = self.Variables[branch_name]
+        size_variable = variable.Sizes[0] if isinstance(variable.Sizes[0], Variable) else None
+        ## Entry arrays are laid out with the maximum sizes, the first one is cut to the size variable value
+        if variable.Typecode == 'as' or variable.Sizes == (1,): shape = []
+        elif size_variable: shape = list(variable.MaxSizes[1:])
+        else: shape = list(variable.MaxSizes)
+        return {
+            'dtype': np.dtype(Dtypes[variable.Typecode]).str,
+            'shape': shape,
+            'size-name': size_variable.Name if size_variable else None,
+        }
+
+    def isValid(self):
+        ## Refreshes the source identity in the manifest if only the modification time changed
+        manifest = self.loadManifest()
+        if not manifest: return False
+        identity = get_file_identity(self.Path, manifest['source'])
+        if identity['hash'] != manifest['source']['hash']: return False
+        self.Manifest = manifest
+        if identity is not manifest['source']:
+            manifest['source'] = identity
+            self.saveManifest()
+        return True
+
+    def getMissingBranches(self):
+        return [
+            branch_name for branch_name in self.Variables
+            if self.Manifest['columns'].get(branch_name) != self.getColumnRecord(branch_name)
+        ]
+
+    def build(self):
+        ## Reads the missing branches with their size variables from the tree and writes them as columns
+        if not self.isValid():
+            shutil.rmtree(self.CacheDir, ignore_errors = True)
+            self.Manifest = {'source': get_file_identity(self.Path), 'entries': None, 'columns': {}}
+        branch_names = self.getMissingBranches()
+        if not branch_names: return
+        os.makedirs(self.CacheDir, exist_ok = True)
+
+        variables = {branch_name: self.Variables[branch_name] for branch_name in branch_names}
+        size_variables = {}
+        for branch_name in branch_names:
+            for size in self.Variables[branch_name].Sizes:
+                if isinstance(size, Variable): variables[size.Name] = size_variables[size.Name] = size
+        records = {branch_name: self.getColumnRecord(branch_name) for branch_name in branch_names}
+
+        ## Counting pass over the size branches only, then every column is written in place into a mapped .npy file,
+        ## so that memory does not grow with the number of entries
+        size_offsets = self.countSizes(size_variables)
+        container = Container(self.Path, "read", variables, prune = True)
+        n_entries = container.getEntries()
+        columns = {}
+        for branch_name, record in records.items():
+            if record['size-name']:
+                offsets = size_offsets[record['size-name']]
+                np.save(self.getColumnPath(branch_name, 'offsets'), offsets)
+                columns[branch_name] = open_column(self.getColumnPath(branch_name), record['dtype'], [int(offsets[-1])] + record['shape'])
+            else:
+                columns[branch_name] = open_column(self.getColumnPath(branch_name), record['dtype'], [n_entries] + record['shape'])
+
+        for n_entry in range(n_entries):
+            container.getEntry(n_entry)
+            for branch_name, record in records.items():
+                entry_array = np.frombuffer(self.Variables[branch_name].getArray(), dtype = record['dtype'])
+                if record['size-name']:
+                    first, last = size_offsets[record['size-name']][n_entry : n_entry + 2]
+                    if last == first: continue
+                    entry_array = entry_array[:(last - first) * int(np.prod(record['shape'], dtype = np.int64))]
+                    columns[branch_name][first : last] = entry_array.reshape([last - first] + record['shape'])
+                else:
+                    columns[branch_name][n_entry] = entry_array.reshape(record['shape'])
+        container.close()
+
+        for branch_name, record in records.items():
+            if columns[branch_name] is not None: columns[branch_name].flush()
+            self.Manifest['columns'][branch_name] = record
+        del columns
+        self.Manifest['entries'] = n_entries
+        self.saveManifest()
+
+    def countSizes(self, size_variables):
+        ## {size name: offsets of shape (entries + 1,)} of the columns with the size variable
+        if not size_variables: return {}
+        container = Container(self.Path, "read", size_variables, prune = True)
+        n_entries = container.getEntries()
+        offsets = {size_name: np.zeros(n_entries + 1, dtype = np.int64) for size_name in size_variables}
+        for n_entry in range(n_entries):
+            container.getEntry(n_entry)
+            for size_name, size_variable in size_variables.items():
+                offsets[size_name][n_entry + 1] = offsets[size_name][n_entry] + int(size_variable)
+        container.close()
+        return offsets
+
+    def open(self):
+        ## Builds the cache if needed and maps all columns, no data is read until the arrays are accessed
+        self.build()
+        self.Columns = {}
+        for branch_name, record in self.Manifest['columns'].items():
+            if branch_name not in self.Variables: continue
+            values = np.load(self.getColumnPath(branch_name), mmap_mode = 'r')
+            if record['size-name']:
+                self.Columns[branch_name] = (np.load(self.getColumnPath(branch_name, 'offsets'), mmap_mode = 'r'), values)
+            else:
+                self.Columns[branch_name] = values
+        return self
+
+    def getEntries(self) -> int:
+        return self.Manifest['entries']
+
+    def getColumn(self, branch_name):
+        return self.Columns[branch_name]
+
+    def getChunk(self, first_entry, last_entry):
+        """
+        Columns of entries [first_entry, last_entry): views of fixed-size columns,
+        (offsets from the first entry of the chunk, views of values) of the others
+        """
+        chunk = {}
+        for branch_name, column in self.Columns.items():
+            if isinstance(column, tuple):
+                offsets, values = column
+                chunk[branch_name] = (offsets[first_entry : last_entry + 1] - offsets[first_entry], values[offsets[first_entry] : offsets[last_entry]])
+            else:
+                chunk[branch_name] = column[first_entry : last_entry]
+        return chunk
+
+
+def open_column(path, dtype, shape):
+    ## .npy file mapped for writing, an empty column is saved at once since empty files cannot be mapped
+    if 0 in shape:
+        np.save(path, np.zeros(shape, dtype = dtype))
+        return None
+    return np.lib.format.open_memmap(path, mode = 'w+', dtype = dtype, shape = tuple(shape))
+
+
+def get_padded(offsets, values, size, *, fill_value = 0):
+    ## First size elements of every entry of an offsets-values column as an array (entries, size, ...), shorter entries filled
+    counts = np.diff(offsets)
+    indices = offsets[:-1, None] + np.arange(size)[None, :]
+    is_present = np.arange(size)[None, :] < counts[:, None]
+    padded = np.asarray(values)[np.where(is_present, indices, 0)] if len(values) else np.zeros((len(counts), size) + values.shape[1:], dtype = values.dtype)
+    padded[~is_present] = fill_value
+    return padded
@@ -1,9 +1,15 @@
+from fnmatch import fnmatch
 from pprint import pprint
 from typing import Tuple
 
-from ROOT import TFile, TTree
+import json
+import os
+
+from ROOT import TFile, TTree, TNamed, TObject
 
 from .Variable import Variable
+from .StageCache import get_file_identity
+from .MemoryGuard import is_low_memory_mode, LowMemoryCacheSize, LowMemoryAutoFlush
 
 def prod(iterable, *, start = 1):
     if len(iterable) == 0: return start
@@ -13,38 +19,164 @@ def prod(iterable, *, start = 1):
     return _prod
 
 
+## Compression algorithms of ROOT files, settings are 100 * algorithm + level
+CompressionAlgorithms = {'ZLIB': 1, 'LZMA': 2, 'LZ4': 4, 'ZSTD': 5}
+
+def get_compression_settings(compression: str) -> int:
+    ## 'ZSTD:5' -> 505
+    algorithm, level = compression.split(':')
+    if algorithm.upper() not in CompressionAlgorithms: raise ValueError(f"Wrong compression algorithm: '{algorithm}'")
+    return 100 * CompressionAlgorithms[algorithm.upper()] + int(level)
+
+
+def add_size_branches(selected, branches_variables):
+    ## Size variables (nt, nph, ...) of selected arrays must be branches of the same tree
+    for variable in list(selected.values()):
+        for size in variable.Sizes:
+            if isinstance(size, Variable) and size.Name in branches_variables: selected[size.Name] = branches_variables[size.Name]
+    ## Keeping the order of the branches
+    return {branch_name: variable for branch_name, variable in branches_variables.items() if branch_name in selected}
+
+
+def select_branches(branches_variables, *, keep = None, drop = None):
+    """
+    Branches matching any of keep glob patterns (all if keep is None) and none of drop ones, e.g. drop = ["terr0", "tlxe*"]
+    Size variables of selected arrays (nt, nph, ...) are always kept
+    """
+    selected = {
+        branch_name: variable for branch_name, variable in branches_variables.items()
+        if (keep is None or any(fnmatch(branch_name, pattern) for pattern in keep)) and
+        not (drop and any(fnmatch(branch_name, pattern) for pattern in drop))
+    }
+    return add_size_branches(selected, branches_variables)
+
+
 class Container:
     """
     Base class for tr_ph containment.
     Derived classes deliver:
     - branches set (self.dictBranches)
     - methods FillEntry() (because it has to provide some calculations)
+    New trees can be slimmed by keep/drop glob patterns of branch names, see select_branches()
+    Read trees bind branches matching optional glob patterns only if the tree has them (e.g. branches added by later versions
+    of a stage), the missing ones are listed in self.MissingBranches
+
+    Skims: a new tree with a parent container (the input of the stage) stores only the parent entry number of every entry
+    and the branches not read from the parent tree, the parent file is recorded in the skim file.
+    Reading a skim joins it with its parent transparently: branches missing in the skim are read from the parent entry
+
+    Layout of new trees: {'compression': 'LZ4:4', 'basket-size': bytes, 'auto-flush': entries if positive, bytes if negative},
+    ROOT defaults for the missing settings, see Benchmarks/Layouts.py for measuring them on our trees
+    In the low-memory mode of a restarted pipeline task read trees get a smaller cache and new trees are flushed more often
     """
+    SkimInfoName = "skim_parent"
+    ParentEntryName = "parent_entry"
+    SkimIndexNames = ("runnum", "evnum") ## kept in skims for friends joined by index
 
-    def __init__(self, path: str, mode: str, branches_variables):
+    def __init__(self, path: str, mode: str, branches_variables, *, prune: bool = False, keep = None, drop = None, parent = None, layout = None, optional = None):
         if mode in ("read", "new", "recreate", "update"):
             self.Mode = mode
         else:
             raise ValueError(f"Wrong mode: '{mode}'")
         self.CurrentEntry = -1
+        self.Friends = [] ## [(container, index_names), ...]
+        self.IsMatched = True ## the current entry has entries in all friend trees, see getEntry
+        self.Parent = None ## parent container of a skim: opened from the skim info when reading, the stage input when writing
+        self.ParentEntry = Variable(Container.ParentEntryName, "i")
+        self.MissingBranches = []
 
         self.ContainerFile = TFile.Open(path, self.Mode)
         if self.Mode in ("read", "update"):
             self.Tree = self.ContainerFile.Get("tr_ph")
+            ## reading only branches bound to variables
+            if prune: self.Tree.SetBranchStatus("*", 0)
+            if self.Mode == "read": self.openParent(prune = prune)
+            if is_low_memory_mode(): self.Tree.SetCacheSize(LowMemoryCacheSize)
         elif self.Mode in ("new", "recreate"):
+            ## Branches are created with the compression of the file
+            if layout and layout.get('compression'): self.ContainerFile.SetCompressionSettings(get_compression_settings(layout['compression']))
             self.Tree = TTree("tr_ph", "tr_ph")
 
         self.Variables = branches_variables
+        if self.Mode == "read" and optional:
+            self.MissingBranches = [
+                branch_name for branch_name in self.Variables
+                if any(fnmatch(branch_name, pattern) for pattern in optional) and not self.hasBranch(branch_name)
+            ]
+            self.Variables = {branch_name: variable for branch_name, variable in self.Variables.items() if branch_name not in self.MissingBranches}
+        if self.Mode in ("new", "recreate") and (keep is not None or drop):
+            self.Variables = select_branches(branches_variables, keep = keep, drop = drop)
+        if self.Mode in ("new", "recreate") and parent:
+            ## Branches read from the parent tree itself are not copied, kinfit friends and calculated branches are
+            self.Parent = parent
+            self.Variables = add_size_branches({
+                branch_name: variable for branch_name, variable in self.Variables.items()
+                if parent.Variables.get(branch_name) is not variable or branch_name in Container.SkimIndexNames
+            }, self.Variables)
+            self.Tree.Branch(Container.ParentEntryName, self.ParentEntry.getArray(), f"{Container.ParentEntryName}/I")
         for branch_name, variable in self.Variables.items():
             self.addBranch(branch_name, variable)
-
+        if self.Mode in ("new", "recreate") and layout:
+            if layout.get('basket-size'): self.Tree.SetBasketSize("*", layout['basket-size'])
+            if layout.get('auto-flush'): self.Tree.SetAutoFlush(layout['auto-flush'])
+        if self.Mode in ("new", "recreate") and is_low_memory_mode(): self.Tree.SetAutoFlush(LowMemoryAutoFlush)
+
+
+    def openParent(self, *, prune: bool = False):
+        skim_info = self.ContainerFile.Get(Container.SkimInfoName)
+        if not skim_info: return
+        skim_info = json.loads(skim_info.GetTitle())
+        ## Parent file is hashed only if its size or modification time differ from the recorded ones
+        ## Skims written before the identity was recorded are checked by the entries number only
+        if 'identity' in skim_info and get_file_identity(skim_info['path'], skim_info['identity'])['hash'] != skim_info['identity']['hash']:
+            raise ValueError(f"Parent tree of skim '{self.ContainerFile.GetName()}' changed: '{skim_info['path']}' has another content")
+        self.Parent = Container(skim_info['path'], "read", {}, prune = prune)
+        if self.Parent.getEntries() != skim_info['entries']:
+            raise ValueError(f"Parent tree of skim '{self.ContainerFile.GetName()}' changed: {self.Parent.getEntries()} entries in '{skim_info['path']}', {skim_info['entries']} expected")
+        self.Tree.SetBranchStatus(Container.ParentEntryName, 1)
+        self.Tree.SetBranchAddress(Container.ParentEntryName, self.ParentEntry.getArray())
+
+    def hasBranch(self, branch_name) -> bool:
+        ## Branches of a skim include the ones of its parent
+        if self.Tree.FindBranch(branch_name): return True
+        return bool(self.Mode == "read" and self.Parent and self.Parent.hasBranch(branch_name))
+
+    def isSkim(self) -> bool:
+        return self.Parent is not None
 
     def getEntries(self) -> int:
         return self.Tree.GetEntries()
 
     def getEntry(self, entry: int):
+        ## Friends joined by index may miss the entry (e.g. kinfit outputs of a subset), IsMatched is False then
+        ## and the friend variables keep the contents of the previous entry
         self.Tree.GetEntry(entry)
         self.CurrentEntry = entry
+        if self.Parent: self.Parent.getEntry(self.ParentEntry.Content)
+        self.IsMatched = True
+        for friend, index_names in self.Friends:
+            friend_entry = friend.Tree.GetReadEntry()
+            if friend_entry < 0: self.IsMatched = False
+            friend.CurrentEntry = friend_entry
+
+    """
+    Attaches the tree of another container as a friend, so that one GetEntry reads branches of both trees.
+    Without index the trees must be aligned entry by entry,
+    with index (e.g. ("runnum", "evnum")) the friend entry is looked up by index branches values of this tree
+    """
+    def addFriend(self, friend, *, index_names: Tuple[str, str] = None):
+        if index_names:
+            friend.Tree.BuildIndex(*index_names)
+        elif friend.getEntries() != self.getEntries():
+            raise ValueError(f"Friend tree is not aligned: {friend.getEntries()} entries in '{friend.ContainerFile.GetName()}', {self.getEntries()} entries in '{self.ContainerFile.GetName()}'")
+        self.Tree.AddFriend(friend.Tree, f"friend{len(self.Friends)}")
+        self.Friends.append((friend, index_names))
+
+    def getBranchNames(self):
+        ## Branches bound to variables in this tree and its friends, i.e. the ones a pruned read would read
+        branch_names = list(self.Variables)
+        for friend, _ in self.Friends: branch_names += friend.getBranchNames()
+        return branch_names
 
     def getBranchSignature(self, branch_name):
         variable = self.Variables[branch_name]
@@ -57,6 +189,7 @@ class Container:
         return f"{branch_name}{''.join([f'[{size}]' for size in named_sizes])}/{variable.getTypecode()}"
 
     def fillEntry(self):
+        if self.Parent: self.ParentEntry.Content = self.Parent.CurrentEntry
         self.Tree.Fill()
         self.CurrentEntry += 1
 
@@ -71,10 +204,19 @@ class Container:
     Doesn't throw an exception when the tree is read-only
     """
     def addBranch(self, branch_name: str, variable: Variable):
+        if self.Mode == "read" and not self.Tree.FindBranch(branch_name) and self.Parent:
+            ## Size branches of the array are read in the parent tree too, they are bound to the skim ones otherwise
+            for size in variable.Sizes:
+                if isinstance(size, Variable) and size.Name not in self.Parent.Variables and self.Parent.Tree.FindBranch(size.Name):
+                    self.Parent.Tree.SetBranchStatus(size.Name, 1)
+            self.Parent.Variables[branch_name] = variable
+            self.Parent.addBranch(branch_name, variable)
+            return
         if self.Mode == "read" and not self.Tree.FindBranch(branch_name):
             raise ValueError(f"Branch not found: {branch_name}")
 
         if (self.Mode == "read" or (self.Mode == "update" and self.Tree.FindBranch(branch_name))):
+            self.Tree.SetBranchStatus(branch_name, 1)
             self.Tree.SetBranchAddress(branch_name, variable.getArray())
         elif ((self.Mode in ("new", "recreate")) or (self.Mode == "update" and not self.Tree.FindBranch(branch_name))):
             self.Tree.Branch(branch_name, variable.getArray(), self.getBranchSignature(branch_name))
@@ -85,9 +227,16 @@ class Container:
         else:
             self.ContainerFile.cd()
             self.Tree.Write()
+            if self.Parent:
+                parent_path = os.path.abspath(self.Parent.ContainerFile.GetName())
+                skim_info = {'path': parent_path, 'entries': self.Parent.getEntries(), 'identity': get_file_identity(parent_path)}
+                TNamed(Container.SkimInfoName, json.dumps(skim_info)).Write("", TObject.kOverwrite)
             self.ContainerFile.Save()
             return self.Tree
 
     def close(self):
         if self.Mode in ("new", "recreate"): del self.Tree
         self.ContainerFile.Close()
+        for friend, _ in self.Friends: friend.close()
+        ## The parent of a new skim is the input of the stage, it is closed by its owner
+        if self.Parent and self.Mode == "read": self.Parent.close()
@@ -0,0 +1,141 @@
+from statistics import median
+
+import heapq
+import json
+import os
+
+def get_tree_info(path, tree_name = "tr_ph"):
+    ## Entries and compressed size of the tree branches, read from the file header without reading any entry
+    ## Files without the tree (e.g. histograms) are described by their size only
+    from ROOT import TFile
+    tree_info = {'entries': 0, 'zip-bytes': os.path.getsize(path)}
+    tree_file = TFile.Open(path, "read")
+    if not tree_file or tree_file.IsZombie(): return tree_info
+    tree = tree_file.Get(tree_name)
+    if tree:
+        tree_info['entries'] = int(tree.GetEntries())
+        tree_info['zip-bytes'] = sum(int(branch.GetZipBytes("*")) for branch in tree.GetListOfBranches())
+    tree_file.Close()
+    return tree_info
+
+
+class CostModel:
+    """
+    Throughput of the stages (events/s and compressed bytes/s of the input trees) measured in the previous runs
+    and in calibration runs, kept in a JSON file by stage, sample type and kinfit type
+    Wall time of a task is predicted from the entries of its input trees, or from their size if no entries are known
+    """
+    def __init__(self, path = None, *, n_records = 20):
+        self.Path = path
+        self.NRecords = n_records
+        self.Records = {} ## {key: [{'events-per-second': ..., 'bytes-per-second': ...}, ...]}
+        if path and os.path.exists(path):
+            with open(path, 'r') as file_costs:
+                self.Records = json.load(file_costs)
+
+    def getKey(self, task):
+        if not task.Plan: return task.Name
+        return '-'.join(str(task.Plan[name]) for name in ('stage', 'sample', 'kinfit-type', 'kinfit-engine') if name in task.Plan)
+
+    def isKnown(self, task):
+        return bool(self.Records.get(self.getKey(task)))
+
+    def getInputsInfo(self, task):
+        inputs_info = {'entries': 0, 'zip-bytes': 0}
+        for path in task.Inputs:
+            if not os.path.exists(path): continue
+            tree_info = get_tree_info(path)
+            inputs_info['entries'] += tree_info['entries']
+            inputs_info['zip-bytes'] += tree_info['zip-bytes']
+        return inputs_info
+
+    def add(self, task, inputs_info, wall_time):
+        if wall_time <= 0: return
+        record = {
+            'events-per-second': inputs_info['entries'] / wall_time,
+            'bytes-per-second': inputs_info['zip-bytes'] / wall_time,
+        }
+        key = self.getKey(task)
+        self.Records[key] = (self.Records.get(key, []) + [record])[-self.NRecords:]
+
+    def addRun(self, pipeline):
+        ## Throughput of the tasks run by the pipeline, up-to-date tasks did not process anything
+        for task in pipeline.getTasks('done'):
+            if task.IsCached or task.IsLowMemory: continue
+            self.add(task, self.getInputsInfo(task), task.WallTime)
+
+    def predictTime(self, task, inputs_info):
+        ## None if the stage has not been calibrated
+        if not self.isKnown(task): return None
+        records = self.Records[self.getKey(task)]
+        events_per_second = median(record['events-per-second'] for record in records)
+        if inputs_info['entries'] and events_per_second: return inputs_info['entries'] / events_per_second
+        return inputs_info['zip-bytes'] / median(record['bytes-per-second'] for record in records)
+
+    def save(self):
+        if not self.Path: return
+        with open(self.Path, 'w') as file_costs:
+            json.dump(self.Records, file_costs, indent = 2)
+
+
+def estimate_run(pipeline, outdated, cost_model, n_workers):
+    """
+    Dry-run estimate of the tasks to run (outdated, see Pipeline.plan): wall time and memory of every task
+    and of the whole run on n_workers, scheduled like Pipeline.submitTasks (dependencies first, the longest tasks first)
+    Inputs produced during the run are estimated by the inputs of their producers, i.e. before cuts, as an upper bound
+    """
+    tasks = [pipeline.Tasks[name] for name, is_outdated in outdated.items() if is_outdated]
+
+    inputs_infos = {}
+    def get_inputs_info(task):
+        if task.Name not in inputs_infos:
+            inputs_info = cost_model.getInputsInfo(task)
+            producers = {pipeline.Producers[path].Name: pipeline.Producers[path] for path in task.Inputs if path in pipeline.Producers and not os.path.exists(path)}
+            for producer in producers.values():
+                producer_info = get_inputs_info(producer)
+                inputs_info = {name: inputs_info[name] + producer_info[name] for name in inputs_info}
+            inputs_infos[task.Name] = inputs_info
+        return inputs_infos[task.Name]
+
+    estimate = {}
+    for task in tasks:
+        inputs_info = get_inputs_info(task)
+        estimate[task.Name] = {
+            'entries': inputs_info['entries'],
+            'zip-bytes': inputs_info['zip-bytes'],
+            'wall-time': cost_model.predictTime(task, inputs_info),
+            'memory': pipeline.MemoryHistory.predict(task.getMemoryKey()),
+        }
+
+    ## List scheduling: a worker takes the longest ready task as soon as it is free
+    names = set(estimate)
+    pending = list(tasks)
+    running = [] ## heap of (finish time, name)
+    done = set()
+    time, peak_memory = 0., 0
+    while pending or running:
+        ready = [task for task in pending if all(dependency.Name not in names or dependency.Name in done for dependency in task.Dependencies)]
+        ready.sort(key = lambda task: estimate[task.Name]['wall-time'] or 0., reverse = True)
+        for task in ready[:n_workers - len(running)]:
+            pending.remove(task)
+            heapq.heappush(running, (time + (estimate[task.Name]['wall-time'] or 0.), task.Name))
+        peak_memory = max(peak_memory, sum(estimate[name]['memory'] for _, name in running))
+        if not running: break
+        time, name = heapq.heappop(running)
+        done.add(name)
+
+    pipeline.Logger.info(f"{'Task':<60} {'Entries':>10} {'Input, MB':>10} {'Wall time, s':>12} {'Memory, MB':>10}")
+    for name, task_estimate in estimate.items():
+        wall_time = f"{task_estimate['wall-time']:.0f}" if task_estimate['wall-time'] is not None else '?'
+        pipeline.Logger.info(
+            f"{name:<60} {task_estimate['entries']:>10} {task_estimate['zip-bytes'] >> 20:>10} "
+            f"{wall_time:>12} {task_estimate['memory'] >> 20:>10}"
+        )
+    uncalibrated = sorted({cost_model.getKey(pipeline.Tasks[name]) for name, task_estimate in estimate.items() if task_estimate['wall-time'] is None})
+    if uncalibrated: pipeline.Logger.info(f"Stages without calibration are counted as 0 s: {uncalibrated}")
+    cpu_time = sum(task_estimate['wall-time'] or 0. for task_estimate in estimate.values())
+    pipeline.Logger.info(
+        f"Estimate for {n_workers} workers: wall time {time / 3600:.2f} h, "
+        f"CPU time {cpu_time / 3600:.2f} h, peak memory {peak_memory / (1 << 30):.1f} GB"
+    )
+    return {'tasks': estimate, 'wall-time': time, 'cpu-time': cpu_time, 'peak-memory': peak_memory}
@@ -0,0 +1,102 @@
+from math import pi
+
+import numpy as np
+
+class KinematicFitter:
+    """
+    Constrained least-squares fit of charged tracks with 4-momentum conservation (Lagrange multipliers method)
+    Track parameters are (P, theta, phi), their covariance matrices are taken from 'terr' branch
+    Every method works on a chunk of events: arrays with the leading dimension equal to the number of events
+    """
+    def __init__(self, masses, *, max_iterations = 20, chi2_tolerance = 1e-3, constraint_tolerance = 1e-2):
+        self.Masses = np.asarray(masses, dtype = np.float64)
+        self.MaxIterations = max_iterations
+        self.Chi2Tolerance = chi2_tolerance
+        self.ConstraintTolerance = constraint_tolerance ## MeV
+
+    def calculateConstraints(self, parameters, total_p4):
+        ## parameters: [n_events, 3 * n_tracks] -> (P, theta, phi) for every track
+        n_events = parameters.shape[0]
+        tracks_parameters = parameters.reshape(n_events, -1, 3)
+        p, th, phi = tracks_parameters[..., 0], tracks_parameters[..., 1], tracks_parameters[..., 2]
+        sin_th, cos_th = np.sin(th), np.cos(th)
+        sin_phi, cos_phi = np.sin(phi), np.cos(phi)
+        energies = np.sqrt(p ** 2 + self.Masses ** 2)
+
+        ## f = (sum(px), sum(py), sum(pz), sum(E)) - (0, 0, 0, 2 * E_beam)
+        constraints = np.stack([
+            (p * sin_th * cos_phi).sum(axis = 1),
+            (p * sin_th * sin_phi).sum(axis = 1),
+            (p * cos_th).sum(axis = 1),
+            energies.sum(axis = 1),
+        ], axis = 1) - total_p4
+
+        ## df/d(P, theta, phi): [n_events, 4, n_tracks, 3]
+        jacobian = np.zeros((n_events, 4, tracks_parameters.shape[1], 3))
+        jacobian[:, 0, :, 0] = sin_th * cos_phi
+        jacobian[:, 0, :, 1] = p * cos_th * cos_phi
+        jacobian[:, 0, :, 2] = -p * sin_th * sin_phi
+        jacobian[:, 1, :, 0] = sin_th * sin_phi
+        jacobian[:, 1, :, 1] = p * cos_th * sin_phi
+        jacobian[:, 1, :, 2] = p * sin_th * cos_phi
+        jacobian[:, 2, :, 0] = cos_th
+        jacobian[:, 2, :, 1] = -p * sin_th
+        jacobian[:, 3, :, 0] = p / energies
+        return constraints, jacobian.reshape(n_events, 4, -1)
+
+    def fit(self, beam_energies, momenta, thetas, phis, covariances):
+        """
+        beam_energies: [n_events], momenta, thetas, phis: [n_events, n_tracks], covariances: [n_events, n_tracks, 3, 3]
+        Returns dictionary of arrays: 'is-converged', 'chi2', 'momenta', 'thetas', 'phis', 'energies'
+        """
+        n_events, n_tracks = momenta.shape
+        if n_tracks != len(self.Masses): raise ValueError(f"Number of tracks is not equal to number of masses: {n_tracks} != {len(self.Masses)}")
+
+        measured = np.stack([momenta, thetas, phis], axis = -1).reshape(n_events, 3 * n_tracks).astype(np.float64)
+        covariance = np.zeros((n_events, 3 * n_tracks, 3 * n_tracks))
+        for i in range(n_tracks):
+            covariance[:, 3 * i : 3 * (i + 1), 3 * i : 3 * (i + 1)] = covariances[:, i]
+        total_p4 = np.zeros((n_events, 4))
+        total_p4[:, 3] = 2.0 * np.asarray(beam_energies, dtype = np.float64)
+
+        fitted = measured.copy()
+        chi2 = np.full(n_events, np.inf)
+        is_converged = np.zeros(n_events, dtype = bool)
+        is_failed = np.zeros(n_events, dtype = bool)
+        for _ in range(self.MaxIterations):
+            is_active = ~(is_converged | is_failed)
+            if not is_active.any(): break
+
+            ## Linearizing constraints around current fitted parameters
+            constraints, jacobian = self.calculateConstraints(fitted, total_p4)
+            residuals = constraints + np.einsum('nij,nj->ni', jacobian, measured - fitted)
+            cov_jacobian_t = covariance @ jacobian.transpose(0, 2, 1)
+            s_matrix = jacobian @ cov_jacobian_t
+            is_singular = ~(np.abs(np.linalg.det(s_matrix)) > 0.0)
+            s_matrix[is_singular] = np.eye(4)
+
+            lagrange_multipliers = np.linalg.solve(s_matrix, residuals[..., None])[..., 0]
+            fitted_new = measured - np.einsum('nij,nj->ni', cov_jacobian_t, lagrange_multipliers)
+            chi2_new = np.einsum('ni,ni->n', residuals, lagrange_multipliers)
+
+            fitted = np.where(is_active[:, None], fitted_new, fitted)
+            chi2_prev, chi2 = chi2, np.where(is_active, chi2_new, chi2)
+            constraints, _ = self.calculateConstraints(fitted, total_p4)
+
+            is_failed |= is_active & (is_singular | ~np.isfinite(chi2))
+            is_converged |= (
+                is_active & ~is_failed &
+                (np.abs(chi2 - chi2_prev) < self.Chi2Tolerance) &
+                (np.abs(constraints).max(axis = 1) < self.ConstraintTolerance)
+            )
+
+        fitted = fitted.reshape(n_events, n_tracks, 3)
+        fitted_momenta = np.abs(fitted[..., 0])
+        return {
+            'is-converged': is_converged,
+            'chi2': np.where(is_failed, np.inf, chi2),
+            'momenta': fitted_momenta,
+            'thetas': fitted[..., 1],
+            'phis': np.mod(fitted[..., 2], 2.0 * pi),
+            'energies': np.sqrt(fitted_momenta ** 2 + self.Masses ** 2),
+        }
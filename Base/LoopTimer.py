@@ -0,0 +1,77 @@
+from collections import OrderedDict
+from time import perf_counter
+
+import json
+
+## Set in a worker process for tasks run with timing, see Analysis.loop
+TimingMode = False
+
+def set_timing_mode(is_timed):
+    global TimingMode
+    TimingMode = is_timed
+
+
+def is_timing_mode():
+    return TimingMode
+
+
+class LoopTimer:
+    """
+    Cumulative wall time and number of calls of the parts of Analysis.loop:
+    'io' (getEntry), 'cut' (cut functions), 'trigger' (TriggerVariable functions), 'histogram' (filling), 'output' (dumpToFile)
+    Times are inclusive: a TriggerVariable calculated inside a cut counts for both of them
+    """
+    Kinds = ('io', 'cut', 'trigger', 'histogram', 'output')
+
+    def __init__(self):
+        self.Records = OrderedDict() ## {(kind, name): [time, n_calls]} of the current stage
+        self.StageStartTime = perf_counter()
+        self.Stages = OrderedDict() ## {stage name: {'wall-time': ..., 'records': {kind: {name: {'time': ..., 'calls': ...}}}}}
+
+    def add(self, kind, name, time):
+        record = self.Records.get((kind, name))
+        if record is None: record = self.Records[(kind, name)] = [0., 0]
+        record[0] += time
+        record[1] += 1
+
+    def wrap(self, kind, name, func):
+        def timed_func(*args, **kwargs):
+            start_time = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(kind, name, perf_counter() - start_time)
+        timed_func.__wrapped__ = func
+        return timed_func
+
+    def startStage(self):
+        self.Records = OrderedDict()
+        self.StageStartTime = perf_counter()
+
+    def endStage(self, stage_name):
+        records = {kind: {} for kind in LoopTimer.Kinds}
+        for (kind, name), (time, n_calls) in self.Records.items():
+            records[kind][name] = {'time': time, 'calls': n_calls}
+        self.Stages[stage_name] = {'wall-time': perf_counter() - self.StageStartTime, 'records': records}
+        self.Records = OrderedDict()
+        return self.Stages[stage_name]
+
+    def formSummary(self, stage_name):
+        ## Lines of the summary table of a stage, the slowest parts first
+        stage = self.Stages[stage_name]
+        lines = [f"'{stage_name}' timing, wall time {stage['wall-time']:.1f} s", f"{'Kind':<10} {'Name':<40} {'Time, s':>10} {'Share':>7} {'Calls':>10} {'us/call':>9}"]
+        rows = [(kind, name, record) for kind, kind_records in stage['records'].items() for name, record in kind_records.items()]
+        for kind, name, record in sorted(rows, key = lambda row: row[2]['time'], reverse = True):
+            share = record['time'] / stage['wall-time'] if stage['wall-time'] > 0 else 0.
+            lines.append(
+                f"{kind:<10} {name:<40} {record['time']:>10.2f} {share:>7.1%} {record['calls']:>10} "
+                f"{1e6 * record['time'] / record['calls']:>9.1f}"
+            )
+        return lines
+
+    def formJSON(self):
+        return json.dumps(self.Stages, indent = 2)
+
+    def save(self, path):
+        with open(path, 'w') as file_timing:
+            file_timing.write(self.formJSON())
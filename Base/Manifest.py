@@ -0,0 +1,101 @@
+import json
+
+## Prefixes of the file names of the samples, data files have none
+SAMPLE_PREFIXES = {'data': '', 'sim': 'sim_', 'multihad': 'multihad_'}
+
+def get_sample_name(is_sim = False, is_multihad = False):
+    return 'sim' if is_sim else 'multihad' if is_multihad else 'data'
+
+
+def get_point_path(directory, name, version, year, energy_point, sample = 'data'):
+    ## Common template of the files of one energy point: '{directory}/{prefix}{name}{year}_tr_ph_fc_e{energy_point}_{version}.root'
+    return f"{directory}/{SAMPLE_PREFIXES[sample]}{name}{year}_tr_ph_fc_e{energy_point}_{version}.root"
+
+
+## Default directories of the files of every stage (and of raw samples), one place for all scripts,
+## so that a stage reads its inputs where the previous stage writes them
+DEFAULT_ROOTS = {
+    'multihadron': "/store11/idpershin/simulation/multihadron",
+    'prelim_cut': "/store11/idpershin/kpkmpippim/prelim_cuts_new",
+    'pershin_cut': "/store11/idpershin/kpkmpippim/pershin_cut_wo_TotalP-DeltaE",
+    'pershin_cut_2': "/store11/idpershin/kpkmpippim/pershin_cut_w_TotalP-DeltaE-2",
+    'pershin_cut_wo_eta': "/store11/idpershin/kpkmpippim/pershin_cut_w_TotalP-DeltaE-2_wo_eta",
+    'kinfit_analysis': "/store11/idpershin/kpkmpippim/kinfit",
+    'final_cut': "/store11/idpershin/kpkmpippim/final_cuts_new",
+    'pershin_dynamics': "/store11/idpershin/kpkmpippim/dynamics/pershin",
+}
+
+def get_root(roots, name, default = None):
+    ## Directory of the files of a stage (or of a raw sample), overridden by the output roots of a manifest
+    if roots and name in roots: return roots[name]
+    return default if default else DEFAULT_ROOTS[name]
+
+
+class Manifest:
+    """
+    Declarative description of a pipeline run, kept in a JSON file:
+    {
+        "info": path of data info JSON (versions, years and energy points),
+        "fit-data": path of missing mass fit data JSON,
+        "points": {version: {year: [elabel, ...]}}, optional, all points of the info by default,
+        "samples": ["data", "sim", "multihad"],
+        "stages": ["prelim_cut", "pershin_cut_2", "kinfit_analysis", "pershin_dynamics", "kkpipimissmass_fit"],
+        "roots": {stage or raw sample name: directory}, optional, DEFAULT_ROOTS otherwise,
+        "kinfit-type": "Permut" or "DCLklhd",
+        "kinfit-engine": "external" or "native",
+        "slim": true to drop the branches not read by later stages from prelim_cut outputs, optional, false by default,
+            needs the native kinfit engine, kinfit executables read the full preliminary trees,
+        "skim": true to write pershin_cut_2 outputs as skims of their inputs, optional, false by default,
+        "output-layout": {"compression": "LZ4:4", "basket-size": ..., "auto-flush": ...} of prelim_cut and pershin_cut_2 outputs, optional,
+        "work-dir": directory of logs, reports, memory history and profiles
+    }
+    """
+    Stages = ["prelim_cut", "pershin_cut", "pershin_cut_2", "pershin_cut_wo_eta", "kinfit_analysis", "pershin_dynamics", "kkpipimissmass_fit"]
+    DefaultStages = ["prelim_cut", "pershin_cut_2", "kinfit_analysis", "pershin_dynamics", "kkpipimissmass_fit"]
+    Samples = ["data", "sim", "multihad"]
+
+    def __init__(self, manifest_data):
+        self.InfoPath = manifest_data["info"]
+        self.FitDataPath = manifest_data["fit-data"]
+        self.Points = manifest_data.get("points")
+        self.Samples = manifest_data.get("samples", ["data"])
+        self.Stages = manifest_data.get("stages", Manifest.DefaultStages)
+        self.Roots = manifest_data.get("roots", {})
+        self.KinfitType = manifest_data["kinfit-type"]
+        self.KinfitEngine = manifest_data.get("kinfit-engine", "external")
+        self.IsSlim = manifest_data.get("slim", False)
+        self.IsSkim = manifest_data.get("skim", False)
+        self.OutputLayout = manifest_data.get("output-layout")
+        self.WorkDir = manifest_data["work-dir"]
+
+        for sample in self.Samples:
+            if sample not in Manifest.Samples: raise ValueError(f"Unknown sample: {sample}")
+        for stage in self.Stages:
+            if stage not in Manifest.Stages: raise ValueError(f"Unknown stage: {stage}")
+        ## prelim_cut of multihad samples writes its cut and hists files under data names in the pershin_cut root, see Scripts/prelim_cut.py
+        if self.hasStage("prelim_cut") and self.hasSample("multihad") and self.hasStage("pershin_cut") and self.hasSample("data"):
+            raise ValueError(
+                "prelim_cut of multihad samples and pershin_cut of data write the same cut and hists files in the pershin_cut root, "
+                "run them in separate manifests with different pershin_cut roots"
+            )
+        if self.IsSlim and self.hasStage("kinfit_analysis") and self.KinfitEngine == "external":
+            raise ValueError("Slim preliminary outputs cannot be read by kinfit executables, use a native kinfit engine")
+
+    @staticmethod
+    def load(path):
+        with open(path, 'r') as file_manifest:
+            return Manifest(json.load(file_manifest))
+
+    def hasStage(self, stage):
+        return stage in self.Stages
+
+    def hasSample(self, sample):
+        return sample in self.Samples
+
+    def getPoints(self, json_info):
+        ## [(version, year, elabel), ...] of the manifest points, all points of the data info if not given
+        points = self.Points if self.Points is not None else {
+            version: {year: list(year_data["elabels"]) for year, year_data in json_info[version]["years"].items()}
+            for version in json_info
+        }
+        return [(version, year, elabel) for version in points for year in points[version] for elabel in points[version][year]]
@@ -0,0 +1,120 @@
+import _thread
+import threading
+import json
+import os
+
+## Set in a worker process for a task restarted after exceeding its memory limit, see Analysis.loop and Container
+LowMemoryMode = False
+
+## Tree buffers of the low-memory mode: read cache and baskets of new trees flushed every few MB instead of ~30 MB
+LowMemoryCacheSize = 4 << 20
+LowMemoryAutoFlush = -(4 << 20)
+
+def set_low_memory_mode(is_low_memory):
+    global LowMemoryMode
+    LowMemoryMode = is_low_memory
+
+
+def is_low_memory_mode():
+    return LowMemoryMode
+
+
+def get_rss():
+    ## Resident set size of the current process in bytes
+    with open('/proc/self/statm', 'r') as file_statm:
+        return int(file_statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def reset_peak_rss():
+    ## Linux resets VmHWM (peak resident set size) of the process on writing '5' to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as file_clear_refs:
+            file_clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss():
+    with open('/proc/self/status', 'r') as file_status:
+        for line in file_status:
+            if line.startswith('VmHWM:'): return int(line.split()[1]) * 1024
+    return get_rss()
+
+
+class MemoryLimitExceededError(MemoryError):
+    def __init__(self, message, peak_memory):
+        MemoryError.__init__(self, message)
+        self.PeakMemory = peak_memory
+
+
+class MemoryGuard:
+    """
+    Watches the resident memory of a worker process while a task runs
+    Peak memory of the task is available after exit as PeakMemory,
+    a task going over the limit is interrupted and MemoryLimitExceededError is raised instead
+    """
+    def __init__(self, limit = None, *, interval = 0.5):
+        self.Limit = limit
+        self.Interval = interval
+        self.PeakMemory = 0
+        self.IsExceeded = False
+        self.IsPeakReset = False
+        self.StopEvent = threading.Event()
+        self.WatchThread = None
+
+    def watch(self):
+        while not self.StopEvent.wait(self.Interval):
+            rss = get_rss()
+            self.PeakMemory = max(self.PeakMemory, rss)
+            if self.Limit and rss > self.Limit:
+                self.IsExceeded = True
+                _thread.interrupt_main()
+                return
+
+    def __enter__(self):
+        self.IsPeakReset = reset_peak_rss()
+        self.PeakMemory = get_rss()
+        self.WatchThread = threading.Thread(target = self.watch, daemon = True)
+        self.WatchThread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.StopEvent.set()
+        self.WatchThread.join()
+        ## Without the reset VmHWM is the peak of the whole worker life, the sampled peak is used then
+        if self.IsPeakReset: self.PeakMemory = max(self.PeakMemory, get_peak_rss())
+        if self.IsExceeded and exc_type is KeyboardInterrupt:
+            raise MemoryLimitExceededError(f"Memory limit exceeded: {self.PeakMemory >> 20} MB > {self.Limit >> 20} MB", self.PeakMemory) from None
+        return False
+
+
+class MemoryHistory:
+    """
+    Peak memory of finished tasks by stage and sample type, kept in a JSON file between runs
+    Prediction for a new task is the largest of recent peaks with a margin
+    """
+    def __init__(self, path = None, *, default_memory = 2 << 30, margin = 1.2, n_records = 20):
+        self.Path = path
+        self.DefaultMemory = default_memory
+        self.Margin = margin
+        self.NRecords = n_records
+        self.Records = {} ## {key: [peak memory, ...]}
+        if path and os.path.exists(path):
+            with open(path, 'r') as file_history:
+                self.Records = json.load(file_history)
+
+    def isKnown(self, key):
+        return key in self.Records
+
+    def predict(self, key):
+        if not self.isKnown(key): return self.DefaultMemory
+        return int(self.Margin * max(self.Records[key]))
+
+    def add(self, key, peak_memory):
+        self.Records[key] = (self.Records.get(key, []) + [peak_memory])[-self.NRecords:]
+
+    def save(self):
+        if not self.Path: return
+        with open(self.Path, 'w') as file_history:
+            json.dump(self.Records, file_history, indent = 2)
@@ -0,0 +1,443 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import errno
+import json
+import os
+import time
+import traceback
+import cProfile
+
+import logging
+from logging import getLogger, StreamHandler, FileHandler, Formatter
+
+import sys
+
+from .StageCache import StageCache
+from .WorkerPool import WorkerCrashedError
+from .MemoryGuard import MemoryGuard, MemoryHistory, MemoryLimitExceededError, set_low_memory_mode
+from .LoopTimer import set_timing_mode
+from .ProgressMeter import set_metrics_path
+from .SamplingProfiler import SamplingProfiler
+
+class Task:
+    """
+    One unit of work of a pipeline (e.g. one stage at one energy point)
+    inputs/outputs are file paths: a task depends on the tasks producing its inputs
+    sources/plan: modules and stage description the outputs depend on, if given the task is skipped
+    while its StageCache record matches
+    cost_factor: relative cost of the stage per byte of input, used to start the biggest tasks first
+    is_io_bound: the task mostly streams its inputs (e.g. reading CMD3ContainerV9 trees), it counts against volume limits
+    """
+    def __init__(self, name, func, *, args = (), kwargs = None, inputs = (), outputs = (), sources = None, plan = None, cost_factor = 1.0, is_io_bound = True):
+        self.Name = name
+        self.Func = func
+        self.Args = tuple(args)
+        self.Kwargs = kwargs if kwargs else {}
+        self.Inputs = list(inputs)
+        self.Outputs = list(outputs)
+        self.Sources = sources
+        self.Plan = plan
+        self.CostFactor = cost_factor
+        self.IsIOBound = is_io_bound
+
+        ## Filled by Pipeline
+        self.Dependencies = []
+        self.Dependents = []
+        self.PathCostFactor = None ## cost factor of the task and the most expensive chain of its dependents
+        self.Status = 'pending' ## pending, running, done, failed, skipped, excluded
+        self.Result = None
+        self.Error = None
+        self.IsCached = False
+        self.Attempts = 0
+        self.StartTime = None
+        self.WallTime = 0.
+        self.PeakMemory = 0
+        self.IsLowMemory = False ## restarted after exceeding its memory limit
+
+    def areInputsAvailable(self):
+        return all(os.path.exists(path) for path in self.Inputs)
+
+    def getInputsSize(self):
+        return sum(os.path.getsize(path) for path in self.Inputs if os.path.exists(path))
+
+    def getMemoryKey(self):
+        ## Tasks of the same stage and sample type have similar memory footprints
+        if not self.Plan: return self.Name
+        return '-'.join(str(self.Plan[name]) for name in ('stage', 'sample') if name in self.Plan)
+
+    def getCache(self):
+        if self.Sources is None or not self.Outputs: return None
+        return StageCache(self.Inputs, self.Outputs, sources = self.Sources, plan = self.Plan)
+
+    def run(self):
+        return self.Func(*self.Args, **self.Kwargs)
+
+
+def measure_read_bandwidth(path, *, n_bytes = 1 << 28, block_size = 1 << 24):
+    ## MB/s of reading a file not in the page cache, e.g. a big input tree on the volume
+    with open(path, 'rb') as file:
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        start_time = time.monotonic()
+        n_bytes_read = 0
+        while n_bytes_read < n_bytes:
+            block = file.read(block_size)
+            if not block: break
+            n_bytes_read += len(block)
+        return n_bytes_read / (1 << 20) / max(time.monotonic() - start_time, 1e-9)
+
+
+def get_volume_limits(volume_bandwidths, task_bandwidth):
+    ## Number of concurrent reading tasks saturating every volume: {path prefix: MB/s} -> {path prefix: n_tasks}
+    return {prefix: max(1, int(bandwidth // task_bandwidth)) for prefix, bandwidth in volume_bandwidths.items()}
+
+
+def run_task(task, is_forced = False, memory_limit = None, profile_dir = None, is_timed = False, profile_rate = None, metrics_path = None):
+    ## Module-level function so that it can be sent to worker processes, inputs are hashed there as well
+    ## Returns (is_cached, result, peak_memory)
+    set_low_memory_mode(task.IsLowMemory)
+    set_timing_mode(is_timed)
+    set_metrics_path(metrics_path)
+    cache = task.getCache()
+    if cache and cache.isUpToDate() and not is_forced: return True, cache.Record['result'], 0
+    ## Progress records of all analyses of the task, an attempt starts a new file
+    if metrics_path: open(metrics_path, 'w').close()
+    with MemoryGuard(memory_limit) as memory_guard:
+        if profile_dir and profile_rate:
+            ## Folded stacks for flame graphs in '<profile_dir>/<task name>.folded', summary of the analysis code in '.txt'
+            profiler = SamplingProfiler(rate = profile_rate)
+            try:
+                with profiler: result = task.run()
+            finally:
+                profiler.saveFolded(os.path.join(profile_dir, f"{task.Name}.folded"))
+                profiler.saveSummary(os.path.join(profile_dir, f"{task.Name}.txt"))
+        elif profile_dir:
+            ## Statistics of every task are kept in '<profile_dir>/<task name>.prof', e.g. for snakeviz
+            profile = cProfile.Profile()
+            try:
+                result = profile.runcall(task.run)
+            finally:
+                profile.dump_stats(os.path.join(profile_dir, f"{task.Name}.prof"))
+        else:
+            result = task.run()
+    if cache: cache.update(result)
+    return False, result, memory_guard.PeakMemory
+
+
+class Pipeline:
+    """
+    Runs a DAG of tasks linked by their input and output files
+    Every task is submitted as soon as the tasks producing its inputs are done and its inputs exist,
+    so workers stay busy across stage boundaries
+    Ready tasks are started by decreasing estimated cost (inputs size x cost factors along the chain of dependents),
+    so the biggest energy points do not form a tail. Failures of transient kinds are retried
+    volume_limits: {path prefix: n_tasks}, maximum number of I/O-bound tasks reading from a volume at the same time,
+    the remaining workers are given to CPU-bound tasks (e.g. kinfit) meanwhile
+    memory_budget: bytes of node memory, a task is admitted if memory predicted for it by MemoryHistory fits
+    next to the running ones. A task with known history going over memory_limit_factor x prediction
+    is restarted once in low-memory mode (histograms freed after every stage, smaller tree buffers), admitted
+    against the peak of its first attempt, which is added to the history; it fails if it goes over that peak again
+    """
+    ## Exceptions considered transient: crashed worker processes and file system hiccups of network volumes,
+    ## other OS errors (e.g. missing inputs or directories raised by the scripts) fail at once
+    TransientErrors = (BrokenProcessPool, WorkerCrashedError)
+    TransientErrnos = (errno.EIO, errno.ESTALE, errno.ETIMEDOUT, errno.ECONNRESET)
+
+    def __init__(
+            self, *,
+            max_workers = 10, is_forced = False, max_retries = 2, executor_factory = None, volume_limits = None,
+            memory_budget = None, memory_history = None, memory_limit_factor = 2.0, profile_dir = None, profile_rate = None,
+            is_timed = False, metrics_dir = None, report_path = None, logname = "pipeline", logpath = None, logmode = 'w'
+    ):
+        self.Tasks = OrderedDict() ## {name: task}
+        self.Producers = {} ## {output path: task}
+        self.MaxWorkers = max_workers
+        self.IsForced = is_forced ## rerunning tasks with up-to-date outputs
+        self.MaxRetries = max_retries
+        ## e.g. WorkerPool for long-lived workers with ROOT preloaded
+        self.ExecutorFactory = executor_factory if executor_factory else ProcessPoolExecutor
+        self.VolumeLimits = volume_limits if volume_limits else {}
+        self.MemoryBudget = memory_budget
+        self.MemoryHistory = memory_history if memory_history else MemoryHistory()
+        self.MemoryLimitFactor = memory_limit_factor
+        self.ProfileDir = profile_dir
+        self.ProfileRate = profile_rate ## Hz of SamplingProfiler, cProfile is used if not given
+        self.IsTimed = is_timed ## analysis loops log and save their timing, see Analysis.enableTiming
+        self.MetricsDir = metrics_dir ## progress records of analysis loops of every task in '<metrics_dir>/<task name>.metrics.jsonl'
+        self.ReportPath = report_path ## saved after every finished task, so that an interrupted run leaves its report
+
+        self.Logger = getLogger(logname)
+        self.Logger.setLevel(logging.INFO)
+        self.LogHandler = StreamHandler(sys.stdout) if logpath == None else FileHandler(logpath, logmode)
+        self.LogHandler.setFormatter(
+            Formatter(
+                fmt = "%(asctime)s: %(name)s: %(message)s",
+                datefmt = "%d.%m.%Y %H:%M:%S"
+            )
+        )
+        self.Logger.addHandler(self.LogHandler)
+
+
+    ## Operations with tasks
+    def addTask(self, task):
+        if task.Name in self.Tasks: raise ValueError(f"Task already exists: {task.Name}")
+        for path in task.Outputs:
+            if path in self.Producers: raise ValueError(f"Output '{path}' is produced by two tasks: '{self.Producers[path].Name}' and '{task.Name}'")
+        self.Tasks[task.Name] = task
+        self.Producers.update({path: task for path in task.Outputs})
+        return task
+
+    def linkTasks(self):
+        for task in self.Tasks.values():
+            task.Dependencies = list({
+                self.Producers[path].Name: self.Producers[path] for path in task.Inputs if path in self.Producers
+            }.values())
+            task.Dependents = []
+            task.PathCostFactor = None
+        for task in self.Tasks.values():
+            for dependency in task.Dependencies: dependency.Dependents.append(task)
+        for task in self.Tasks.values(): self.calculatePathCostFactor(task)
+
+    def calculatePathCostFactor(self, task):
+        if task.PathCostFactor is None:
+            task.PathCostFactor = task.CostFactor + max(
+                (self.calculatePathCostFactor(dependent) for dependent in task.Dependents), default = 0.
+            )
+        return task.PathCostFactor
+
+    def estimateCost(self, task):
+        return task.getInputsSize() * task.PathCostFactor
+
+    def selectTasks(self, task_names):
+        ## Only the given tasks are run, the other ones are expected to have their outputs in place
+        for name in task_names:
+            if name not in self.Tasks: raise ValueError(f"Task not found: {name}")
+        for task in self.Tasks.values():
+            if task.Name not in task_names: task.Status = 'excluded'
+
+    def getVolumes(self, task):
+        ## Volumes (the longest matching prefixes of volume_limits) the task reads from
+        if not task.IsIOBound: return set()
+        volumes = set()
+        for path in task.Inputs:
+            path = os.path.abspath(path)
+            prefixes = [prefix for prefix in self.VolumeLimits if path == prefix or path.startswith(prefix.rstrip('/') + '/')]
+            if prefixes: volumes.add(max(prefixes, key = len))
+        return volumes
+
+    def isVolumeAvailable(self, task, running):
+        volumes_load = {}
+        for running_task in running.values():
+            for volume in self.getVolumes(running_task): volumes_load[volume] = volumes_load.get(volume, 0) + 1
+        return all(volumes_load.get(volume, 0) < self.VolumeLimits[volume] for volume in self.getVolumes(task))
+
+    def predictMemory(self, task):
+        ## A restarted task needs at most the peak of its first attempt
+        if task.IsLowMemory: return task.PeakMemory
+        return self.MemoryHistory.predict(task.getMemoryKey())
+
+    def getMemoryLimit(self, task):
+        ## Without history the prediction is a guess, the task is only limited by the node budget
+        if task.IsLowMemory: return min(task.PeakMemory, self.MemoryBudget) if self.MemoryBudget else task.PeakMemory
+        key = task.getMemoryKey()
+        if not self.MemoryHistory.isKnown(key): return self.MemoryBudget
+        limit = int(self.MemoryHistory.predict(key) * self.MemoryLimitFactor)
+        return min(limit, self.MemoryBudget) if self.MemoryBudget else limit
+
+    def isMemoryAvailable(self, task, running):
+        if not self.MemoryBudget or not running: return True
+        memory_running = sum(self.predictMemory(running_task) for running_task in running.values())
+        return memory_running + self.predictMemory(task) <= self.MemoryBudget
+
+    def getMetricsPath(self, task):
+        return os.path.join(self.MetricsDir, f"{task.Name}.metrics.jsonl") if self.MetricsDir else None
+
+    def getTasks(self, status):
+        return [task for task in self.Tasks.values() if task.Status == status]
+
+    def isTaskReady(self, task):
+        return all(dependency.Status in ('done', 'excluded') for dependency in task.Dependencies) and task.areInputsAvailable()
+
+    def isTaskBlocked(self, task):
+        return any(dependency.Status in ('failed', 'skipped') for dependency in task.Dependencies)
+
+    ## Processing loop
+    def submitTasks(self, executor, running):
+        ready_tasks = []
+        for task in self.getTasks('pending'):
+            if self.isTaskBlocked(task):
+                task.Status = 'skipped'
+                self.Logger.info(f"Task '{task.Name}' skipped: its dependencies failed")
+            elif self.isTaskReady(task):
+                ready_tasks.append(task)
+
+        ## Only free workers get tasks, so that a task submitted later with a bigger cost is not queued behind smaller ones
+        ## Tasks reading from a saturated volume wait, cheaper tasks from other volumes or CPU-bound ones go first
+        ready_tasks.sort(key = self.estimateCost, reverse = True)
+        for task in ready_tasks:
+            if len(running) >= self.MaxWorkers: break
+            if not self.isVolumeAvailable(task, running): continue
+            if not self.isMemoryAvailable(task, running): continue
+            task.Status = 'running'
+            task.Attempts += 1
+            task.StartTime = time.monotonic()
+            running[executor.submit(
+                run_task, task, self.IsForced, self.getMemoryLimit(task), self.ProfileDir, self.IsTimed, self.ProfileRate, self.getMetricsPath(task)
+            )] = task
+            self.Logger.info(f"Task '{task.Name}' started" + (f", attempt {task.Attempts}" if task.Attempts > 1 else ""))
+
+    def collectTask(self, future, task):
+        task.WallTime += time.monotonic() - task.StartTime
+        try:
+            task.IsCached, task.Result, task.PeakMemory = future.result()
+            task.Status = 'done'
+            task.Error = None
+            ## Peaks of the low-memory mode do not predict the usual runs
+            if not task.IsCached and not task.IsLowMemory: self.MemoryHistory.add(task.getMemoryKey(), task.PeakMemory)
+            self.Logger.info(f"Task '{task.Name}' is up to date" if task.IsCached else f"Task '{task.Name}' finished, peak memory {task.PeakMemory >> 20} MB")
+        except Exception as error:
+            task.Error = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+            if isinstance(error, MemoryLimitExceededError) and not task.IsLowMemory:
+                ## Peak is added to the history, so that the next runs are admitted with enough memory
+                task.IsLowMemory = True
+                task.Status = 'pending'
+                task.PeakMemory = error.PeakMemory
+                self.MemoryHistory.add(task.getMemoryKey(), error.PeakMemory)
+                self.Logger.info(f"Task '{task.Name}' failed: {error!r}, restarting in low-memory mode")
+            elif isinstance(error, MemoryLimitExceededError):
+                task.Status = 'failed'
+                task.PeakMemory = max(task.PeakMemory, error.PeakMemory)
+                self.Logger.info(f"Task '{task.Name}' failed in low-memory mode: {error!r}")
+            elif Pipeline.isTransientError(error) and task.Attempts <= self.MaxRetries:
+                task.Status = 'pending'
+                self.Logger.info(f"Task '{task.Name}' failed: {error!r}, retrying")
+            else:
+                task.Status = 'failed'
+                self.Logger.info(f"Task '{task.Name}' failed: {error!r}")
+
+    @staticmethod
+    def isTransientError(error):
+        if isinstance(error, Pipeline.TransientErrors): return True
+        return isinstance(error, OSError) and error.errno in Pipeline.TransientErrnos
+
+    def isTaskOutdated(self, task, outdated):
+        ## A task is run if its record does not match or a task producing its inputs is run
+        ## Inputs not produced yet are not hashed
+        if task.Name not in outdated:
+            cache = task.getCache()
+            outdated[task.Name] = (
+                any([self.isTaskOutdated(dependency, outdated) for dependency in task.Dependencies if dependency.Status != 'excluded']) or
+                self.IsForced or not cache or not task.areInputsAvailable() or not cache.isUpToDate()
+            )
+        return outdated[task.Name]
+
+    def plan(self, task_names = None):
+        ## Dry run: {name: is_outdated} of the tasks that would be run, nothing is executed
+        self.linkTasks()
+        if task_names is not None: self.selectTasks(task_names)
+        outdated = {}
+        tasks = [task for task in self.Tasks.values() if task.Status != 'excluded']
+        for task in tasks:
+            self.isTaskOutdated(task, outdated)
+            self.Logger.info(f"{task.Name:<60} {'to run' if outdated[task.Name] else 'up to date'}")
+        self.Logger.info(f"Dry run: {sum(outdated[task.Name] for task in tasks)} of {len(tasks)} tasks to run")
+        return {task.Name: outdated[task.Name] for task in tasks}
+
+    def run(self, task_names = None):
+        self.linkTasks()
+        if task_names is not None: self.selectTasks(task_names)
+        running = {} ## {future: task}
+        executor = self.ExecutorFactory(max_workers = self.MaxWorkers)
+        try:
+            while True:
+                self.submitTasks(executor, running)
+                if not running: break
+                done, _ = wait(running, return_when = FIRST_COMPLETED)
+                for future in done: self.collectTask(future, running.pop(future))
+                if self.ReportPath: self.saveReport(self.ReportPath)
+
+                ## A crashed worker breaks the whole pool: tasks still running in it are resubmitted to a new one
+                if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                    self.Logger.info("Worker process crashed, restarting worker pool")
+                    for future, task in list(running.items()):
+                        future.cancel()
+                        task.Status = 'pending'
+                        task.Attempts -= 1
+                    running = {}
+                    executor.shutdown(wait = False)
+                    executor = self.ExecutorFactory(max_workers = self.MaxWorkers)
+        finally:
+            executor.shutdown()
+            if self.ReportPath: self.saveReport(self.ReportPath)
+
+        ## Tasks left pending wait for inputs that no task produces
+        for task in self.getTasks('pending'):
+            task.Status = 'skipped'
+            missing_inputs = [path for path in task.Inputs if not os.path.exists(path)]
+            self.Logger.info(f"Task '{task.Name}' skipped: inputs do not exist: {missing_inputs}")
+
+        self.MemoryHistory.save()
+        if self.ReportPath: self.saveReport(self.ReportPath)
+        self.logReport()
+        return {name: task.Result for name, task in self.Tasks.items() if task.Status == 'done'}
+
+    ## Operations with reports
+    def getReport(self):
+        return OrderedDict(
+            (task.Name, {
+                'status': task.Status,
+                'is-cached': task.IsCached,
+                'attempts': task.Attempts,
+                'wall-time': round(task.WallTime, 3),
+                'peak-memory': task.PeakMemory,
+                'is-low-memory': task.IsLowMemory,
+                'error': task.Error,
+            })
+            for task in self.Tasks.values() if task.Status != 'excluded'
+        )
+
+    def logReport(self):
+        report = self.getReport()
+        self.Logger.info(f"{'Task':<60} {'Status':<8} {'Attempts':>8} {'Wall time, s':>12} {'Peak memory, MB':>15}")
+        for name, task_report in report.items():
+            self.Logger.info(
+                f"{name:<60} {task_report['status']:<8} {task_report['attempts']:>8} "
+                f"{task_report['wall-time']:>12.1f} {task_report['peak-memory'] >> 20:>15}"
+            )
+        for name, task_report in report.items():
+            if task_report['status'] == 'failed': self.Logger.info(f"Task '{name}' traceback:\n{task_report['error']}")
+        self.Logger.info(
+            f"Pipeline finished. {len(self.getTasks('done'))} tasks done "
+            f"({len([task for task in self.getTasks('done') if task.IsCached])} up to date), "
+            f"{len(self.getTasks('failed'))} failed, {len(self.getTasks('skipped'))} skipped"
+        )
+
+    def saveReport(self, path):
+        ## Merged with the report of the previous run, so that tasks excluded from this one keep their status
+        ## Written atomically, a run killed while saving leaves the previous report
+        report = OrderedDict()
+        if os.path.exists(path):
+            with open(path, 'r') as file_report:
+                report.update(json.load(file_report))
+        report.update(self.getReport())
+        path_tmp = f"{path}.tmp"
+        with open(path_tmp, 'w') as file_report:
+            json.dump(report, file_report, indent = 2)
+        os.replace(path_tmp, path)
+
+    @staticmethod
+    def loadReportTasks(path, statuses):
+        with open(path, 'r') as file_report:
+            report = json.load(file_report)
+        return [name for name, task_report in report.items() if task_report['status'] in statuses]
+
+    @staticmethod
+    def loadFailedTasks(path):
+        ## Names of the tasks to rerun: failed ones and the ones skipped because of them
+        return Pipeline.loadReportTasks(path, ('failed', 'skipped'))
+
+    def close(self):
+        self.Logger.removeHandler(self.LogHandler)
+        self.LogHandler.close()
+        del self.Logger
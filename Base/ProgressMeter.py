@@ -0,0 +1,76 @@
+from time import perf_counter, time
+
+import json
+
+from ROOT import TFile
+
+## Set in a worker process for tasks run with metrics, see Analysis.__init__
+MetricsPath = None
+
+def set_metrics_path(path):
+    global MetricsPath
+    MetricsPath = path
+
+
+def get_metrics_path():
+    return MetricsPath
+
+
+class ProgressMeter:
+    """
+    Progress of a loop over entries: scanned and selected entries, events/s, MB/s read from ROOT files and ETA
+    Records are logged every interval seconds and appended as JSON lines to the metrics file, if given,
+    so that an external watcher can tail it
+    """
+    def __init__(self, stage_name, n_entries, *, logger = None, interval = 60., metrics_path = None):
+        self.StageName = stage_name
+        self.NEntries = n_entries
+        self.Logger = logger
+        self.Interval = interval
+        self.MetricsPath = metrics_path
+
+        self.StartTime = perf_counter()
+        self.ReportTime = self.StartTime
+        self.BytesReadStart = TFile.GetFileBytesRead()
+
+    def isDue(self):
+        return perf_counter() - self.ReportTime >= self.Interval
+
+    def getRecord(self, n_scanned, n_selected, *, is_final = False):
+        wall_time = perf_counter() - self.StartTime
+        bytes_read = TFile.GetFileBytesRead() - self.BytesReadStart
+        return {
+            'time': time(),
+            'stage': self.StageName,
+            'entries': self.NEntries,
+            'entries-scanned': n_scanned,
+            'entries-selected': n_selected,
+            'wall-time': wall_time,
+            'bytes-read': bytes_read,
+            'events-per-second': n_scanned / wall_time if wall_time > 0 else 0.,
+            'mb-per-second': bytes_read / (1 << 20) / wall_time if wall_time > 0 else 0.,
+            'eta': wall_time / n_scanned * (self.NEntries - n_scanned) if n_scanned else None,
+            'is-final': is_final,
+        }
+
+    def writeRecord(self, record):
+        if not self.MetricsPath: return
+        with open(self.MetricsPath, 'a') as file_metrics:
+            file_metrics.write(json.dumps(record) + '\n')
+
+    def report(self, n_scanned, n_selected):
+        self.ReportTime = perf_counter()
+        record = self.getRecord(n_scanned, n_selected)
+        if self.Logger:
+            eta = f"{record['eta']:.0f} s" if record['eta'] is not None else '?'
+            self.Logger.info(
+                f"'{self.StageName}': {n_scanned} / {self.NEntries} entries scanned ({n_scanned / self.NEntries:.1%}), "
+                f"{n_selected} selected, {record['events-per-second']:.0f} events/s, {record['mb-per-second']:.1f} MB/s, ETA {eta}"
+            )
+        self.writeRecord(record)
+        return record
+
+    def finish(self, n_selected):
+        record = self.getRecord(self.NEntries, n_selected, is_final = True)
+        self.writeRecord(record)
+        return record
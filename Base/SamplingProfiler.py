@@ -0,0 +1,115 @@
+from collections import Counter
+from time import perf_counter
+
+import os
+import sys
+import threading
+
+## Root of the repository, frames of its files are labelled by their relative paths
+RootDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class SamplingProfiler:
+    """
+    Samples the Python stack of a thread (the calling one by default) rate times per second from a background thread
+    Stacks are kept folded ('frame;frame;frame n_samples', root first) as flame-graph tools (flamegraph.pl, speedscope, inferno) read them
+    PyROOT calls hold the GIL, so a sample falling into a C++ call (e.g. TTree::GetEntry) is taken right after it returns,
+    at its Python call site; every sample is weighted by the time elapsed since the previous one to keep the totals right
+    Samples are also aggregated by the functions and call sites of the analysis code (FocusPaths): a sample counts
+    for the deepest frame of these files, together with the ROOT and library calls made from it
+    """
+    FocusPaths = ('Base/Analysis.py', 'Base/Variable.py', 'Analyses/')
+
+    def __init__(self, *, rate = 100., thread_id = None):
+        self.Rate = rate
+        self.ThreadId = thread_id
+        self.Stacks = Counter() ## {folded stack: n_samples}
+        self.Functions = Counter() ## {focus function: n_samples}
+        self.FunctionsTotal = Counter() ## {focus function: n_samples with the function anywhere in the stack}
+        self.CallSites = Counter() ## {focus file:line: n_samples}
+        self.NSamples = 0
+        self.WallTime = 0.
+        self.Thread = None
+        self.StopEvent = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def start(self):
+        if self.ThreadId is None: self.ThreadId = threading.get_ident()
+        self.StopEvent.clear()
+        self.Thread = threading.Thread(target = self.sampleLoop, name = "sampling-profiler", daemon = True)
+        self.Thread.start()
+
+    def stop(self):
+        if not self.Thread: return
+        self.StopEvent.set()
+        self.Thread.join()
+        self.Thread = None
+
+    def sampleLoop(self):
+        start_time = perf_counter()
+        sample_time = start_time
+        while not self.StopEvent.wait(1. / self.Rate):
+            time = perf_counter()
+            self.sample(max(1, round((time - sample_time) * self.Rate)))
+            sample_time = time
+        self.WallTime += perf_counter() - start_time
+
+    @staticmethod
+    def getPath(frame):
+        path = os.path.abspath(frame.f_code.co_filename)
+        return os.path.relpath(path, RootDir) if path.startswith(RootDir + os.sep) else os.path.basename(path)
+
+    @staticmethod
+    def isFocused(path):
+        ## Directories end with '/'
+        return any(path.startswith(focus_path) if focus_path.endswith('/') else path == focus_path for focus_path in SamplingProfiler.FocusPaths)
+
+    def sample(self, weight = 1):
+        frame = sys._current_frames().get(self.ThreadId)
+        if frame is None: return
+        labels = []
+        focus_labels = []
+        call_site = None
+        while frame is not None:
+            path = SamplingProfiler.getPath(frame)
+            label = f"{path}:{frame.f_code.co_qualname}"
+            labels.append(label)
+            if SamplingProfiler.isFocused(path):
+                if call_site is None: call_site = f"{path}:{frame.f_lineno}"
+                focus_labels.append(label)
+            frame = frame.f_back
+        self.Stacks[';'.join(reversed(labels))] += weight
+        if focus_labels:
+            self.Functions[focus_labels[0]] += weight
+            self.CallSites[call_site] += weight
+            for label in set(focus_labels): self.FunctionsTotal[label] += weight
+        self.NSamples += weight
+
+    def formSummary(self, n_lines = 20):
+        ## Lines of the table of the focus functions and call sites taking most samples
+        n_samples = max(self.NSamples, 1)
+        lines = [
+            f"{self.NSamples} samples at {self.Rate:.0f} Hz, wall time {self.WallTime:.1f} s",
+            f"{'Function':<60} {'Self':>7} {'Total':>7}"
+        ]
+        for label, n_self in self.Functions.most_common(n_lines):
+            lines.append(f"{label:<60} {n_self / n_samples:>7.1%} {self.FunctionsTotal[label] / n_samples:>7.1%}")
+        lines.append(f"{'Call site':<60} {'Self':>7}")
+        for call_site, n_self in self.CallSites.most_common(n_lines):
+            lines.append(f"{call_site:<60} {n_self / n_samples:>7.1%}")
+        return lines
+
+    def saveFolded(self, path):
+        with open(path, 'w') as file_folded:
+            for stack, n_samples in self.Stacks.most_common():
+                file_folded.write(f"{stack} {n_samples}\n")
+
+    def saveSummary(self, path):
+        with open(path, 'w') as file_summary:
+            file_summary.write('\n'.join(self.formSummary()) + '\n')
@@ -0,0 +1,95 @@
+import json
+import hashlib
+
+import os
+from importlib.util import find_spec
+
+def hash_file(path, *, block_size = 1 << 24):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_file_identity(path, identity_prev = None):
+    ## {'size', 'mtime', 'hash'} of a file, hash is recalculated only if the size or modification time differ from identity_prev
+    stat = os.stat(path)
+    if identity_prev and identity_prev['size'] == stat.st_size and identity_prev['mtime'] == stat.st_mtime_ns:
+        return identity_prev
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': hash_file(path)}
+
+
+def hash_source(source):
+    ## Source is either a file (e.g. C++ header) or a module name, the module is not imported
+    if os.path.isfile(source): return hash_file(source)
+    spec = find_spec(source)
+    if not spec or not spec.origin or not os.path.exists(spec.origin): raise ImportError(f"Module source not found: {source}")
+    return hash_file(spec.origin)
+
+
+## Modules every stage depends on
+BASE_SOURCES = ["Base.Analysis", "Base.Container", "Base.Variable", "Base.PhysicalConstants"]
+
+
+class StageCache:
+    """
+    Record of a stage output: hashes of its input files, of the modules defining the stage
+    (script with cuts and histograms lists, analysis class with thresholds, base classes) and of the stage plan
+    A stage is up to date if its outputs exist and all the hashes match the record, like make but content-based
+    The record is kept next to the first output: '<output>.stage.json'
+    """
+    def __init__(self, inputs, outputs, *, sources = (), plan = None):
+        self.Inputs = list(inputs)
+        self.Outputs = list(outputs)
+        self.Sources = list(sources)
+        self.Plan = json.loads(json.dumps(plan)) ## the same form as after loading from the record
+        self.Record = None
+
+    def getRecordPath(self):
+        return f"{self.Outputs[0]}.stage.json"
+
+    def loadRecord(self):
+        if not os.path.exists(self.getRecordPath()): return None
+        with open(self.getRecordPath(), 'r') as file_record:
+            return json.load(file_record)
+
+    def hashInput(self, path, input_record = None):
+        ## Hash is recalculated only if the file size or modification time changed since the record
+        return get_file_identity(path, input_record)
+
+    def createRecord(self, record_prev = None):
+        inputs_prev = record_prev['inputs'] if record_prev else {}
+        return {
+            'inputs': {path: self.hashInput(path, inputs_prev.get(path)) for path in self.Inputs},
+            'sources': {source: hash_source(source) for source in self.Sources},
+            'plan': self.Plan,
+            'result': None,
+        }
+
+    def isUpToDate(self):
+        ## Inputs are hashed before the stage runs, so the record describes the inputs it used
+        record_prev = self.loadRecord()
+        self.Record = self.createRecord(record_prev)
+        if not record_prev or not all(os.path.exists(path) for path in self.Outputs): return False
+
+        is_up_to_date = (
+            {path: input_record['hash'] for path, input_record in self.Record['inputs'].items()} ==
+            {path: input_record['hash'] for path, input_record in record_prev['inputs'].items()} and
+            self.Record['sources'] == record_prev['sources'] and
+            self.Record['plan'] == record_prev['plan']
+        )
+        self.Record['result'] = record_prev['result']
+        ## Keeping the refreshed sizes and modification times of inputs with unchanged content
+        if is_up_to_date: self.saveRecord()
+        return is_up_to_date
+
+    def saveRecord(self):
+        with open(self.getRecordPath(), 'w') as file_record:
+            json.dump(self.Record, file_record, indent = 2)
+
+    def update(self, result = None):
+        ## Called after the stage produced its outputs
+        if not self.Record: self.Record = self.createRecord(self.loadRecord())
+        self.Record['result'] = result
+        self.saveRecord()
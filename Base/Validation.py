@@ -0,0 +1,147 @@
+from math import isclose, isnan
+
+import os
+
+def get_bin_contents(hist):
+    return [hist.GetBinContent(n_bin) for n_bin in range(hist.GetNcells())]
+
+
+"""
+Differential validation of analysis engines: an optimized engine (e.g. a subclass of an analysis with vectorized
+TriggerVariable functions or cut lambdas, or a batch engine) must reproduce the results of the per-entry Analysis.loop
+An engine is a function (input_path, spec, work_dir) -> results:
+spec: {'cuts': [cut name, ...], 'values': [variable name, ...], 'histograms': [histogram name, ...]}
+results: {
+    'keys': [(runnum, evnum), ...] of all input entries,
+    'selection': [is_selected, ...] of all input entries,
+    'values': {variable name: {n_entry: value}} of the selected entries,
+    'histograms': {histogram name: [bin content, ...]} including underflow and overflow bins,
+}
+"""
+def run_analysis(analysis_class, input_path, spec, work_dir):
+    ## Reference engine: one pass of Analysis.loop with the cuts and histograms of spec, then values of the selected entries
+    name = analysis_class.__name__
+    analysis = analysis_class(input_path, analysis_path = f"{work_dir}/{name}_hists.root", log_path = f"{work_dir}/{name}.log")
+    for cut_name in spec.get('cuts', []): analysis.addCut(cut_name)
+    for hist_name in spec.get('histograms', []): analysis.addHistogram(hist_name)
+    hists = dict(analysis.getHistogramsCurrent())
+    analysis.loop(directory_name = 'validation')
+
+    results = {
+        'keys': [],
+        'selection': [],
+        'values': {variable_name: {} for variable_name in spec.get('values', [])},
+        'histograms': {hist_name: get_bin_contents(hist[0]) for hist_name, hist in hists.items()},
+    }
+    for n_entry in range(analysis.getEntries()):
+        analysis.getEntry(n_entry)
+        is_selected = analysis.CutDispatcher.checkEntryInChecklist(n_entry)
+        results['keys'].append((analysis.Variables["runnum"].Content, analysis.Variables["evnum"].Content))
+        results['selection'].append(is_selected)
+        if not is_selected: continue
+        for variable_name, values in results['values'].items():
+            values[n_entry] = analysis.Variables[variable_name].Content
+    analysis.close()
+    return results
+
+
+def get_analysis_engine(analysis_class):
+    return lambda input_path, spec, work_dir: run_analysis(analysis_class, input_path, spec, work_dir)
+
+
+def is_value_close(reference, candidate, *, rel_tol, abs_tol):
+    ## Values are numbers or nested lists of numbers (array variables)
+    if isinstance(reference, (list, tuple)) or isinstance(candidate, (list, tuple)):
+        if not isinstance(reference, (list, tuple)) or not isinstance(candidate, (list, tuple)) or len(reference) != len(candidate): return False
+        return all(is_value_close(a, b, rel_tol = rel_tol, abs_tol = abs_tol) for a, b in zip(reference, candidate))
+    if isinstance(reference, float) and isinstance(candidate, float) and isnan(reference) and isnan(candidate): return True
+    return isclose(reference, candidate, rel_tol = rel_tol, abs_tol = abs_tol)
+
+
+class ValidationReport:
+    """
+    Differences of a candidate engine from the reference one: the first differing entry (by runnum, evnum)
+    of the selection and of every value, and the first differing bin of every histogram, with the numbers of differences
+    tolerances: {variable or histogram name: (rel_tol, abs_tol)}, default_tolerance for the others
+    """
+    def __init__(self, reference, candidate, *, tolerances = None, default_tolerance = (1e-6, 1e-9)):
+        self.Tolerances = tolerances if tolerances else {}
+        self.DefaultTolerance = default_tolerance
+        self.Differences = [] ## [{'kind': ..., 'name': ..., 'count': ..., 'first': {...}}, ...]
+        self.compare(reference, candidate)
+
+    def getTolerance(self, name):
+        rel_tol, abs_tol = self.Tolerances.get(name, self.DefaultTolerance)
+        return {'rel_tol': rel_tol, 'abs_tol': abs_tol}
+
+    def addDifference(self, kind, name, count, first):
+        if count: self.Differences.append({'kind': kind, 'name': name, 'count': count, 'first': first})
+
+    def compare(self, reference, candidate):
+        keys = reference['keys']
+        if keys != candidate['keys']:
+            n_entry = next((n for n, (a, b) in enumerate(zip(keys, candidate['keys'])) if a != b), min(len(keys), len(candidate['keys'])))
+            self.addDifference('keys', 'entries', 1, {
+                'entry': n_entry,
+                'reference': keys[n_entry] if n_entry < len(keys) else 'no entry',
+                'candidate': candidate['keys'][n_entry] if n_entry < len(candidate['keys']) else 'no entry',
+            })
+            return
+
+        differing = [n_entry for n_entry, (a, b) in enumerate(zip(reference['selection'], candidate['selection'])) if a != b]
+        self.addDifference('selection', 'entries', len(differing), differing and {
+            'key': keys[differing[0]], 'reference': reference['selection'][differing[0]], 'candidate': candidate['selection'][differing[0]],
+        })
+
+        for name, reference_values in reference['values'].items():
+            candidate_values = candidate['values'].get(name)
+            if candidate_values is None:
+                self.addDifference('value', name, 1, {'reference': 'present', 'candidate': 'missing'})
+                continue
+            ## Only entries selected by both engines are compared, the others are counted by the selection
+            differing = [
+                n_entry for n_entry in sorted(reference_values) if n_entry in candidate_values and
+                not is_value_close(reference_values[n_entry], candidate_values[n_entry], **self.getTolerance(name))
+            ]
+            self.addDifference('value', name, len(differing), differing and {
+                'key': keys[differing[0]], 'reference': reference_values[differing[0]], 'candidate': candidate_values[differing[0]],
+            })
+
+        for name, reference_bins in reference['histograms'].items():
+            candidate_bins = candidate['histograms'].get(name)
+            if candidate_bins is None or len(candidate_bins) != len(reference_bins):
+                self.addDifference('histogram', name, 1, {'reference': len(reference_bins), 'candidate': len(candidate_bins) if candidate_bins else 'missing'})
+                continue
+            differing = [n_bin for n_bin, (a, b) in enumerate(zip(reference_bins, candidate_bins)) if not is_value_close(a, b, **self.getTolerance(name))]
+            self.addDifference('histogram', name, len(differing), differing and {
+                'bin': differing[0], 'reference': reference_bins[differing[0]], 'candidate': candidate_bins[differing[0]],
+            })
+
+    def isEqual(self):
+        return not self.Differences
+
+    def formLines(self):
+        if self.isEqual(): return ["Candidate reproduces the reference"]
+        lines = []
+        for difference in self.Differences:
+            first = difference['first']
+            where = (
+                f"first at (runnum, evnum) = {first['key']}: " if 'key' in first else
+                f"first at bin {first['bin']}: " if 'bin' in first else
+                f"first at entry {first['entry']}: " if 'entry' in first else ""
+            )
+            lines.append(
+                f"{difference['kind']} '{difference['name']}': {difference['count']} differences, {where}"
+                f"reference {first['reference']}, candidate {first['candidate']}"
+            )
+        return lines
+
+
+def validate(reference_engine, candidate_engine, input_path, spec, work_dir, **kwargs):
+    ## Runs both engines on the same input in their own directories and compares the results
+    results = []
+    for name, engine in (('reference', reference_engine), ('candidate', candidate_engine)):
+        engine_dir = f"{work_dir}/{name}"
+        os.makedirs(engine_dir, exist_ok = True)
+        results.append(engine(input_path, spec, engine_dir))
+    return ValidationReport(*results, **kwargs)
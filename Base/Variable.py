@@ -125,7 +125,8 @@ class Variable:
                 deep_size //= size
                 deep_size *= max_size
                 
-            self._Content = array(self.Typecode, main_array)
+            ## writing in place so that the buffer bound to a TTree branch stays valid
+            self._Content[:] = array(self.Typecode, main_array)
         
     Content = property(getContent, setContent)
         
@@ -0,0 +1,316 @@
+from concurrent.futures import Executor, Future
+from concurrent.futures.process import _ExceptionWithTraceback
+
+import threading
+import itertools
+import pickle
+import socket
+import time
+import uuid
+import os
+
+from .WorkerPool import WorkerPool, WorkerCrashedError, try_warm_up, get_headers, is_picklable
+
+class WorkQueue:
+    """
+    Queue of tasks in a directory on a file system shared by several hosts, no external service is needed
+    A task is a pickled (func, args, kwargs) file moved between subdirectories by atomic renames:
+    pending/<task id> -> running/<task id>@<worker id> -> results/<task id>
+    Every worker updates its heartbeat file, tasks of a worker whose heartbeat stopped are reclaimed as crashed
+    Every submitter (WorkQueueExecutor) updates its heartbeat file as well, task ids start with its id:
+    pending tasks and results of a dead submitter are removed, so that they are neither run nor kept forever
+    """
+    Subdirectories = ('pending', 'running', 'results', 'heartbeats', 'executors')
+
+    def __init__(self, path, *, heartbeat_timeout = 60.):
+        self.Path = path
+        self.HeartbeatTimeout = heartbeat_timeout
+        ## {(subdirectory, worker or executor id): (heartbeat, local time it was seen)}: clocks of the hosts are never compared
+        self.Heartbeats = {}
+        for subdirectory in WorkQueue.Subdirectories:
+            os.makedirs(self.getPath(subdirectory), exist_ok = True)
+
+    def getPath(self, subdirectory, name = None):
+        return os.path.join(self.Path, subdirectory) if name is None else os.path.join(self.Path, subdirectory, name)
+
+    def listFiles(self, subdirectory):
+        ## Files being written are hidden until they are renamed into place
+        return sorted(name for name in os.listdir(self.getPath(subdirectory)) if not name.startswith('.'))
+
+    def writeFile(self, subdirectory, name, obj):
+        tmp_path = self.getPath(subdirectory, f".{name}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(obj, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.getPath(subdirectory, name))
+
+    ## Submitter side
+    def put(self, task_id, func, args = (), kwargs = None):
+        self.writeFile('pending', task_id, (func, args, kwargs if kwargs else {}))
+
+    def cancel(self, task_id):
+        ## Only a task not claimed yet can be cancelled
+        try:
+            os.remove(self.getPath('pending', task_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def getResults(self):
+        return self.listFiles('results')
+
+    def beatExecutor(self, executor_id, heartbeat):
+        ## Host and process are recorded, so that a submitter restarted on the same host sees a killed one at once
+        self.writeFile('executors', executor_id, (socket.gethostname(), os.getpid(), heartbeat))
+
+    def removeExecutor(self, executor_id):
+        self.removeFile('executors', executor_id)
+
+    def popResult(self, task_id):
+        ## Returns (status, value)
+        path = self.getPath('results', task_id)
+        with open(path, 'rb') as file_result:
+            result = pickle.load(file_result)
+        os.remove(path)
+        return result
+
+    ## Worker side
+    def claim(self, worker_id):
+        ## Rename succeeds for one worker only, the others move on to the next task
+        for task_id in self.listFiles('pending'):
+            if not self.isExecutorAlive(get_executor_id(task_id)):
+                self.removeFile('pending', task_id)
+                continue
+            running_path = self.getPath('running', f"{task_id}@{worker_id}")
+            try:
+                os.rename(self.getPath('pending', task_id), running_path)
+            except FileNotFoundError:
+                continue
+            with open(running_path, 'rb') as file_task:
+                return task_id, pickle.load(file_task)
+        return None
+
+    def putResult(self, task_id, worker_id, status, value):
+        self.writeFile('results', task_id, (status, value))
+        try:
+            os.remove(self.getPath('running', f"{task_id}@{worker_id}"))
+        except FileNotFoundError:
+            ## The task was reclaimed meanwhile, the submitter drops the late result
+            pass
+
+    def beat(self, worker_id, heartbeat):
+        self.writeFile('heartbeats', worker_id, heartbeat)
+
+    def removeWorker(self, worker_id):
+        self.removeFile('heartbeats', worker_id)
+
+    ## Done by workers and by the submitter
+    def removeFile(self, subdirectory, name):
+        try:
+            os.remove(self.getPath(subdirectory, name))
+        except FileNotFoundError:
+            pass
+
+    def readHeartbeat(self, subdirectory, name):
+        ## FileNotFoundError without heartbeat file, None while it is being replaced
+        try:
+            with open(self.getPath(subdirectory, name), 'rb') as file_heartbeat:
+                return pickle.load(file_heartbeat)
+        except (EOFError, pickle.UnpicklingError):
+            return None
+
+    def isBeating(self, subdirectory, name, heartbeat):
+        now = time.monotonic()
+        heartbeat_prev, seen_time = self.Heartbeats.get((subdirectory, name), (None, now))
+        if heartbeat != heartbeat_prev: self.Heartbeats[(subdirectory, name)] = (heartbeat, now)
+        return heartbeat != heartbeat_prev or now - seen_time < self.HeartbeatTimeout
+
+    def isWorkerAlive(self, worker_id):
+        try:
+            heartbeat = self.readHeartbeat('heartbeats', worker_id)
+        except FileNotFoundError:
+            return False
+        return heartbeat is None or self.isBeating('heartbeats', worker_id, heartbeat)
+
+    def isExecutorAlive(self, executor_id):
+        try:
+            heartbeat = self.readHeartbeat('executors', executor_id)
+        except FileNotFoundError:
+            return False
+        if heartbeat is None: return True
+        host, pid, _ = heartbeat
+        if host == socket.gethostname() and not is_process_alive(pid): return False
+        return self.isBeating('executors', executor_id, heartbeat)
+
+    def reclaim(self):
+        ## Tasks of dead workers fail with WorkerCrashedError, the pipeline retries them
+        reclaimed = []
+        for name in self.listFiles('running'):
+            task_id, worker_id = name.split('@', 1)
+            if self.isWorkerAlive(worker_id): continue
+            reclaimed_path = self.getPath('running', f".{name}.reclaimed")
+            try:
+                os.rename(self.getPath('running', name), reclaimed_path)
+            except FileNotFoundError:
+                continue
+            self.writeFile('results', task_id, ('error', WorkerCrashedError(f"Worker {worker_id} stopped sending heartbeats")))
+            os.remove(reclaimed_path)
+            reclaimed.append(task_id)
+        for worker_id in self.listFiles('heartbeats'):
+            if not self.isWorkerAlive(worker_id): self.removeWorker(worker_id)
+        return reclaimed
+
+    def purge(self):
+        ## Pending tasks and results of dead submitters: nobody collects them, and a restarted submitter submits its tasks again
+        ## Returns ids of the removed tasks
+        executors_alive = {}
+        purged = []
+        for subdirectory in ('pending', 'results'):
+            for task_id in self.listFiles(subdirectory):
+                executor_id = get_executor_id(task_id)
+                if executor_id not in executors_alive: executors_alive[executor_id] = self.isExecutorAlive(executor_id)
+                if executors_alive[executor_id]: continue
+                self.removeFile(subdirectory, task_id)
+                purged.append(task_id)
+        for executor_id in self.listFiles('executors'):
+            if executor_id not in executors_alive: executors_alive[executor_id] = self.isExecutorAlive(executor_id)
+            if not executors_alive[executor_id]: self.removeExecutor(executor_id)
+        return purged
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def get_executor_id(task_id):
+    ## '<executor id>-<number>'
+    return task_id.split('-', 1)[0]
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def run_worker(queue_path, *, heartbeat_interval = 10., heartbeat_timeout = 60., poll_interval = 1., idle_timeout = None, is_warmed_up = True):
+    ## Worker process: takes tasks from the queue until no task comes for idle_timeout seconds or it is killed
+    ## The pipeline submits tasks of the next stages only when their inputs are ready, so the queue may be empty for a while
+    queue = WorkQueue(queue_path, heartbeat_timeout = heartbeat_timeout)
+    worker_id = get_worker_id()
+    heartbeats = itertools.count()
+    queue.beat(worker_id, next(heartbeats))
+
+    stop_event = threading.Event()
+    def send_heartbeats():
+        while not stop_event.wait(heartbeat_interval):
+            queue.beat(worker_id, next(heartbeats))
+    heartbeat_thread = threading.Thread(target = send_heartbeats, daemon = True)
+    heartbeat_thread.start()
+
+    if is_warmed_up: try_warm_up(WorkerPool.Modules, get_headers())
+
+    try:
+        idle_start = time.monotonic()
+        while True:
+            queue.reclaim()
+            queue.purge()
+            item = queue.claim(worker_id)
+            if item is None:
+                if idle_timeout is not None and time.monotonic() - idle_start > idle_timeout: break
+                time.sleep(poll_interval)
+                continue
+
+            task_id, (func, args, kwargs) = item
+            try:
+                result = ('done', func(*args, **kwargs))
+                pickle.dumps(result)
+            except BaseException as error:
+                ## Exception is sent with its traceback, like in ProcessPoolExecutor
+                error = error if is_picklable(error) else RuntimeError(repr(error))
+                result = ('error', _ExceptionWithTraceback(error, error.__traceback__))
+            queue.putResult(task_id, worker_id, *result)
+            idle_start = time.monotonic()
+    finally:
+        stop_event.set()
+        heartbeat_thread.join()
+        queue.removeWorker(worker_id)
+
+
+class WorkQueueExecutor(Executor):
+    """
+    Executor submitting tasks to a WorkQueue served by workers on several hosts (see Scripts/pipeline_worker.py)
+    max_workers is not used: the pipeline max_workers should be the total number of workers
+    Results are collected by polling, tasks of dead workers are reclaimed by the submitter as well
+    The executor sends heartbeats while it runs; on start pending tasks and results of killed submitters are removed,
+    so that tasks of a previous run are not run next to their resubmitted copies
+    """
+    def __init__(self, queue_path, max_workers = None, *, poll_interval = 1., heartbeat_interval = 10., heartbeat_timeout = 60.):
+        self.Queue = WorkQueue(queue_path, heartbeat_timeout = heartbeat_timeout)
+        self.PollInterval = poll_interval
+        self.HeartbeatInterval = heartbeat_interval
+        self.ExecutorId = uuid.uuid4().hex[:8] ## prefix of task ids of this executor
+        self.Heartbeats = itertools.count()
+        self.beat()
+        self.Queue.purge()
+        self.TaskIds = itertools.count()
+        self.Futures = {} ## {task_id: future}
+        self.Lock = threading.Lock()
+        self.IsShutdown = False
+        self.StopEvent = threading.Event()
+
+        self.ManagerThread = threading.Thread(target = self.manage, daemon = True)
+        self.ManagerThread.start()
+
+    def collectResults(self):
+        for task_id in self.Queue.getResults():
+            if not task_id.startswith(self.ExecutorId): continue
+            status, value = self.Queue.popResult(task_id)
+            with self.Lock:
+                future = self.Futures.pop(task_id, None)
+            ## Late results of reclaimed tasks are dropped
+            if not future or future.cancelled(): continue
+            if status == 'done': future.set_result(value)
+            else: future.set_exception(value)
+
+    def beat(self):
+        self.Queue.beatExecutor(self.ExecutorId, next(self.Heartbeats))
+        self.HeartbeatTime = time.monotonic()
+
+    ## Processing loop
+    def manage(self):
+        while not self.StopEvent.wait(self.PollInterval):
+            if time.monotonic() - self.HeartbeatTime >= self.HeartbeatInterval: self.beat()
+            self.Queue.reclaim()
+            self.Queue.purge()
+            self.collectResults()
+            with self.Lock:
+                if self.IsShutdown and not self.Futures: break
+        ## Tasks left in the queue are removed by the workers
+        self.Queue.removeExecutor(self.ExecutorId)
+
+    ## Executor interface
+    def submit(self, fn, /, *args, **kwargs):
+        with self.Lock:
+            if self.IsShutdown: raise RuntimeError("Cannot submit to a work queue after shutdown")
+            future = Future()
+            task_id = f"{self.ExecutorId}-{next(self.TaskIds):08d}"
+            self.Futures[task_id] = future
+            self.Queue.put(task_id, fn, args, kwargs)
+            return future
+
+    def shutdown(self, wait = True, *, cancel_futures = False):
+        with self.Lock:
+            self.IsShutdown = True
+            if cancel_futures:
+                for task_id, future in list(self.Futures.items()):
+                    if self.Queue.cancel(task_id):
+                        future.cancel()
+                        self.Futures.pop(task_id)
+        if wait: self.ManagerThread.join()
+        else: self.StopEvent.set()
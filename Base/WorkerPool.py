@@ -0,0 +1,240 @@
+from concurrent.futures import Executor, Future
+from concurrent.futures.process import _ExceptionWithTraceback
+from collections import deque
+
+import multiprocessing
+from multiprocessing.connection import wait
+import importlib
+import itertools
+import threading
+import pickle
+import os
+import logging
+
+from .MemoryGuard import get_rss
+
+def warm_up(modules, headers):
+    ## Done once per worker: ROOT initialization, C++ helpers declaration and cppyy bindings creation
+    import ROOT
+    ROOT.gROOT.SetBatch(True)
+    for header in headers:
+        ROOT.gInterpreter.ProcessLine(f'#include "{header}"')
+    for module in modules:
+        importlib.import_module(module)
+    for class_name in ('TFile', 'TTree', 'TH1I', 'TH1F', 'TH2F', 'TGraph', 'TLorentzVector', 'TVector3'):
+        getattr(ROOT, class_name)
+
+
+def try_warm_up(modules, headers):
+    ## Warm-up is only an optimization: if it fails, tasks report the actual error themselves, the worker logs why
+    try:
+        warm_up(modules, headers)
+    except Exception:
+        logging.getLogger("worker_pool").warning(f"Warm-up of worker process {os.getpid()} failed", exc_info = True)
+
+
+def get_headers():
+    ## dE/dx library included by PreliminaryAnalysis, the repository copy off-cluster
+    from Analyses.PreliminaryAnalysis import DEDX_HEADER_PATH
+    return [DEDX_HEADER_PATH]
+
+
+def is_picklable(obj):
+    try:
+        pickle.dumps(obj)
+        return True
+    except (pickle.PickleError, TypeError, AttributeError, RecursionError):
+        ## objects that cannot be pickled, other errors are not expected here and are raised
+        return False
+
+
+def get_error_message(error):
+    ## Exception is sent with its traceback, like in ProcessPoolExecutor
+    error = error if is_picklable(error) else RuntimeError(repr(error))
+    return ('error', _ExceptionWithTraceback(error, error.__traceback__))
+
+
+def worker_loop(task_connection, result_connection, modules, headers, memory_limit):
+    ## Every worker gets tasks and sends results through its own pipes: the pool knows the task of every worker,
+    ## and a crashed worker cannot corrupt messages of the others
+    try_warm_up(modules, headers)
+
+    while True:
+        try:
+            item = pickle.loads(task_connection.recv_bytes())
+        except EOFError:
+            break
+        except BaseException as error:
+            ## e.g. a function of a module the worker cannot import, the task fails with the error
+            result_connection.send(get_error_message(error))
+            continue
+        if item is None: break
+
+        func, args, kwargs = item
+        try:
+            message = ('done', func(*args, **kwargs))
+            pickle.dumps(message)
+        except BaseException as error:
+            message = get_error_message(error)
+        result_connection.send(message)
+
+        if memory_limit and get_rss() > memory_limit:
+            result_connection.send(('recycled', None))
+            break
+
+
+class WorkerCrashedError(RuntimeError):
+    pass
+
+
+class WorkerPool(Executor):
+    """
+    Long-lived worker processes forked from a forkserver with ROOT and the analysis modules preloaded
+    Every worker declares the C++ helpers (dE/dx library) and creates cppyy bindings once, then takes many tasks
+    A worker is recycled only after its memory exceeds memory_limit, a crashed worker is replaced
+    and its task fails with WorkerCrashedError
+    Tasks wait in the pool until a worker is idle and are sent to it over its own pipe, so the task of every worker is known
+    """
+    Modules = [
+        "Base.Analysis",
+        "Analyses.PreliminaryAnalysis",
+        "Analyses.IntermediateAnalysis",
+        "Analyses.KinfitAnalysis",
+        "Analyses.FinalAnalysis",
+        "Analyses.DynamicsAnalysis",
+    ]
+
+    def __init__(self, max_workers = 10, *, modules = None, headers = None, memory_limit = 4 << 30):
+        self.MaxWorkers = max_workers
+        self.Modules = WorkerPool.Modules if modules is None else modules
+        self.Headers = get_headers() if headers is None else headers
+        self.MemoryLimit = memory_limit
+
+        self.Context = multiprocessing.get_context('forkserver')
+        self.Context.set_forkserver_preload(["ROOT"] + self.Modules)
+
+        self.Workers = {} ## {pid: (process, task connection, result connection)}
+        self.WorkersTasks = {} ## {pid: (task_id, func, args, kwargs)} of busy workers
+        self.PendingTasks = deque() ## [(task_id, func, args, kwargs), ...] waiting for an idle worker
+        self.Futures = {} ## {task_id: future}
+        self.TaskIds = itertools.count()
+        self.Lock = threading.Lock()
+        self.IsShutdown = False
+
+        for _ in range(max_workers): self.startWorker()
+        self.ManagerThread = threading.Thread(target = self.manage, daemon = True)
+        self.ManagerThread.start()
+
+
+    ## Operations with workers
+    def startWorker(self):
+        task_reader, task_writer = self.Context.Pipe(duplex = False)
+        result_reader, result_writer = self.Context.Pipe(duplex = False)
+        process = self.Context.Process(
+            target = worker_loop,
+            args = (task_reader, result_writer, self.Modules, self.Headers, self.MemoryLimit),
+            daemon = True,
+        )
+        process.start()
+        task_reader.close()
+        result_writer.close()
+        self.Workers[process.pid] = (process, task_writer, result_reader)
+
+    def replaceWorker(self, pid):
+        process, task_writer, result_reader = self.Workers.pop(pid)
+        process.join()
+        task_writer.close()
+        result_reader.close()
+        ## A recycled worker exits without reading the task sent after its last result, the task goes to another worker
+        task = self.WorkersTasks.pop(pid, None)
+        if task and task[0] in self.Futures: self.PendingTasks.appendleft(task)
+        if not self.IsShutdown: self.startWorker()
+
+    def handleCrash(self, pid):
+        process, _, _ = self.Workers[pid]
+        process.join()
+        task_id = self.WorkersTasks[pid][0] if pid in self.WorkersTasks else None
+        future = self.Futures.pop(task_id, None)
+        if future and not future.cancelled():
+            future.set_exception(WorkerCrashedError(f"Worker process {pid} exited with code {process.exitcode}"))
+        self.replaceWorker(pid)
+
+    def handleMessage(self, pid, message):
+        status, value = message
+        if status == 'recycled':
+            self.replaceWorker(pid)
+        else:
+            task_id, _, _, _ = self.WorkersTasks.pop(pid)
+            future = self.Futures.pop(task_id, None)
+            if not future or future.cancelled(): return
+            if status == 'done': future.set_result(value)
+            else: future.set_exception(value)
+
+    def dispatchTasks(self):
+        ## Pending tasks are sent to idle workers, a task that cannot be pickled fails at once
+        for pid, (_, task_writer, _) in self.Workers.items():
+            if pid in self.WorkersTasks: continue
+            while self.PendingTasks:
+                task_id, fn, args, kwargs = self.PendingTasks.popleft()
+                future = self.Futures[task_id]
+                if future.cancelled():
+                    self.Futures.pop(task_id)
+                    continue
+                try:
+                    data = pickle.dumps((fn, args, kwargs))
+                except Exception as error:
+                    self.Futures.pop(task_id)
+                    future.set_exception(error)
+                    continue
+                try:
+                    task_writer.send_bytes(data)
+                except OSError:
+                    ## The worker exited, its pipe is closed: the task waits for another worker
+                    self.PendingTasks.appendleft((task_id, fn, args, kwargs))
+                    break
+                self.WorkersTasks[pid] = (task_id, fn, args, kwargs)
+                break
+
+    ## Processing loop
+    def manage(self):
+        while not (self.IsShutdown and not self.Futures):
+            with self.Lock:
+                readers = {result_reader: pid for pid, (_, _, result_reader) in self.Workers.items()}
+            for result_reader in wait(list(readers), timeout = 0.5):
+                pid = readers[result_reader]
+                with self.Lock:
+                    try:
+                        self.handleMessage(pid, result_reader.recv())
+                    except (EOFError, OSError):
+                        ## Pipe is closed only when the worker exits
+                        self.handleCrash(pid)
+            with self.Lock:
+                self.dispatchTasks()
+
+    ## Executor interface
+    def submit(self, fn, /, *args, **kwargs):
+        with self.Lock:
+            if self.IsShutdown: raise RuntimeError("Cannot submit to a worker pool after shutdown")
+            future = Future()
+            task_id = next(self.TaskIds)
+            self.Futures[task_id] = future
+            self.PendingTasks.append((task_id, fn, args, kwargs))
+            self.dispatchTasks()
+            return future
+
+    def shutdown(self, wait = True, *, cancel_futures = False):
+        with self.Lock:
+            self.IsShutdown = True
+            if cancel_futures:
+                for future in self.Futures.values(): future.cancel()
+                self.Futures = {}
+                self.PendingTasks.clear()
+        if wait: self.ManagerThread.join()
+        with self.Lock:
+            for _, task_writer, _ in self.Workers.values():
+                try:
+                    task_writer.send_bytes(pickle.dumps(None))
+                except OSError:
+                    pass
+        if wait:
+            for process, _, _ in self.Workers.values(): process.join()
@@ -0,0 +1,235 @@
+from ctypes import c_float
+from time import perf_counter
+
+import os
+
+import ROOT
+
+from Base.Variable import Variable
+from Base.Container import Container
+from Base.Analysis import CutDispatcher
+from Analyses.PreliminaryAnalysis import PreliminaryAnalysis, DEDX_HEADER_PATH
+from Analyses.IntermediateAnalysis import IntermediateAnalysis
+from Containers.CMD3ContainerV9 import CMD3ContainerV9, get_variables
+from Containers.NativeKinfitContainer import NativeKinfitContainer
+from Scripts.generate_sample import get_generator
+
+from .Suite import BenchmarkSuite
+
+class BenchmarkData:
+    """
+    Synthetic trees the benchmarks run on, generated once per number of entries and seed in the work directory:
+    raw multihadron-like tree (Scripts/generate_sample.py), its PreliminaryAnalysis output and the IntermediateAnalysis output of that
+    """
+    def __init__(self, work_dir, *, n_entries = 20000, seed = 1, energy = 950.):
+        self.WorkDir = work_dir
+        self.NEntries = n_entries
+        self.Seed = seed
+        self.Energy = energy
+        os.makedirs(work_dir, exist_ok = True)
+
+    def getPath(self, name, extension = 'root'):
+        return f"{self.WorkDir}/{name}_n{self.NEntries}_s{self.Seed}.{extension}"
+
+    def getRawPath(self):
+        path = self.getPath('raw')
+        if not os.path.exists(path): get_generator('multihad', self.Energy, self.Seed).write(path, self.NEntries)
+        return path
+
+    def getPrelimPath(self):
+        path = self.getPath('prelim_cut')
+        if not os.path.exists(path): run_preliminary_stage(self.getRawPath(), path, self.getPath('prelim_hists'), self.getPath('prelim', 'log'))
+        return path
+
+    def getCutPath(self):
+        path = self.getPath('cut')
+        if not os.path.exists(path): run_intermediate_stage(self.getPrelimPath(), path, self.getPath('cut_hists'), self.getPath('cut', 'log'))
+        return path
+
+
+def run_preliminary_stage(input_path, output_path, hists_path, log_path):
+    ## Cuts of Scripts/prelim_cut.py
+    analysis = PreliminaryAnalysis(input_path, analysis_path = hists_path, output_path = output_path, log_path = log_path)
+    for cut_name in ('nt', 'tcharge', 'tz', 'trho', 'tnhit', 'tth', 'tptot'): analysis.addCut(cut_name)
+    analysis.addHistogram('h_tptot_tdedx')
+    analysis.loop()
+    analysis.dumpToFile()
+    n_entries = analysis.getEntries()
+    analysis.close()
+    return n_entries
+
+
+def run_intermediate_stage(input_path, output_path, hists_path, log_path):
+    ## Histograms and the likelihood cut of Scripts/prelim_cut.py
+    analysis = IntermediateAnalysis(input_path, analysis_path = hists_path, output_path = output_path, log_path = log_path)
+    hist_names = [
+        'h_KpKmPipPimLklhd', 'h_TotalP_DeltaE', 'h_TotalP_DeltaEKKPiPi', 'h_PiPiPiMissMass2', 'h_KPiPiMissMass2',
+        'h_PiPiPiPiMissMass2', 'h_KKPiPiMissMass2', 'h_KKMissMass', 'h_PiPiMissMass', 'h_finalstate_id',
+    ]
+    for hist_name in hist_names: analysis.addHistogram(hist_name)
+    analysis.loop()
+    analysis.addCut('KpKmPipPimLklhd')
+    for hist_name in hist_names: analysis.addHistogram(hist_name)
+    analysis.loop()
+    analysis.dumpToFile()
+    n_entries = analysis.getEntries()
+    analysis.close()
+    return 2 * n_entries
+
+
+suite = BenchmarkSuite()
+
+## Variable access: one Variable per shape of CMD-3 branches, filled like an entry with 4 tracks
+VariableShapes = {
+    'scalar': lambda nt: Variable("emeas", "f"),
+    'tracks': lambda nt: Variable("tptot", "f", sizes = (nt,)),
+    'layers': lambda nt: Variable("tenslxe_layers", "f", sizes = (nt, 14,)),
+    'matrix': lambda nt: Variable("terr", "f", sizes = (nt, 3, 3,)),
+}
+
+def get_shape_value(variable):
+    ## New content of the variable filled with ones, setContent pads the given lists in place
+    if variable.Sizes == (1,): return 1.
+    value = 1.
+    for size in reversed(variable.Sizes): value = [value] * int(size)
+    return value
+
+
+for shape_name, make_variable in VariableShapes.items():
+    def get_content_benchmark(data, make_variable = make_variable):
+        nt = Variable("nt", "as", max_value = 10)
+        nt.Content = 4
+        variable = make_variable(nt)
+        variable.Content = get_shape_value(variable)
+        def measured(n_calls = 100000):
+            for _ in range(n_calls): variable.Content
+            return n_calls
+        return measured
+
+    def set_content_benchmark(data, make_variable = make_variable):
+        nt = Variable("nt", "as", max_value = 10)
+        nt.Content = 4
+        variable = make_variable(nt)
+        def measured(n_calls = 100000):
+            ## Values are built anew as analyses do for their TriggerVariables
+            for _ in range(n_calls): variable.Content = get_shape_value(variable)
+            return n_calls
+        return measured
+
+    suite.add(f"variable-get-{shape_name}")(get_content_benchmark)
+    suite.add(f"variable-set-{shape_name}")(set_content_benchmark)
+
+
+@suite.add("container-get-entry-full")
+def container_get_entry_full(data):
+    container = CMD3ContainerV9(data.getRawPath(), get_variables())
+    def measured():
+        for n_entry in range(container.getEntries()): container.getEntry(n_entry)
+        return container.getEntries()
+    return measured, container.close
+
+
+@suite.add("container-get-entry-pruned")
+def container_get_entry_pruned(data):
+    ## Branches read by the track cuts only
+    variables = get_variables()
+    container = Container(data.getRawPath(), "read", {name: variables[name] for name in ("nt", "tcharge", "tptot", "tth", "tz", "trho", "tnhit")}, prune = True)
+    def measured():
+        for n_entry in range(container.getEntries()): container.getEntry(n_entry)
+        return container.getEntries()
+    return measured, container.close
+
+
+@suite.add("cut-dispatcher-checklist")
+def cut_dispatcher_checklist(data):
+    ## Checking every entry and deleting every second one, as in Analysis.loop with a 50% cut
+    n_entries = 100 * data.NEntries
+    def measured():
+        cut_dispatcher = CutDispatcher({}, n_entries_full = n_entries)
+        for n_entry in range(n_entries):
+            if cut_dispatcher.checkEntryInChecklist(n_entry) and n_entry % 2: cut_dispatcher.deleteEntryFromChecklist(n_entry)
+        cut_dispatcher.getEntriesSelected()
+        return n_entries
+    return measured
+
+
+@suite.add("dedx-test-k-per-track")
+def dedx_test_k(data):
+    ## Events are tracks here, both hypotheses are calculated for every track
+    ROOT.gInterpreter.ProcessLine(f'#include "{DEDX_HEADER_PATH}"')
+    variables = get_variables()
+    container = Container(data.getRawPath(), "read", {name: variables[name] for name in ("nt", "runnum", "tptot", "tdedx")}, prune = True)
+    tracks = []
+    for n_entry in range(min(container.getEntries(), 5000)):
+        container.getEntry(n_entry)
+        runnum = variables["runnum"].Content
+        tracks += [(p, dedx, runnum) for p, dedx in zip(variables["tptot"].Content, variables["tdedx"].Content)]
+    container.close()
+    pars = (c_float * 12)()
+    def measured():
+        for p, dedx, runnum in tracks:
+            ROOT.test_k(p, dedx, runnum, pars, False, False)
+            ROOT.test_k(p, dedx, runnum, pars, False, True)
+        return len(tracks)
+    return measured
+
+
+for method_name in [name for name in dir(IntermediateAnalysis) if name.startswith('calculate') and 'MissMass' in name]:
+    def miss_mass_benchmark(data, method_name = method_name):
+        ## Only the method is timed, entries are read between the calls
+        analysis = IntermediateAnalysis(data.getPrelimPath(), log_path = data.getPath(method_name, 'log'))
+        n_entries = min(analysis.getEntries(), 2000)
+        method = getattr(analysis, method_name)
+        def measured():
+            wall_time = 0.
+            for n_entry in range(n_entries):
+                analysis.getEntry(n_entry)
+                start_time = perf_counter()
+                method()
+                wall_time += perf_counter() - start_time
+            return n_entries, wall_time
+        return measured, analysis.close
+    suite.add(f"intermediate-{method_name}")(miss_mass_benchmark)
+
+
+@suite.add("histograms-fill")
+def histograms_fill(data):
+    ## All histograms of the intermediate stage filled from the entries of the preliminary output
+    analysis = IntermediateAnalysis(data.getPrelimPath(), analysis_path = data.getPath('fill_hists'), log_path = data.getPath('fill', 'log'))
+    for hist_name in analysis.HistogramDispatcher.HistogramsAvailable: analysis.addHistogram(hist_name)
+    hists = analysis.getHistogramsCurrent()
+    n_entries = min(analysis.getEntries(), 2000)
+    def measured():
+        wall_time = 0.
+        for n_entry in range(n_entries):
+            analysis.getEntry(n_entry)
+            analysis.calculateEntry()
+            start_time = perf_counter()
+            analysis.fillHistograms(hists)
+            wall_time += perf_counter() - start_time
+        return n_entries, wall_time
+    return measured, analysis.close
+
+
+for is_cached in (False, True):
+    def kinfit_read_chunk_benchmark(data, is_cached = is_cached):
+        ## Fit inputs of the whole preliminary output as one chunk, from the tree or from the memory-mapped columns built beforehand
+        kinfit_container = NativeKinfitContainer(data.getPrelimPath(), "4Pi", {}, column_cache = is_cached)
+        def measured():
+            kinfit_container.readChunk(0, kinfit_container.getEntries())
+            return kinfit_container.getEntries()
+        return measured, kinfit_container.close
+    suite.add(f"kinfit-read-chunk-{'columns' if is_cached else 'tree'}")(kinfit_read_chunk_benchmark)
+
+
+@suite.add("stage-preliminary")
+def stage_preliminary(data):
+    input_path = data.getRawPath()
+    return lambda: run_preliminary_stage(input_path, data.getPath('bench_prelim_cut'), data.getPath('bench_prelim_hists'), data.getPath('bench_prelim', 'log'))
+
+
+@suite.add("stage-intermediate")
+def stage_intermediate(data):
+    ## Two passes over the entries: all of them and after the likelihood cut
+    input_path = data.getPrelimPath()
+    return lambda: run_intermediate_stage(input_path, data.getPath('bench_cut'), data.getPath('bench_hists'), data.getPath('bench_intermediate', 'log'))
@@ -0,0 +1,105 @@
+from itertools import product
+from time import perf_counter
+
+import os
+
+from Base.Container import Container
+from Analyses.IntermediateAnalysis import IntermediateAnalysis
+from Containers.CMD3ContainerV9 import CMD3ContainerV9, get_variables
+from Containers.PreliminaryContainer import PreliminaryContainer
+
+## Configurations measured by default: ROOT default compression (ZLIB:1) and fast or dense alternatives,
+## ROOT default basket size and auto-flush (32 kB, 30 MB) and bigger ones for sequential reading
+DefaultCompressions = ['ZLIB:1', 'LZ4:4', 'ZSTD:5']
+DefaultBasketSizes = [32000, 256000]
+DefaultAutoFlushes = [-30000000, -100000000]
+
+## Branches read by the track cuts, as a pruned read of a later stage
+PrunedBranches = ("nt", "tcharge", "tptot", "tth", "tz", "trho", "tnhit")
+
+## Schemas of the measured trees: raw CMD-3 v9 trees, PreliminaryContainer trees of prelim_cut and pershin_cut_2 outputs
+Schemas = ['raw', 'prelim', 'cut']
+
+def get_layouts(compressions = None, basket_sizes = None, auto_flushes = None):
+    return [
+        {'compression': compression, 'basket-size': basket_size, 'auto-flush': auto_flush}
+        for compression, basket_size, auto_flush in product(
+            compressions or DefaultCompressions, basket_sizes or DefaultBasketSizes, auto_flushes or DefaultAutoFlushes
+        )
+    ]
+
+
+def get_layout_name(layout):
+    return f"{layout['compression']}_b{layout['basket-size']}_f{layout['auto-flush']}"
+
+
+def read_entries(container):
+    start_time = perf_counter()
+    for n_entry in range(container.getEntries()): container.getEntry(n_entry)
+    return container.getEntries() / (perf_counter() - start_time)
+
+
+def get_variables_of_schema(schema, path):
+    ## Variables of all branches of the schema, the ones of PreliminaryContainer trees are defined by the analysis reading them
+    if schema == 'raw': return get_variables()
+    analysis = IntermediateAnalysis(path, log_path = os.devnull)
+    variables = analysis.Variables
+    analysis.close()
+    return variables
+
+
+def open_container(schema, path, mode, variables, layout = None):
+    if schema == 'raw':
+        return CMD3ContainerV9(path, variables) if mode == "read" else Container(path, mode, variables, layout = layout)
+    return PreliminaryContainer(path, mode, variables, layout = layout)
+
+
+def measure_layout(input_path, work_dir, layout, *, schema = 'raw', repeat = 3):
+    """
+    Copies a tree of the schema with the layout and measures it:
+    {'write-time': s, 'file-size': bytes, 'read-full': events/s, 'read-pruned': events/s}, best read of repeat ones
+    Write time is of filling and writing the copy only, reading and decoding the input entries is not timed
+    Reads go through the page cache, so they measure decompression and deserialization rather than the disk
+    """
+    output_path = f"{work_dir}/layout_{schema}_{get_layout_name(layout)}.root"
+    variables = get_variables_of_schema(schema, input_path)
+    input_container = open_container(schema, input_path, "read", variables)
+    output_container = open_container(schema, output_path, "recreate", variables, layout)
+    write_time = 0.
+    for n_entry in range(input_container.getEntries()):
+        input_container.getEntry(n_entry)
+        start_time = perf_counter()
+        output_container.fillEntry()
+        write_time += perf_counter() - start_time
+    start_time = perf_counter()
+    output_container.dumpToFile()
+    output_container.close()
+    write_time += perf_counter() - start_time
+    input_container.close()
+
+    result = {'write-time': write_time, 'file-size': os.path.getsize(output_path), 'read-full': 0., 'read-pruned': 0.}
+    for _ in range(repeat):
+        container = open_container(schema, output_path, "read", variables)
+        result['read-full'] = max(result['read-full'], read_entries(container))
+        container.close()
+
+        container = Container(output_path, "read", {name: variables[name] for name in PrunedBranches}, prune = True)
+        result['read-pruned'] = max(result['read-pruned'], read_entries(container))
+        container.close()
+    os.remove(output_path)
+    return result
+
+
+def measure_layouts(input_path, work_dir, layouts, *, schema = 'raw', repeat = 3, logger = None):
+    ## {layout name: {'layout': ..., 'write-time': ..., 'file-size': ..., 'read-full': ..., 'read-pruned': ...}}
+    os.makedirs(work_dir, exist_ok = True)
+    results = {}
+    for layout in layouts:
+        name = get_layout_name(layout)
+        results[name] = {'layout': layout, **measure_layout(input_path, work_dir, layout, schema = schema, repeat = repeat)}
+        if logger:
+            logger.info(
+                f"{name:<36} write {results[name]['write-time']:>7.1f} s {results[name]['file-size'] >> 20:>7} MB "
+                f"read {results[name]['read-full']:>9.0f} events/s, pruned {results[name]['read-pruned']:>9.0f} events/s"
+            )
+    return results
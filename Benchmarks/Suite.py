@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from fnmatch import fnmatch
+from time import perf_counter, time
+
+import json
+import os
+import platform
+
+from Base.MemoryGuard import get_peak_rss, reset_peak_rss
+
+class BenchmarkSuite:
+    """
+    Registry of benchmarks: a benchmark function takes the benchmark data (see HotPaths.BenchmarkData), prepares
+    everything it needs and returns the function to measure. The measured function returns the number of events processed,
+    or (n_events, wall_time) if it times only a part of its loop itself (e.g. one method after reading every entry)
+    A benchmark holding analyses or containers returns (measured function, teardown function), the teardown closes them
+    after the last run, so that their files and log handlers do not pile up over the suite
+    Results are the best throughput of repeat runs: {name: {'events': ..., 'wall-time': ..., 'events-per-second': ..., 'peak-memory': ...}}
+    """
+    def __init__(self):
+        self.Benchmarks = OrderedDict() ## {name: benchmark function}
+
+    def add(self, name):
+        def register(func):
+            if name in self.Benchmarks: raise ValueError(f"Benchmark already exists: {name}")
+            self.Benchmarks[name] = func
+            return func
+        return register
+
+    def getNames(self, patterns = None):
+        ## patterns: glob patterns of benchmark names, e.g. 'variable-*'
+        if not patterns: return list(self.Benchmarks)
+        return [name for name in self.Benchmarks if any(fnmatch(name, pattern) for pattern in patterns)]
+
+    def runSingle(self, name, data, *, repeat = 3):
+        measured_func = self.Benchmarks[name](data)
+        measured_func, teardown_func = measured_func if isinstance(measured_func, tuple) else (measured_func, None)
+        result, peak_memory = None, 0
+        try:
+            for _ in range(repeat):
+                ## Peak memory is of the whole process if the kernel does not support resetting it
+                reset_peak_rss()
+                start_time = perf_counter()
+                measured = measured_func()
+                wall_time = perf_counter() - start_time
+                n_events, wall_time = measured if isinstance(measured, tuple) else (measured, wall_time)
+                peak_memory = max(peak_memory, get_peak_rss())
+                events_per_second = n_events / wall_time if wall_time > 0 else 0.
+                if result is None or events_per_second > result['events-per-second']:
+                    result = {'events': n_events, 'wall-time': wall_time, 'events-per-second': events_per_second}
+        finally:
+            if teardown_func: teardown_func()
+        result['peak-memory'] = peak_memory
+        return result
+
+    def run(self, data, patterns = None, *, repeat = 3, logger = None):
+        results = OrderedDict()
+        for name in self.getNames(patterns):
+            results[name] = self.runSingle(name, data, repeat = repeat)
+            if logger:
+                logger.info(
+                    f"{name:<50} {results[name]['events-per-second']:>12.0f} events/s "
+                    f"{results[name]['peak-memory'] >> 20:>8} MB"
+                )
+        return results
+
+
+def save_results(path, results, **info):
+    ## Results with the machine and the sample they were measured on, e.g. as a baseline
+    info.update({'time': time(), 'host': platform.node(), 'python': platform.python_version()})
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+    with open(path, 'w') as file_results:
+        json.dump({'info': info, 'results': results}, file_results, indent = 2)
+
+
+def load_results(path):
+    with open(path, 'r') as file_results:
+        return json.load(file_results)
+
+
+def compare_results(baseline, results, *, threshold = 0.1):
+    """
+    Changes of throughput and peak memory of the benchmarks present in both results relative to the baseline
+    A benchmark regressed if its events/s dropped or its peak memory grew by more than threshold
+    Returns [{'name': ..., 'speed-change': ..., 'memory-change': ..., 'is-regression': ...}, ...]
+    """
+    comparison = []
+    for name, result in results.items():
+        if name not in baseline: continue
+        base_result = baseline[name]
+        speed_change = result['events-per-second'] / base_result['events-per-second'] - 1. if base_result['events-per-second'] else 0.
+        memory_change = result['peak-memory'] / base_result['peak-memory'] - 1. if base_result['peak-memory'] else 0.
+        comparison.append({
+            'name': name,
+            'speed-change': speed_change,
+            'memory-change': memory_change,
+            'is-regression': speed_change < -threshold or memory_change > threshold,
+        })
+    return comparison
+
+
+def get_baseline_path(name):
+    ## Baselines are kept in the repository next to the benchmarks, one per machine
+    return f"{os.path.dirname(os.path.abspath(__file__))}/baselines/{name}.json"
@@ -1,7 +1,58 @@
 from Base.Container import Container
+from Base.Variable import Variable
+
+def get_variables():
+    ## Variables of all CMD3ContainerV9 branches with the types and maximum sizes of CMD-3 v9 trees, e.g. for writing synthetic trees
+    nt = Variable("nt", "as", max_value = 10)
+    nph = Variable("nph", "as", max_value = 46)
+    variables = {
+        "nt":               nt,
+        "ntlxe":            Variable("ntlxe",               "as", max_value = 10),
+        "nph":              nph,
+        "emeas":            Variable("emeas",               "f"),
+        "demeas":           Variable("demeas",              "f"),
+        "xbeam":            Variable("xbeam",               "f"),
+        "ybeam":            Variable("ybeam",               "f"),
+        "runnum":           Variable("runnum",              "i"),
+        "evnum":            Variable("evnum",               "i"),
+        "ecaltot":          Variable("ecaltot",             "f"),
+        "ecalneu":          Variable("ecalneu",             "f"),
+        "psumch":           Variable("psumch",              "f"),
+        "psumnu":           Variable("psumnu",              "f"),
+        "nt_total":         Variable("nt_total",            "i"),
+        "nv_total":         Variable("nv_total",            "i"),
+        "ntlxe_total":      Variable("ntlxe_total",         "i"),
+        "finalstate_id":    Variable("finalstate_id",       "i"),
+        "nph_total":        Variable("nph_total",           "i"),
+    }
+    for name in (
+            "tlength", "tphi", "tth", "tptot", "tphiv", "tthv", "tptotv", "trho", "tdedx", "tz", "tchi2r", "tchi2z", "tchi2ndf",
+            "tt0", "tant", "ten", "tfc", "tenlxe", "tlengthlxe", "tencsi", "tenbgo", "tclth", "tclphi",
+            "tlxelength", "tlxededx", "tlxeir", "tlxeitheta", "tlxeiphi", "tlxevtheta", "tlxevphi", "tlxechi2", "tlxesen",
+    ):
+        variables[name] = Variable(name, "f", sizes = (nt,))
+    for name in ("tnhit", "tcharge", "tindlxe", "tenconv", "ntlxelayers", "tlxenhit"):
+        variables[name] = Variable(name, "i", sizes = (nt,))
+    variables["tenslxe_layers"] = Variable("tenslxe_layers", "f", sizes = (nt, 14,))
+    variables["tlxesen_layers"] = Variable("tlxesen_layers", "f", sizes = (nt, 14,))
+    variables["terr"] = Variable("terr", "f", sizes = (nt, 3, 3,))
+    variables["terr0"] = Variable("terr0", "f", sizes = (nt, 6, 6,))
+    variables["txyzatcl"] = Variable("txyzatcl", "f", sizes = (nt, 3,))
+    variables["txyzatlxe"] = Variable("txyzatlxe", "f", sizes = (nt, 3,))
+    for name in ("phen", "phth", "phphi", "phrho", "phen0", "phth0", "phphi0", "phlxe", "phcsi", "phbgo"):
+        variables[name] = Variable(name, "f", sizes = (nph,))
+    for name in ("phflag", "phconv", "phfc"):
+        variables[name] = Variable(name, "i", sizes = (nph,))
+    variables["phslxe_layers"] = Variable("phslxe_layers", "f", sizes = (nph, 14,))
+    variables["pherr"] = Variable("pherr", "f", sizes = (nph, 3,))
+    return variables
+
 
 class CMD3ContainerV9(Container):
-    def __init__(self, path: str, variables):
+    """
+    Raw CMD-3 v9 tr_ph tree, read-only except for writing synthetic trees (see Scripts/generate_sample.py)
+    """
+    def __init__(self, path: str, variables, mode: str = "read"):
         branches = [
             "nt",
             "ntlxe",
@@ -82,4 +133,4 @@ class CMD3ContainerV9(Container):
             "phconv",
             "phfc",
         ]
-        Container.__init__(self, path, "read", {branch: variables[branch] for branch in branches})
+        Container.__init__(self, path, mode, {branch: variables[branch] for branch in branches})
@@ -1,7 +1,8 @@
 from Base.Container import Container
+from Containers.PreliminaryContainer import OPTIONAL_BRANCHES, SLIM_DROP
 
 class FinalContainer(Container):
-    def __init__(self, path: str, mode: str, variables):
+    def __init__(self, path: str, mode: str, variables, *, keep = None, drop = None, parent = None, layout = None):
         branches = [
             "nt",
             "ntlxe",
@@ -73,6 +74,8 @@ class FinalContainer(Container):
             "KmTrackIndex",
             "PipTrackIndex",
             "PimTrackIndex",
+            "TrackPiLklhds",
+            "TrackKLklhds",
             "KpKmPipPimKinfitChi2",
             "KpKmPipPimKinfitKpTrack",
             "KpKmPipPimKinfitKmTrack",
@@ -86,4 +89,4 @@ class FinalContainer(Container):
             
             "PipPimPipPimMissMass",
         ]
-        Container.__init__(self, path, mode, {branch: variables[branch] for branch in set(branches) & set(variables)})
+        Container.__init__(self, path, mode, {branch: variables[branch] for branch in set(branches) & set(variables)}, keep = keep, drop = drop, parent = parent, layout = layout, optional = OPTIONAL_BRANCHES + SLIM_DROP)
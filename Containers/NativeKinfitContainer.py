@@ -0,0 +1,217 @@
+import numpy as np
+
+from Base.ColumnCache import ColumnCache, get_padded
+from Base.Container import Container
+from Base.Variable import Variable
+from Base.KinematicFit import KinematicFitter
+from Base.PhysicalConstants import m_pi, m_K
+
+class NativeKinfitContainer:
+    """
+    In-process replacement of the kinfit containers (Kinfit2K2PiContainer, Kinfit4PiContainer).
+    Reads a preliminary tree by chunks of entries, fits every chunk at once
+    and delivers the same KF_* branches as the external kinfit executables write
+    With column_cache the fit inputs are read memory-mapped from a ColumnCache of the preliminary tree
+    """
+    Hypotheses = {
+        "2K2Pi": (m_K, m_K, m_pi, m_pi), ## tracks order: K+, K-, pi+, pi-
+        "4Pi": (m_pi, m_pi, m_pi, m_pi), ## tracks order: pi+, pi-, pi+, pi-
+    }
+    ## Swapping a '+'-charged pair of tracks and a '-'-charged one, the same as in likelihood calculation
+    TracksPermutations = (
+        (0, 1, 2, 3),
+        (2, 1, 0, 3),
+        (0, 3, 2, 1),
+        (2, 3, 0, 1),
+    )
+
+    def __init__(self, path: str, hypothesis: str, branches_variables, *, kinfit_type: str = "DCLklhd", chunk_size: int = 10_000, column_cache: bool = False):
+        if hypothesis not in NativeKinfitContainer.Hypotheses: raise ValueError(f"Wrong kinfit hypothesis: '{hypothesis}'")
+        if kinfit_type not in ("Permut", "DCLklhd"): raise ValueError(f"Wrong kinfit type: '{kinfit_type}'")
+        self.Hypothesis = hypothesis
+        self.KinfitType = kinfit_type
+        self.Fitter = KinematicFitter(NativeKinfitContainer.Hypotheses[hypothesis])
+        self.ChunkSize = chunk_size
+        self.CurrentChunk = -1
+        self.CurrentEntry = -1
+        self.Results = {}
+
+        ## Private variables with fit inputs, only these branches are read from the preliminary tree
+        nt = Variable("nt", "as", max_value = 10)
+        self.InputVariables = {
+            "nt":               nt,
+            "emeas":            Variable("emeas",           "f"),
+            "tptot":            Variable("tptot",           "f", sizes = (nt,)),
+            "tth":              Variable("tth",             "f", sizes = (nt,)),
+            "tphi":             Variable("tphi",            "f", sizes = (nt,)),
+            "tcharge":          Variable("tcharge",         "i", sizes = (nt,)),
+            "terr":             Variable("terr",            "f", sizes = (nt, 3, 3,)),
+            "KpTrackIndex":     Variable("KpTrackIndex",    "B"),
+            "KmTrackIndex":     Variable("KmTrackIndex",    "B"),
+            "PipTrackIndex":    Variable("PipTrackIndex",   "B"),
+            "PimTrackIndex":    Variable("PimTrackIndex",   "B"),
+        }
+        if column_cache:
+            self.InputContainer = None
+            self.ColumnCache = ColumnCache(path, self.InputVariables).open()
+        else:
+            self.InputContainer = Container(path, "read", self.InputVariables, prune = True)
+            self.ColumnCache = None
+
+        ## {'KF_<hypothesis>_<quantity>': variable}
+        self.Variables = branches_variables
+
+
+    def getEntries(self) -> int:
+        if self.ColumnCache: return self.ColumnCache.getEntries()
+        return self.InputContainer.getEntries()
+
+    def getBranchNames(self):
+        ## Branches of the preliminary tree read as fit inputs
+        return list(self.InputVariables)
+
+    def getEntry(self, entry: int):
+        n_chunk = entry // self.ChunkSize
+        if n_chunk != self.CurrentChunk: self.fitChunk(n_chunk)
+        i = entry - n_chunk * self.ChunkSize
+
+        prefix = f"KF_{self.Hypothesis}_"
+        self.Variables[prefix + "IsConverged"].Content = int(self.Results["is-converged"][i])
+        self.Variables[prefix + "Chi2"].Content = float(self.Results["chi2"][i])
+        for quantity, result_name in (
+                ("TrackMomenta", "momenta"),
+                ("TrackThetas", "thetas"),
+                ("TrackPhis", "phis"),
+                ("TrackEnergies", "energies"),
+                ("TrackIndices", "indices"),
+        ):
+            ## writing to the buffer directly since the number of fitted tracks is fixed
+            array = self.Variables[prefix + quantity].getArray()
+            for k, value in enumerate(self.Results[result_name][i].tolist()): array[k] = value
+        self.CurrentEntry = entry
+
+    def readChunk(self, first_entry, last_entry):
+        if self.ColumnCache: return self.readChunkColumns(first_entry, last_entry)
+        n_events = last_entry - first_entry
+        chunk = {
+            "beam-energies": np.zeros(n_events),
+            "momenta": np.zeros((n_events, 4)),
+            "thetas": np.zeros((n_events, 4)),
+            "phis": np.zeros((n_events, 4)),
+            "charges": np.zeros((n_events, 4), dtype = np.int32),
+            "covariances": np.tile(np.eye(3), (n_events, 4, 1, 1)),
+            "pid-indices": np.tile(np.arange(4), (n_events, 1)),
+            "is-valid": np.zeros(n_events, dtype = bool),
+        }
+        for i, n_entry in enumerate(range(first_entry, last_entry)):
+            self.InputContainer.getEntry(n_entry)
+            if int(self.InputVariables["nt"]) != 4: continue
+
+            chunk["is-valid"][i] = True
+            chunk["beam-energies"][i] = self.InputVariables["emeas"].Content
+            chunk["momenta"][i] = self.InputVariables["tptot"].getArray()[:4]
+            chunk["thetas"][i] = self.InputVariables["tth"].getArray()[:4]
+            chunk["phis"][i] = self.InputVariables["tphi"].getArray()[:4]
+            chunk["charges"][i] = self.InputVariables["tcharge"].getArray()[:4]
+            chunk["covariances"][i] = np.reshape(self.InputVariables["terr"].getArray()[:36], (4, 3, 3))
+            chunk["pid-indices"][i] = [
+                self.InputVariables["KpTrackIndex"].Content,
+                self.InputVariables["KmTrackIndex"].Content,
+                self.InputVariables["PipTrackIndex"].Content,
+                self.InputVariables["PimTrackIndex"].Content,
+            ]
+
+        return self.arrangeChunk(chunk)
+
+    def readChunkColumns(self, first_entry, last_entry):
+        ## The same chunk as readChunk from the memory-mapped columns, entries without 4 tracks keep the default inputs
+        columns = self.ColumnCache.getChunk(first_entry, last_entry)
+        is_valid = np.asarray(columns["nt"]) == 4
+        mask = is_valid[:, None]
+        chunk = {
+            "beam-energies": np.where(is_valid, columns["emeas"], 0.).astype(float),
+            "momenta": np.where(mask, get_padded(*columns["tptot"], 4), 0.).astype(float),
+            "thetas": np.where(mask, get_padded(*columns["tth"], 4), 0.).astype(float),
+            "phis": np.where(mask, get_padded(*columns["tphi"], 4), 0.).astype(float),
+            "charges": np.where(mask, get_padded(*columns["tcharge"], 4), 0).astype(np.int32),
+            "covariances": np.where(mask[:, :, None, None], get_padded(*columns["terr"], 4), np.eye(3)).astype(float),
+            "pid-indices": np.where(mask, np.stack([
+                columns[name] for name in ("KpTrackIndex", "KmTrackIndex", "PipTrackIndex", "PimTrackIndex")
+            ], axis = 1), np.arange(4)).astype(int),
+            "is-valid": is_valid,
+        }
+        return self.arrangeChunk(chunk)
+
+    def arrangeChunk(self, chunk):
+        ## Tracks indices arranged so that the charges are (+, -, +, -)
+        charges = chunk["charges"]
+        chunk["is-valid"] &= ((charges == 1).sum(axis = 1) == 2) & ((charges == -1).sum(axis = 1) == 2)
+        chunk["charge-indices"] = np.argsort(-charges, axis = 1, kind = "stable")[:, [0, 2, 1, 3]]
+        return chunk
+
+    def getTracksAssignments(self, chunk):
+        if self.Hypothesis == "4Pi":
+            return [chunk["charge-indices"]]
+        if self.KinfitType == "DCLklhd":
+            return [chunk["pid-indices"]]
+        return [chunk["charge-indices"][:, list(perm)] for perm in NativeKinfitContainer.TracksPermutations]
+
+    def fitChunk(self, n_chunk):
+        first_entry = n_chunk * self.ChunkSize
+        last_entry = min(first_entry + self.ChunkSize, self.getEntries())
+        chunk = self.readChunk(first_entry, last_entry)
+        events = np.arange(last_entry - first_entry)[:, None]
+
+        ## Choosing the tracks assignment with the lowest chi2 among converged fits
+        self.Results = {}
+        for tracks_indices in self.getTracksAssignments(chunk):
+            results = self.Fitter.fit(
+                chunk["beam-energies"],
+                chunk["momenta"][events, tracks_indices],
+                chunk["thetas"][events, tracks_indices],
+                chunk["phis"][events, tracks_indices],
+                chunk["covariances"][events, tracks_indices],
+            )
+            results["is-converged"] &= chunk["is-valid"]
+            results["chi2"] = np.where(results["is-converged"], results["chi2"], np.inf)
+            results["indices"] = tracks_indices
+            if not self.Results:
+                self.Results = results
+                continue
+
+            is_better = results["chi2"] < self.Results["chi2"]
+            for name, values in results.items():
+                mask = is_better if values.ndim == 1 else is_better[:, None]
+                self.Results[name] = np.where(mask, values, self.Results[name])
+        self.CurrentChunk = n_chunk
+
+    def close(self):
+        if self.InputContainer: self.InputContainer.close()
+
+
+class NativeKinfit2K2PiContainer(NativeKinfitContainer):
+    def __init__(self, path, variables, *, kinfit_type = "DCLklhd", chunk_size = 10_000, column_cache = False):
+        branches = {
+            "KF_2K2Pi_IsConverged":   variables["KpKmPipPimKinfitIsConverged"],
+            "KF_2K2Pi_Chi2":          variables["KpKmPipPimKinfitChi2"],
+            "KF_2K2Pi_TrackMomenta":  variables["KpKmPipPimKinfitTrackMomenta"],
+            "KF_2K2Pi_TrackThetas":   variables["KpKmPipPimKinfitTrackThetas"],
+            "KF_2K2Pi_TrackPhis":     variables["KpKmPipPimKinfitTrackPhis"],
+            "KF_2K2Pi_TrackEnergies": variables["KpKmPipPimKinfitTrackEnergies"],
+            "KF_2K2Pi_TrackIndices":  variables["KpKmPipPimKinfitTrackIndices"],
+        }
+        NativeKinfitContainer.__init__(self, path, "2K2Pi", branches, kinfit_type = kinfit_type, chunk_size = chunk_size, column_cache = column_cache)
+
+
+class NativeKinfit4PiContainer(NativeKinfitContainer):
+    def __init__(self, path, variables, *, chunk_size = 10_000, column_cache = False):
+        branches = {
+            "KF_4Pi_IsConverged":   variables["PipPimPipPimKinfitIsConverged"],
+            "KF_4Pi_Chi2":          variables["PipPimPipPimKinfitChi2"],
+            "KF_4Pi_TrackMomenta":  variables["PipPimPipPimKinfitTrackMomenta"],
+            "KF_4Pi_TrackThetas":   variables["PipPimPipPimKinfitTrackThetas"],
+            "KF_4Pi_TrackPhis":     variables["PipPimPipPimKinfitTrackPhis"],
+            "KF_4Pi_TrackEnergies": variables["PipPimPipPimKinfitTrackEnergies"],
+            "KF_4Pi_TrackIndices":  variables["PipPimPipPimKinfitTrackIndices"],
+        }
+        NativeKinfitContainer.__init__(self, path, "4Pi", branches, chunk_size = chunk_size, column_cache = column_cache)
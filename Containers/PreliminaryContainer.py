@@ -1,7 +1,13 @@
 from Base.Container import Container
 
+## Branches added by later versions of PreliminaryAnalysis, files written before them are read without these
+OPTIONAL_BRANCHES = ["TrackPiLklhds", "TrackKLklhds"]
+## Branches not read by any later stage (IntermediateAnalysis, KinfitAnalysis, FinalAnalysis, DynamicsAnalysis):
+## the 6x6 track errors and the LXe layers and track reconstruction, dropped from slim outputs and optional when reading
+SLIM_DROP = ["terr0", "*_layers", "tlxe*", "txyzatlxe"]
+
 class PreliminaryContainer(Container):
-    def __init__(self, path: str, mode: str, variables):
+    def __init__(self, path: str, mode: str, variables, *, keep = None, drop = None, parent = None, layout = None):
         branches = [
             "nt",
             "ntlxe",
@@ -90,5 +96,7 @@ class PreliminaryContainer(Container):
             "KmTrackIndex",
             "PipTrackIndex",
             "PimTrackIndex",
+            "TrackPiLklhds",
+            "TrackKLklhds",
         ]
-        Container.__init__(self, path, mode, {branch: variables[branch] for branch in branches if branch in variables})
+        Container.__init__(self, path, mode, {branch: variables[branch] for branch in branches if branch in variables}, keep = keep, drop = drop, parent = parent, layout = layout, optional = OPTIONAL_BRANCHES + SLIM_DROP)
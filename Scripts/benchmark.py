@@ -0,0 +1,118 @@
+from argparse import ArgumentParser
+
+import os
+import sys
+
+import logging
+from logging import getLogger, StreamHandler, Formatter
+
+from Benchmarks.Suite import save_results, load_results, compare_results, get_baseline_path
+
+def get_logger():
+    logger = getLogger("benchmark")
+    logger.setLevel(logging.INFO)
+    log_handler = StreamHandler(sys.stdout)
+    log_handler.setFormatter(
+        Formatter(
+            fmt = "%(asctime)s: %(name)s: %(message)s",
+            datefmt = "%d.%m.%Y %H:%M:%S"
+        )
+    )
+    logger.addHandler(log_handler)
+    return logger
+
+
+def resolve_results_path(name_or_path):
+    ## Stored baselines are given by name, e.g. 'cluster-node'
+    return name_or_path if os.path.exists(name_or_path) or name_or_path.endswith('.json') else get_baseline_path(name_or_path)
+
+
+def report_comparison(logger, baseline_path, results, threshold):
+    ## Returns True if any benchmark regressed
+    baseline = load_results(baseline_path)
+    if baseline['info'].get('entries') != results['info'].get('entries'):
+        logger.info(f"Baseline was measured on {baseline['info'].get('entries')} entries, results on {results['info'].get('entries')}")
+    comparison = compare_results(baseline['results'], results['results'], threshold = threshold)
+    logger.info(f"{'Benchmark':<50} {'Speed':>8} {'Memory':>8}")
+    for record in comparison:
+        logger.info(
+            f"{record['name']:<50} {record['speed-change']:>+8.1%} {record['memory-change']:>+8.1%}"
+            + ("  REGRESSION" if record['is-regression'] else "")
+        )
+    regressions = [record['name'] for record in comparison if record['is-regression']]
+    logger.info(f"Regressions above {threshold:.0%}: {regressions}" if regressions else f"No regressions above {threshold:.0%}")
+    return bool(regressions)
+
+
+if __name__ == '__main__':
+    ##Parsing input arguments
+    parser = ArgumentParser(description = "Benchmarks of the hot paths on synthetic CMD-3 trees")
+    subparsers = parser.add_subparsers(dest = 'mode', required = True)
+
+    parser_list = subparsers.add_parser('list', help = "List the benchmarks")
+
+    parser_run = subparsers.add_parser('run', help = "Run the benchmarks")
+    parser_run.add_argument('--only', action = 'append', default = [], help = 'Glob pattern of benchmark names, e.g. "variable-*"')
+    parser_run.add_argument('--entries', type = int, default = 20000, help = 'Entries of the synthetic tree')
+    parser_run.add_argument('--seed', type = int, default = 1)
+    parser_run.add_argument('--repeat', type = int, default = 3, help = 'Runs of every benchmark, the fastest one is kept')
+    parser_run.add_argument('--work-dir', default = '/tmp/kpkmpippim_benchmarks', help = 'Directory of the synthetic trees and outputs of the stages')
+    parser_run.add_argument('--output', help = 'Path of JSON results')
+    parser_run.add_argument('--save-baseline', help = 'NAME: store the results as the baseline of this machine in Benchmarks/baselines')
+    parser_run.add_argument('--baseline', help = 'NAME or path of the baseline to compare the results with')
+    parser_run.add_argument('--threshold', type = float, default = 0.1, help = 'Relative slowdown or memory growth reported as a regression')
+
+    parser_layouts = subparsers.add_parser('layouts', help = "Measure write time, file size and read throughput of output tree layouts")
+    parser_layouts.add_argument('--schema', choices = ['raw', 'prelim', 'cut'], default = 'raw', help = 'Tree copied: raw CMD-3 v9 one, prelim_cut or pershin_cut_2 output')
+    parser_layouts.add_argument('--input', help = 'Tree of the schema copied with every layout, a synthetic one by default')
+    parser_layouts.add_argument('--entries', type = int, default = 20000, help = 'Entries of the synthetic tree')
+    parser_layouts.add_argument('--seed', type = int, default = 1)
+    parser_layouts.add_argument('--compression', action = 'append', default = [], help = 'ALGORITHM:LEVEL, e.g. LZ4:4, ZSTD:5, ZLIB:1')
+    parser_layouts.add_argument('--basket-size', action = 'append', type = int, default = [], help = 'Basket size in bytes')
+    parser_layouts.add_argument('--auto-flush', action = 'append', type = int, default = [], help = 'Cluster size: entries if positive, bytes if negative')
+    parser_layouts.add_argument('--repeat', type = int, default = 3, help = 'Reads of every layout, the fastest one is kept')
+    parser_layouts.add_argument('--work-dir', default = '/tmp/kpkmpippim_benchmarks', help = 'Directory of the synthetic tree and of the copies')
+    parser_layouts.add_argument('--output', help = 'Path of JSON results')
+
+    parser_compare = subparsers.add_parser('compare', help = "Compare results with a baseline")
+    parser_compare.add_argument('baseline', help = 'NAME or path of the baseline')
+    parser_compare.add_argument('results', help = 'Path of JSON results')
+    parser_compare.add_argument('--threshold', type = float, default = 0.1, help = 'Relative slowdown or memory growth reported as a regression')
+    args = parser.parse_args()
+
+    logger = get_logger()
+    if args.mode == 'compare':
+        results = load_results(args.results)
+        sys.exit(1 if report_comparison(logger, resolve_results_path(args.baseline), results, args.threshold) else 0)
+
+    ## Benchmarks import ROOT and the analyses, the comparison does not need them
+    if args.mode == 'layouts':
+        from Benchmarks.Layouts import get_layouts, measure_layouts
+        from Benchmarks.HotPaths import BenchmarkData
+        if args.input:
+            input_path = args.input
+        else:
+            data = BenchmarkData(args.work_dir, n_entries = args.entries, seed = args.seed)
+            input_path = {'raw': data.getRawPath, 'prelim': data.getPrelimPath, 'cut': data.getCutPath}[args.schema]()
+        layouts = get_layouts(args.compression, args.basket_size, args.auto_flush)
+        results = measure_layouts(input_path, args.work_dir, layouts, schema = args.schema, repeat = args.repeat, logger = logger)
+        if args.output:
+            save_results(args.output, results, input = input_path, schema = args.schema, repeat = args.repeat)
+            logger.info(f"Results saved to {args.output}")
+        sys.exit(0)
+
+    from Benchmarks.HotPaths import suite, BenchmarkData
+    if args.mode == 'list':
+        for name in suite.getNames(): print(name)
+        sys.exit(0)
+
+    data = BenchmarkData(args.work_dir, n_entries = args.entries, seed = args.seed)
+    results = {
+        'info': {'entries': args.entries, 'seed': args.seed, 'repeat': args.repeat},
+        'results': suite.run(data, args.only, repeat = args.repeat, logger = logger),
+    }
+    for path in filter(None, [args.output, get_baseline_path(args.save_baseline) if args.save_baseline else None]):
+        save_results(path, results['results'], **results['info'])
+        logger.info(f"Results saved to {path}")
+    if args.baseline:
+        sys.exit(1 if report_comparison(logger, resolve_results_path(args.baseline), results, args.threshold) else 0)
@@ -0,0 +1,50 @@
+from argparse import ArgumentParser
+from importlib import import_module
+from tempfile import TemporaryDirectory
+
+from Base.ArrowExporter import ArrowExporter
+
+## Analyses whose selected entries can be exported: (module, class, input trees), the first input is a tree of the previous stage
+Analyses = {
+    'preliminary': ("Analyses.PreliminaryAnalysis", "PreliminaryAnalysis", ["input"]),
+    'intermediate': ("Analyses.IntermediateAnalysis", "IntermediateAnalysis", ["input"]),
+    'final': ("Analyses.FinalAnalysis", "FinalAnalysis", ["input", "kinfit 2K2Pi", "kinfit 4Pi"]),
+    'dynamics': ("Analyses.DynamicsAnalysis", "DynamicsAnalysis", ["input"]),
+}
+
+def export_selected(analysis_name, input_paths, output_path, cut_names, variable_names, *, log_path = None, row_group_size = 65536):
+    ## One loop with the cuts, then the selected entries are written by Analysis.dumpToFile like the ROOT outputs
+    module_name, class_name, input_names = Analyses[analysis_name]
+    if len(input_paths) != len(input_names): raise ValueError(f"Analysis '{analysis_name}' reads {len(input_names)} inputs: {', '.join(input_names)}")
+    ## Histograms of the loop are not exported, they go to a throwaway analysis file
+    with TemporaryDirectory() as analysis_dir:
+        analysis = getattr(import_module(module_name), class_name)(*input_paths, analysis_path = f"{analysis_dir}/hists.root", log_path = log_path)
+        for cut_name in cut_names: analysis.addCut(cut_name)
+        analysis.loop(directory_name = 'export')
+
+        exporter = ArrowExporter(
+            output_path, {variable_name: analysis.Variables[variable_name] for variable_name in variable_names}, row_group_size = row_group_size
+        )
+        analysis.OutputContainers.append(exporter)
+        analysis.dumpToFile()
+        n_entries = exporter.getEntries()
+        analysis.close()
+    return n_entries
+
+
+if __name__ == '__main__':
+    ##Parsing input arguments
+    parser = ArgumentParser(description = "Export selected entries of a stage to Parquet/Arrow for NumPy/pandas studies")
+    parser.add_argument('--analysis', choices = list(Analyses), required = True)
+    parser.add_argument('--input', action = 'append', required = True, help = 'Input tree of the analysis, final reads the preliminary tree, then the 2K2Pi and 4Pi kinfit trees')
+    parser.add_argument('--output', required = True, help = 'Output file: .parquet, or .arrow/.feather for Arrow IPC')
+    parser.add_argument('--cut', action = 'append', default = [], help = 'Cut selecting the exported entries')
+    parser.add_argument('--variable', action = 'append', required = True, help = 'Branch or TriggerVariable written as a column, e.g. tptot or KpKmPipPimLklhd')
+    parser.add_argument('--row-group-size', type = int, default = 65536, help = 'Entries buffered in memory before they are written')
+    parser.add_argument('--log-path', default = None)
+    args = parser.parse_args()
+
+    n_entries = export_selected(
+        args.analysis, args.input, args.output, args.cut, args.variable, log_path = args.log_path, row_group_size = args.row_group_size
+    )
+    print(f"{n_entries} entries exported to {args.output}")
@@ -0,0 +1,272 @@
+from math import pi, sqrt, acos, cos, sin, exp
+
+from array import array
+from argparse import ArgumentParser
+
+import random
+
+from ROOT import TGenPhaseSpace, TLorentzVector, gRandom
+
+from Base.PhysicalConstants import m_pi, m_pi0, m_K
+from Base.Manifest import get_point_path
+from Containers.CMD3ContainerV9 import CMD3ContainerV9, get_variables
+
+## {finalstate_id: (name, masses, charges)}, neutral particles are pi0
+## 12 is the K+K-pi+pi- code of the multihadron generator, the other codes are used by this generator only
+FinalStates = {
+    12: ("K+K-pi+pi-", (m_K, m_K, m_pi, m_pi), (1, -1, 1, -1)),
+    1: ("pi+pi-pi+pi-", (m_pi, m_pi, m_pi, m_pi), (1, -1, 1, -1)),
+    2: ("pi+pi-pi0", (m_pi, m_pi, m_pi0), (1, -1, 0)),
+    3: ("K+K-pi0", (m_K, m_K, m_pi0), (1, -1, 0)),
+    4: ("pi+pi-pi+pi-pi0", (m_pi, m_pi, m_pi, m_pi, m_pi0), (1, -1, 1, -1, 0)),
+    5: ("K+K-pi+pi-pi0", (m_K, m_K, m_pi, m_pi, m_pi0), (1, -1, 1, -1, 0)),
+}
+
+## Fractions of the final states in data-like and multihadron-like samples, sim samples are signal only
+DefaultFractions = {12: 0.2, 1: 0.4, 2: 0.15, 3: 0.05, 4: 0.15, 5: 0.05}
+
+N_LAYERS = 14 ## LXe calorimeter layers
+R_LXE = 37. ## cm, radii of LXe and CsI calorimeters
+R_CSI = 48.
+
+
+def get_dedx(p, mass, rng):
+    ## Bethe-Bloch-like dependence on beta, MIP ~ 2000 in the units of tdedx, 12% resolution
+    beta2 = p * p / (p * p + mass * mass)
+    return 2000. * min(beta2 ** -0.85, 20.) * rng.gauss(1., 0.12)
+
+
+def split_layers(energy, rng):
+    weights = [rng.expovariate(1.) * exp(-layer / 5.) for layer in range(N_LAYERS)]
+    weights_sum = sum(weights)
+    return [energy * weight / weights_sum for weight in weights]
+
+
+def get_diagonal(values):
+    return [[value if i == j else 0. for j in range(len(values))] for i, value in enumerate(values)]
+
+
+class SampleGenerator:
+    """
+    Synthetic CMD-3 v9 tr_ph trees for tests and benchmarks without access to the cluster data
+    Events of the final states mixed by fractions ({finalstate_id: fraction}) are generated by phase space (TGenPhaseSpace)
+    at the c.m. energy 2 x emeas, pi0 decay into two photons, tracks and photons out of the detector acceptance are lost,
+    momenta, angles, dE/dx and energies are smeared with resolutions close to the CMD-3 ones
+    Events are reproducible by seed, finalstate_id is filled for multihadron-like samples only (0 otherwise)
+    """
+    def __init__(self, *, energy = 950., fractions = None, is_multihad = False, seed = 1, run_number = 79625, entries_per_run = 10000):
+        self.Energy = energy ## MeV, beam energy
+        self.Fractions = fractions if fractions else DefaultFractions
+        self.IsMultihad = is_multihad
+        self.Rng = random.Random(seed)
+        gRandom.SetSeed(seed)
+        self.RunNumber = run_number ## first run, runs of 2019 at 950 MeV by default, dE/dx parameters depend on it
+        self.EntriesPerRun = entries_per_run
+        self.PhaseSpaces = {} ## {finalstate_id: (TGenPhaseSpace, maximum weight)}
+        self.Pi0Decay = TGenPhaseSpace()
+        self.Pi0Masses = array('d', [0., 0.])
+        self.Variables = get_variables()
+
+    def getPhaseSpace(self, finalstate_id):
+        if finalstate_id not in self.PhaseSpaces:
+            masses = array('d', FinalStates[finalstate_id][1])
+            phase_space = TGenPhaseSpace()
+            if not phase_space.SetDecay(TLorentzVector(0., 0., 0., 2. * self.Energy), len(masses), masses):
+                raise ValueError(f"Final state {FinalStates[finalstate_id][0]} is not allowed at energy {2. * self.Energy} MeV")
+            self.PhaseSpaces[finalstate_id] = (phase_space, phase_space.GetWtMax())
+        return self.PhaseSpaces[finalstate_id]
+
+    def generateFinalState(self, finalstate_id):
+        ## Unweighted phase space event: [(TLorentzVector, mass, charge), ...]
+        phase_space, weight_max = self.getPhaseSpace(finalstate_id)
+        while phase_space.Generate() < self.Rng.random() * weight_max: pass
+        _, masses, charges = FinalStates[finalstate_id]
+        return [(TLorentzVector(phase_space.GetDecay(i)), mass, charge) for i, (mass, charge) in enumerate(zip(masses, charges))]
+
+    def decayPi0(self, p4):
+        self.Pi0Decay.SetDecay(p4, 2, self.Pi0Masses)
+        self.Pi0Decay.Generate()
+        return [TLorentzVector(self.Pi0Decay.GetDecay(i)) for i in range(2)]
+
+    def makeTrack(self, p4, mass, charge, z0):
+        rng = self.Rng
+        p, theta, phi = p4.P(), p4.Theta(), p4.Phi() % (2. * pi)
+        sigma_p, sigma_theta, sigma_phi = 0.02 * p + 2., 0.01, 0.005
+        e_kin = p4.E() - mass
+        energy = e_kin * rng.uniform(0.1, 0.7) if rng.random() < 0.3 else min(rng.gauss(30., 5.) / max(sin(theta), 0.3), e_kin)
+        energy_lxe = energy * rng.uniform(0.3, 0.7)
+        layers = split_layers(energy_lxe, rng)
+        cos_theta, sin_theta = cos(theta), sin(theta)
+        xyz_lxe = [R_LXE * cos(phi), R_LXE * sin(phi), z0 + R_LXE * cos_theta / sin_theta]
+        xyz_cl = [R_CSI * cos(phi), R_CSI * sin(phi), z0 + R_CSI * cos_theta / sin_theta]
+        dedx = get_dedx(p, mass, rng)
+        return {
+            "tnhit": max(5, int(rng.gauss(28. * min(1., 0.9 / sin_theta), 4.))),
+            "tlength": 30. / sin_theta,
+            "tphi": (phi + rng.gauss(0., sigma_phi)) % (2. * pi),
+            "tth": min(max(theta + rng.gauss(0., sigma_theta), 0.), pi),
+            "tptot": max(p + rng.gauss(0., sigma_p), 1.),
+            "tphiv": (phi + rng.gauss(0., sigma_phi / 2.)) % (2. * pi),
+            "tthv": min(max(theta + rng.gauss(0., sigma_theta / 2.), 0.), pi),
+            "tptotv": max(p + rng.gauss(0., sigma_p / 2.), 1.),
+            "trho": rng.gauss(0., 0.05),
+            "tdedx": dedx,
+            "tz": z0 + rng.gauss(0., 0.3),
+            "tchi2r": rng.gammavariate(1., 2.),
+            "tchi2z": rng.gammavariate(1., 2.),
+            "tchi2ndf": rng.gammavariate(2., 0.5),
+            "tt0": rng.gauss(0., 2.),
+            "tant": 0.,
+            "tcharge": charge,
+            "ten": energy,
+            "tfc": 1. if abs(cos_theta) < 0.8 else 0.,
+            "tenlxe": energy_lxe,
+            "tlengthlxe": 15. / sin_theta,
+            "tenslxe_layers": layers,
+            "tencsi": energy - energy_lxe,
+            "tenbgo": 0.,
+            "tclth": theta + rng.gauss(0., 0.02),
+            "tclphi": phi + rng.gauss(0., 0.02),
+            "terr": get_diagonal([sigma_p ** 2, sigma_theta ** 2, sigma_phi ** 2]),
+            "terr0": get_diagonal([sigma_p ** 2, sigma_theta ** 2, sigma_phi ** 2, 0.01, 0.09, 1e-4]),
+            "tindlxe": 0,
+            "txyzatcl": xyz_cl,
+            "txyzatlxe": xyz_lxe,
+            "tenconv": 0,
+            "ntlxelayers": sum(1 for layer in layers if layer > 0.5),
+            "tlxenhit": rng.randint(8, 40),
+            "tlxelength": 15. / sin_theta,
+            "tlxededx": dedx * rng.gauss(0.5, 0.05),
+            "tlxeir": R_LXE,
+            "tlxeitheta": theta + rng.gauss(0., 0.01),
+            "tlxeiphi": phi + rng.gauss(0., 0.01),
+            "tlxevtheta": theta + rng.gauss(0., 0.03),
+            "tlxevphi": phi + rng.gauss(0., 0.03),
+            "tlxechi2": rng.gammavariate(1., 2.),
+            "tlxesen": energy_lxe,
+            "tlxesen_layers": layers,
+        }
+
+    def makePhoton(self, energy, theta, phi):
+        rng = self.Rng
+        sigma_energy = energy * (0.03 + 0.03 / sqrt(max(energy, 1.) / 1000.))
+        phen = max(energy + rng.gauss(0., sigma_energy), 1.)
+        energy_lxe = phen * rng.uniform(0.3, 0.6)
+        return {
+            "phen": phen,
+            "phth": min(max(theta + rng.gauss(0., 0.01), 0.), pi),
+            "phphi": (phi + rng.gauss(0., 0.01)) % (2. * pi),
+            "phrho": R_LXE / sin(theta),
+            "phen0": phen * 0.92,
+            "phth0": theta,
+            "phphi0": phi,
+            "phlxe": energy_lxe,
+            "phslxe_layers": split_layers(energy_lxe, rng),
+            "pherr": [sigma_energy, 0.01, 0.01],
+            "phcsi": phen - energy_lxe,
+            "phbgo": 0.,
+            "phflag": 0,
+            "phconv": 0,
+            "phfc": 1 if abs(cos(theta)) < 0.8 else 0,
+        }
+
+    def isInAcceptance(self, theta, *, theta_min):
+        return theta_min < theta < pi - theta_min
+
+    def generateEntry(self, n_entry):
+        rng = self.Rng
+        finalstate_id = rng.choices(list(self.Fractions), weights = list(self.Fractions.values()))[0]
+        z0 = rng.gauss(0., 2.5)
+        tracks, photons = [], []
+        p_charged, p_neutral = TLorentzVector(), TLorentzVector()
+        for p4, mass, charge in self.generateFinalState(finalstate_id):
+            if charge == 0:
+                for p4_photon in self.decayPi0(p4):
+                    if p4_photon.E() < 20. or not self.isInAcceptance(p4_photon.Theta(), theta_min = 0.4): continue
+                    photons.append(self.makePhoton(p4_photon.E(), p4_photon.Theta(), p4_photon.Phi() % (2. * pi)))
+                    p_neutral += p4_photon
+            else:
+                ## Tracks are lost out of the drift chamber, at low momenta and by inefficiency
+                if p4.P() < 40. or not self.isInAcceptance(p4.Theta(), theta_min = 0.5) or rng.random() < 0.03: continue
+                tracks.append(self.makeTrack(p4, mass, charge, z0))
+                p_charged += p4
+
+        ## Soft fake photons: splitoffs of hadronic showers and beam background
+        for _ in range(min(int(rng.expovariate(1.)), 5)):
+            photons.append(self.makePhoton(rng.expovariate(1. / 15.) + 5., acos(rng.uniform(-0.9, 0.9)), rng.uniform(0., 2. * pi)))
+
+        tracks = tracks[:self.Variables["nt"].MaxValue]
+        photons = photons[:self.Variables["nph"].MaxValue]
+        for i, track in enumerate(tracks): track["tindlxe"] = i
+
+        values = {
+            "nt": len(tracks),
+            "ntlxe": len(tracks),
+            "nph": len(photons),
+            "emeas": self.Energy,
+            "demeas": 0.3 + 0.05 * rng.random(),
+            "xbeam": 0.05,
+            "ybeam": -0.02,
+            "runnum": self.RunNumber + n_entry // self.EntriesPerRun,
+            "evnum": n_entry % self.EntriesPerRun,
+            "ecaltot": sum(track["ten"] for track in tracks) + sum(photon["phen"] for photon in photons),
+            "ecalneu": sum(photon["phen"] for photon in photons),
+            "psumch": p_charged.P(),
+            "psumnu": p_neutral.P(),
+            "nt_total": len(tracks),
+            "nv_total": 1,
+            "ntlxe_total": len(tracks),
+            "finalstate_id": finalstate_id if self.IsMultihad else 0,
+            "nph_total": len(photons),
+        }
+        ## Sizes go first, variable-size arrays are checked against them
+        for name, value in values.items(): self.Variables[name].Content = value
+        for records in (tracks, photons):
+            if not records: continue ## empty arrays are not stored by the tree
+            for name in records[0]: self.Variables[name].Content = [record[name] for record in records]
+
+    def write(self, path, n_entries):
+        container = CMD3ContainerV9(path, self.Variables, "recreate")
+        for n_entry in range(n_entries):
+            self.generateEntry(n_entry)
+            container.fillEntry()
+        container.dumpToFile()
+        container.close()
+
+
+def get_generator(sample, energy, seed):
+    ## sim: signal only, data and multihad: signal and backgrounds, with finalstate_id for multihad
+    return SampleGenerator(
+        energy = energy,
+        fractions = {12: 1.} if sample == 'sim' else None,
+        is_multihad = sample in ('sim', 'multihad'),
+        seed = seed,
+    )
+
+
+def generate_point(directory, version, year, energy_point, n_entries, *, seed = 1, energy = None):
+    ## Multihadron-like tree of one energy point, i.e. an input of Scripts/prelim_cut.py with roots = {'multihadron': directory}
+    ## Beam energy is taken from the energy point label (e.g. '950') if not given
+    path = get_point_path(directory, 'multihad', version, year, energy_point)
+    get_generator('multihad', energy if energy else float(energy_point), seed).write(path, n_entries)
+    return path
+
+
+if __name__ == '__main__':
+    ##Parsing input arguments
+    parser = ArgumentParser(description = "Write a synthetic CMD-3 v9 tr_ph tree")
+    parser.add_argument('--output', help = 'Path of the tree, the multihadron path of the energy point in --directory otherwise')
+    parser.add_argument('--directory', default = '.', help = 'Directory of the multihadron-like tree')
+    parser.add_argument('--version', default = 'v9', choices = ['v9'], help = 'Version of CMD-3 data tree')
+    parser.add_argument('--year', default = '2019')
+    parser.add_argument('--elabel', default = '950', help = 'Energy point, also the beam energy in MeV unless --energy is given')
+    parser.add_argument('--energy', type = float, help = 'Beam energy, MeV')
+    parser.add_argument('--entries', type = int, default = 10000)
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--sample', choices = ['data', 'sim', 'multihad'], default = 'multihad', help = 'Event mixture of the tree written to --output')
+    args = parser.parse_args()
+
+    if args.output:
+        get_generator(args.sample, args.energy if args.energy else float(args.elabel), args.seed).write(args.output, args.entries)
+    else:
+        generate_point(args.directory, args.version, args.year, args.elabel, args.entries, seed = args.seed, energy = args.energy)
@@ -5,41 +5,137 @@ import json
 from argparse import ArgumentParser
 
 import os
-import subprocess
-from concurrent.futures import ProcessPoolExecutor, wait
+import shutil
+import asyncio
 
 from Analyses.KinfitAnalysis import KinfitAnalysis
+from Base.Pipeline import Task, Pipeline
+from Base.StageCache import BASE_SOURCES, hash_file
+from Base.Manifest import SAMPLE_PREFIXES, get_root, get_sample_name, get_point_path
 
-def process_single(version, year, energy_point, is_sim, is_multihad, kf_type):
-    input_dir = "/store11/idpershin/kpkmpippim/prelim_cuts_new"
-    output_dir = "/store11/idpershin/kpkmpippim/kinfit"
+def get_paths(version, year, energy_point, is_sim, is_multihad, kf_type, roots = None):
+    input_dir = get_root(roots, 'prelim_cut')
+    output_dir = get_root(roots, 'kinfit_analysis')
     if not os.path.exists(input_dir): raise OSError(f"Input directory does not exist: {input_dir}")
     if not os.path.exists(output_dir): raise OSError(f"Output directory does not exist: {output_dir}")
+    sample_name = get_sample_name(is_sim, is_multihad)
+    prefix = SAMPLE_PREFIXES[sample_name]
 
-    prefix = ''
-    if is_sim:
-        prefix = 'sim_'
-    elif is_multihad:
-        prefix = 'multihad_'
-
-    input_path = f"{input_dir}/{prefix}prelim_cut{year}_tr_ph_fc_e{energy_point}_{version}.root"
-    kinfit_2k2pi_path = f"{output_dir}/{prefix}kinfit_2k2pi_{kf_type.lower()}{year}_tr_ph_fc_e{energy_point}_{version}.root"
-    kinfit_4pi_path = f"{output_dir}/{prefix}kinfit_4pi{year}_tr_ph_fc_e{energy_point}_{version}.root"
-    hists_path = f"{output_dir}/{prefix}hists_{kf_type.lower()}{year}_tr_ph_fc_e{energy_point}_{version}.root"
-    log_path = f"{output_dir}/{prefix}{kf_type.lower()}_tr_ph_fc_y{year}_e{energy_point}_{version}_%s.log" % date.today().isoformat()
-    if not os.path.exists(input_path): raise OSError(f"Input path does not exist: {input_path}")
-
-    result = subprocess.run(["kpkmpippim-kinfit-2chk2chpi-exe", "--input-path", input_path, "--output-path", kinfit_2k2pi_path, "--kinfit-type", kf_type])
-    if result.returncode != 0: raise RuntimeError(f"kpkmpippim-kinfit-2chk2chpi-exe failed with code {result.returncode}")
-    result = subprocess.run(["kpkmpippim-kinfit-4chpi-exe", "--input-path", input_path, "--output-path", kinfit_4pi_path])
-    if result.returncode != 0: raise RuntimeError(f"kpkmpippim-kinfit-4chpi-exe failed with code {result.returncode}")
+    return {
+        'input': get_point_path(input_dir, 'prelim_cut', version, year, energy_point, sample_name),
+        'kinfit-2k2pi': get_point_path(output_dir, f'kinfit_2k2pi_{kf_type.lower()}', version, year, energy_point, sample_name),
+        'kinfit-4pi': get_point_path(output_dir, 'kinfit_4pi', version, year, energy_point, sample_name),
+        'hists': get_point_path(output_dir, f'hists_{kf_type.lower()}', version, year, energy_point, sample_name),
+        'log': f"{output_dir}/{prefix}{kf_type.lower()}_tr_ph_fc_y{year}_e{energy_point}_{version}_%s.log" % date.today().isoformat(),
+    }
+
+
+def get_executable_version(executable):
+    ## executable binary content identifies its version
+    executable_path = shutil.which(executable)
+    if not executable_path: raise OSError(f"Executable not found: {executable}")
+    return hash_file(executable_path)
+
+
+def get_record_path(output_path):
+    return f"{output_path}.kinfit.json"
+
+
+def is_kinfit_done(output_path, record):
+    if not os.path.exists(output_path) or not os.path.exists(get_record_path(output_path)): return False
+    with open(get_record_path(output_path), 'r') as file_record:
+        return json.load(file_record) == record
+
+
+async def run_kinfit(executable, input_path, output_path, input_hash, executable_version, kf_type = None):
+    ## skipping kinfit if its output has been produced from the same input by the same executable
+    record = {
+        'input-path': input_path,
+        'input-hash': input_hash,
+        'executable': executable,
+        'executable-version': executable_version,
+        'kinfit-type': kf_type,
+    }
+    if is_kinfit_done(output_path, record): return
+
+    args = ["--input-path", input_path, "--output-path", output_path]
+    if kf_type: args += ["--kinfit-type", kf_type]
+    process = await asyncio.create_subprocess_exec(executable, *args)
+    try:
+        returncode = await process.wait()
+    finally:
+        ## Cancelled because the other kinfit failed or the task was interrupted (e.g. by MemoryGuard):
+        ## the executable must not keep writing its output while the task is retried
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    if returncode != 0: raise RuntimeError(f"{executable} failed with code {returncode}")
+
+    with open(get_record_path(output_path), 'w') as file_record:
+        json.dump(record, file_record, indent = 2)
+
+
+async def run_kinfits(paths, kf_type):
+    ## the input and the executables are hashed in threads, once per task, so the event loop is not blocked
+    executable_2k2pi, executable_4pi = "kpkmpippim-kinfit-2chk2chpi-exe", "kpkmpippim-kinfit-4chpi-exe"
+    input_hash, version_2k2pi, version_4pi = await asyncio.gather(
+        asyncio.to_thread(hash_file, paths['input']),
+        asyncio.to_thread(get_executable_version, executable_2k2pi),
+        asyncio.to_thread(get_executable_version, executable_4pi),
+    )
+    await asyncio.gather(
+        run_kinfit(executable_2k2pi, paths['input'], paths['kinfit-2k2pi'], input_hash, version_2k2pi, kf_type),
+        run_kinfit(executable_4pi, paths['input'], paths['kinfit-4pi'], input_hash, version_4pi),
+    )
+
+
+def get_task(version, year, energy_point, is_sim, is_multihad, kf_type, kf_engine = "external", roots = None):
+    paths = get_paths(version, year, energy_point, is_sim, is_multihad, kf_type, roots)
+    sample_name = get_sample_name(is_sim, is_multihad)
+    ## kinfit outputs have their own records of the executables versions, see run_kinfit
+    return Task(
+        f"kinfit_analysis_{sample_name}_{version}_y{year}_e{energy_point}", process_single,
+        args = (version, year, energy_point, is_sim, is_multihad, kf_type, kf_engine),
+        kwargs = {'roots': roots},
+        inputs = [paths['input']],
+        outputs = [paths['hists']] + ([paths['kinfit-2k2pi'], paths['kinfit-4pi']] if kf_engine == "external" else []),
+        sources = BASE_SOURCES + [
+            "Scripts.kinfit_analysis", "Analyses.KinfitAnalysis", "Base.KinematicFit",
+            "Containers.PreliminaryContainer", "Containers.Kinfit2K2PiContainer", "Containers.Kinfit4PiContainer", "Containers.NativeKinfitContainer", "Base.ColumnCache",
+        ],
+        plan = {
+            'stage': 'kinfit_analysis', 'version': version, 'year': year, 'energy-point': energy_point, 'sample': sample_name,
+            'kinfit-type': kf_type, 'kinfit-engine': kf_engine,
+        },
+        cost_factor = 3.0, ## two kinematic fits and three loops over the input
+        is_io_bound = False,
+    )
+
+
+def process_single(version, year, energy_point, is_sim, is_multihad, kf_type, kf_engine = "external", roots = None):
+    paths = get_paths(version, year, energy_point, is_sim, is_multihad, kf_type, roots)
+    if not os.path.exists(paths['input']): raise OSError(f"Input path does not exist: {paths['input']}")
+
+    if kf_engine == "external":
+        asyncio.run(run_kinfits(paths, kf_type))
+    process_analysis(paths, is_multihad, kf_type, kf_engine)
+
+
+def process_analysis(paths, is_multihad, kf_type, kf_engine = "external"):
+    input_path, hists_path, log_path = paths['input'], paths['hists'], paths['log']
+    kinfit_2k2pi_path, kinfit_4pi_path = paths['kinfit-2k2pi'], paths['kinfit-4pi']
+    if kf_engine != "external":
+        ## kinfit is performed in-process by KinfitAnalysis
+        kinfit_2k2pi_path, kinfit_4pi_path = None, None
     
     analysis = KinfitAnalysis(
         input_path,
         kinfit_2k2pi_path,
         kinfit_4pi_path,
         hists_path,
-        log_path = log_path
+        log_path = log_path,
+        kinfit_type = kf_type,
+        kinfit_column_cache = kf_engine == "native-cached",
     )
     analysis.addHistogram('h_KpKmPipPimLklhd')
     analysis.addHistogram('h_TotalP_DeltaE')
@@ -113,53 +209,25 @@ def process_single(version, year, energy_point, is_sim, is_multihad, kf_type):
     analysis.close()
 
 
-def process_all(is_sim_included = True, is_multihad_included = True, kf_type = "DCLklhd"):
+def process_all(is_sim_included = True, is_multihad_included = True, kf_type = "DCLklhd", kf_engine = "external", max_workers = 10):
+    ## Energy points are tasks of a pipeline, the kinfit executables of a point run inside its task
     path_info = "/spoolA/idpershin/analysis/kpkmpippim/data_info_cmd3.json"
     with open(path_info, 'r') as file_info:
         json_info = json.load(file_info)
 
-    with ProcessPoolExecutor(max_workers = 10) as executor:
-        futures = []
-        for version in json_info:
-            for year in json_info[version]["years"]:
-                for elabel in json_info[version]["years"][year]["elabels"]:
-                    energy_point = json_info[version]["years"][year]["elabels"][elabel]["scan-energy-point"]
-
-                    futures.append(
-                        executor.submit(
-                            process_single,
-                            version,
-                            year,
-                            energy_point,
-                            is_sim = False, is_multihad = False,
-                            kf_type = kf_type,
-                        )
-                    )
-
-                    if is_sim_included:
-                        futures.append(
-                            executor.submit(
-                                process_single,
-                                version,
-                                year,
-                                energy_point,
-                                is_sim = True, is_multihad = False,
-                                kf_type = kf_type,
-                            )
-                        )
-   
-                    if is_multihad_included:
-                        futures.append(
-                            executor.submit(
-                                process_single,
-                                version,
-                                year,
-                                energy_point,
-                                is_sim = False, is_multihad = True,
-                                kf_type = kf_type,
-                            )
-                        )
-        wait(futures)
+    samples = [(False, False)]
+    if is_sim_included: samples.append((True, False))
+    if is_multihad_included: samples.append((False, True))
+    pipeline = Pipeline(max_workers = max_workers)
+    for version in json_info:
+        for year in json_info[version]["years"]:
+            for elabel in json_info[version]["years"][year]["elabels"]:
+                energy_point = json_info[version]["years"][year]["elabels"][elabel]["scan-energy-point"]
+                for is_sim, is_multihad in samples:
+                    pipeline.addTask(get_task(version, year, energy_point, is_sim, is_multihad, kf_type, kf_engine))
+    pipeline.run()
+    pipeline.close()
+    if pipeline.getTasks('failed'): raise RuntimeError(f"Failed tasks: {[task.Name for task in pipeline.getTasks('failed')]}")
     
     
 if __name__ == '__main__':
@@ -174,15 +242,18 @@ if __name__ == '__main__':
     parser_single.add_argument('--is-sim', action = 'store_true')
     parser_single.add_argument('--is-multihad', action = 'store_true')
     parser_single.add_argument('--kinfit-type', choices = ("Permut", "DCLklhd"), required = True)
+    parser_single.add_argument('--kinfit-engine', choices = ("external", "native", "native-cached"), default = "external", help = 'Run kinfit executables or fit in-process, native-cached reads fit inputs from a column cache of the input')
 
     parser_all = subparsers.add_parser('all', help = "Process all available energy points")
     parser_all.add_argument('--is-sim-included', action = 'store_true')
     parser_all.add_argument('--is-multihad-included', action = 'store_true')
     parser_all.add_argument('--kinfit-type', choices = ("Permut", "DCLklhd"), required = True)
+    parser_all.add_argument('--kinfit-engine', choices = ("external", "native", "native-cached"), default = "external", help = 'Run kinfit executables or fit in-process, native-cached reads fit inputs from a column cache of the input')
+    parser_all.add_argument('--jobs', type = int, default = 10, help = 'Number of energy points processed at the same time')
     args = parser.parse_args()
 
     if args.mode == 'single':
-        process_single(args.version, args.year, args.energy, args.is_sim, args.is_multihad, args.kinfit_type)
+        process_single(args.version, args.year, args.energy, args.is_sim, args.is_multihad, args.kinfit_type, args.kinfit_engine)
 
     if args.mode == 'all':
-        process_all(args.is_sim_included, args.is_multihad_included, args.kinfit_type)
+        process_all(args.is_sim_included, args.is_multihad_included, args.kinfit_type, args.kinfit_engine, args.jobs)
@@ -6,67 +6,36 @@ from argparse import ArgumentParser
 
 import os
 import subprocess
-from concurrent.futures import ProcessPoolExecutor, wait
 
 from Analyses.IntermediateAnalysis import IntermediateAnalysis
-
-def process_single(version, year, energy_point, is_sim, is_multihad):
-    input_dir = "/home/idpershin/analysis/kpkmpippim/prelim_cuts_new"
-    output_dir = "/home/idpershin/analysis/kpkmpippim/pershin_cut_w_TotalP-DeltaE-2"
-
-    prefix = ''
-    if is_sim:
-        prefix = 'sim_'
-    elif is_multihad:
-        prefix = 'multihad_'
-
+from Containers.PreliminaryContainer import PreliminaryContainer
+from Base.Pipeline import Task, Pipeline
+from Base.StageCache import BASE_SOURCES
+from Base.Manifest import get_root, get_sample_name, get_point_path
+
+FINAL_STATES = [12, 15, 29, 32] # 12 is for K+K-pi+pi-, 15 for K+KSpi-pi0, 29 for K+K-eta, 32 for K+K-omega
+
+def get_paths(version, year, energy_point, is_sim, is_multihad, roots = None):
+    input_dir = get_root(roots, 'prelim_cut')
+    output_dir = get_root(roots, 'pershin_cut_2')
+    sample_name = get_sample_name(is_sim, is_multihad)
+
+    paths = {
+        'input': get_point_path(input_dir, 'prelim_cut', version, year, energy_point, sample_name),
+        'hists': get_point_path(output_dir, 'hists', version, year, energy_point, sample_name),
+        'output': get_point_path(output_dir, 'cut', version, year, energy_point, sample_name),
+    }
     if is_multihad:
-        final_states = [12, 15, 29, 32] # 12 is for K+K-pi+pi-, 15 for K+KSpi-pi0, 29 for K+K-eta, 32 for K+K-omega
+        ## Final states before the selection are kept next to the preliminary outputs, after the selection next to the stage outputs
+        for final_state in FINAL_STATES:
+            paths[f'fs{final_state}-prelim-hists'] = get_point_path(input_dir, f'fs{final_state}_hists', version, year, energy_point, sample_name)
+            paths[f'fs{final_state}-prelim-output'] = get_point_path(input_dir, f'fs{final_state}_cut', version, year, energy_point, sample_name)
+            paths[f'fs{final_state}-hists'] = get_point_path(output_dir, f'fs{final_state}_hists', version, year, energy_point, sample_name)
+            paths[f'fs{final_state}-output'] = get_point_path(output_dir, f'fs{final_state}_cut', version, year, energy_point, sample_name)
+    return paths
 
-        input_dir = "/home/idpershin/analysis/kpkmpippim/prelim_cuts_new"
-            
-        for final_state in final_states:
-            input_path = f"{input_dir}/{prefix}prelim_cut{year}_tr_ph_fc_e{energy_point}_{version}.root"
-            hists_path = f"{input_dir}/{prefix}fs{final_state}_hists{year}_tr_ph_fc_e{energy_point}_{version}.root"
-            output_path = f"{input_dir}/{prefix}fs{final_state}_cut{year}_tr_ph_fc_e{energy_point}_{version}.root"
-
-            analysis = IntermediateAnalysis(
-                input_path,
-                analysis_path = hists_path,
-                output_path = output_path,
-            )
-            analysis.addCutNew(
-                f'finalstate-id_{final_state}',
-                lambda: analysis.Variables["finalstate_id"].Content != final_state
-            )
-            analysis.addHistogram('h_tptot_tdedx')
-            analysis.addHistogram('h_phen')
-            analysis.addHistogram('h_phth')
-            analysis.addHistogram('h_KpKmPipPimLklhd')
-            analysis.addHistogram('h_TotalP_DeltaE')
-            analysis.addHistogram('h_TotalP_DeltaEKKPiPi')
-            analysis.addHistogram('h_PiPiPiMissMass2')
-            analysis.addHistogram('h_KPiPiMissMass2')
-            analysis.addHistogram('h_PiPiPiPiMissMass2')
-            analysis.addHistogram('h_KPiPiPiMissMass2')
-            analysis.addHistogram('h_KKPiPiMissMass2')
-            analysis.addHistogram('h_KKMissMass')
-            analysis.addHistogram('h_PiPiMissMass')
-            analysis.loop()
-            analysis.dumpToFile()
-            analysis.close()
-
-    input_path = f"{input_dir}/{prefix}prelim_cut{year}_tr_ph_fc_e{energy_point}_{version}.root"
-    hists_path = f"{output_dir}/{prefix}hists{year}_tr_ph_fc_e{energy_point}_{version}.root"
-    output_path = f"{output_dir}/{prefix}cut{year}_tr_ph_fc_e{energy_point}_{version}.root"
-    if not os.path.exists(input_path): raise OSError(f"Input path does not exist: {input_path}")
-            
-    analysis = IntermediateAnalysis(
-        input_path,
-        analysis_path = hists_path,
-        output_path = output_path,
-    )
 
+def add_histograms(analysis):
     analysis.addHistogram('h_tptot_tdedx')
     analysis.addHistogram('h_phen')
     analysis.addHistogram('h_phth')
@@ -80,23 +49,72 @@ def process_single(version, year, energy_point, is_sim, is_multihad):
     analysis.addHistogram('h_KKPiPiMissMass2')
     analysis.addHistogram('h_KKMissMass')
     analysis.addHistogram('h_PiPiMissMass')
+
+
+def split_final_states(analysis, paths, name, *, skim = False, layout = None):
+    ## name: '' for the final states after the selection, 'prelim-' before it
+    analysis.splitBy(
+        "finalstate_id", FINAL_STATES,
+        analysis_paths = {
+            final_state: paths[f'fs{final_state}-{name}hists'] for final_state in FINAL_STATES
+        },
+        output_containers = {
+            final_state: [PreliminaryContainer(
+                paths[f'fs{final_state}-{name}output'], "recreate", analysis.Variables,
+                drop = analysis.InputContainers[0].MissingBranches, parent = analysis.InputContainers[0] if skim else None, layout = layout,
+            )]
+            for final_state in FINAL_STATES
+        },
+    )
+
+
+def get_task(version, year, energy_point, is_sim, is_multihad, roots = None, skim = False, layout = None):
+    paths = get_paths(version, year, energy_point, is_sim, is_multihad, roots)
+    sample_name = get_sample_name(is_sim, is_multihad)
+    return Task(
+        f"pershin_cut_2_{sample_name}_{version}_y{year}_e{energy_point}", process_single,
+        args = (version, year, energy_point, is_sim, is_multihad),
+        kwargs = {'roots': roots, 'skim': skim, 'layout': layout},
+        inputs = [paths['input']],
+        outputs = [path for name, path in paths.items() if name != 'input'],
+        sources = BASE_SOURCES + ["Scripts.pershin_cut_2", "Analyses.IntermediateAnalysis", "Containers.PreliminaryContainer"],
+        plan = {'stage': 'pershin_cut_2', 'version': version, 'year': year, 'energy-point': energy_point, 'sample': sample_name, 'skim': skim, 'layout': layout},
+    )
+
+
+def process_single(version, year, energy_point, is_sim, is_multihad, roots = None, skim = False, layout = None):
+    paths = get_paths(version, year, energy_point, is_sim, is_multihad, roots)
+    input_path = paths['input']
+    hists_path = paths['hists']
+    output_path = paths['output']
+    if not os.path.exists(input_path): raise OSError(f"Input path does not exist: {input_path}")
+
+    if is_multihad:
+        ## final states of the preliminary output before any selection, all of them in one pass
+        analysis = IntermediateAnalysis(input_path)
+        split_final_states(analysis, paths, 'prelim-', skim = skim, layout = layout)
+        add_histograms(analysis)
+        analysis.loop()
+        analysis.dumpToFile()
+        analysis.close()
+            
+    analysis = IntermediateAnalysis(
+        input_path,
+        analysis_path = hists_path,
+        output_path = output_path,
+        output_skim = skim,
+        output_layout = layout,
+    )
+    if is_multihad:
+        ## final states are selected in the same pass as the inclusive selection
+        split_final_states(analysis, paths, '', skim = skim, layout = layout)
+
+    add_histograms(analysis)
     if is_multihad: analysis.addHistogram('h_finalstate_id')
     analysis.loop()
             
     analysis.addCut('KpKmPipPimLklhd')
-    analysis.addHistogram('h_tptot_tdedx')
-    analysis.addHistogram('h_phen')
-    analysis.addHistogram('h_phth')
-    analysis.addHistogram('h_KpKmPipPimLklhd')
-    analysis.addHistogram('h_TotalP_DeltaE')
-    analysis.addHistogram('h_TotalP_DeltaEKKPiPi')
-    analysis.addHistogram('h_PiPiPiMissMass2')
-    analysis.addHistogram('h_KPiPiMissMass2')
-    analysis.addHistogram('h_PiPiPiPiMissMass2')
-    analysis.addHistogram('h_KPiPiPiMissMass2')
-    analysis.addHistogram('h_KKPiPiMissMass2')
-    analysis.addHistogram('h_KKMissMass')
-    analysis.addHistogram('h_PiPiMissMass')
+    add_histograms(analysis)
     if is_multihad: analysis.addHistogram('h_finalstate_id')
     analysis.loop()
 
@@ -104,107 +122,36 @@ def process_single(version, year, energy_point, is_sim, is_multihad):
         'TotalP-DeltaE-2',
         lambda: analysis.Variables["DeltaE"].Content > -200. - 1.8 * analysis.Variables["TotalP"].Content
     )
-    analysis.addHistogram('h_tptot_tdedx')
-    analysis.addHistogram('h_phen')
-    analysis.addHistogram('h_phth')
-    analysis.addHistogram('h_KpKmPipPimLklhd')
-    analysis.addHistogram('h_TotalP_DeltaE')
-    analysis.addHistogram('h_TotalP_DeltaEKKPiPi')
-    analysis.addHistogram('h_PiPiPiMissMass2')
-    analysis.addHistogram('h_KPiPiMissMass2')
-    analysis.addHistogram('h_PiPiPiPiMissMass2')
-    analysis.addHistogram('h_KPiPiPiMissMass2')
-    analysis.addHistogram('h_KKPiPiMissMass2')
-    analysis.addHistogram('h_KKMissMass')
-    analysis.addHistogram('h_PiPiMissMass')
+    add_histograms(analysis)
     if is_multihad: analysis.addHistogram('h_finalstate_id')
     analysis.loop()
     
     analysis.dumpToFile()
     analysis.close()
 
-    if is_multihad:
-        final_states = [12, 15, 29, 32] # 12 is for K+K-pi+pi-, 15 for K+KSpi-pi0, 29 for K+K-eta, 32 for K+K-omega
-        
-        input_dir = "/home/idpershin/analysis/kpkmpippim/pershin_cut_w_TotalP-DeltaE-2"
-            
-        for final_state in final_states:
-            input_path = f"{input_dir}/{prefix}cut{year}_tr_ph_fc_e{energy_point}_{version}.root"
-            hists_path = f"{output_dir}/{prefix}fs{final_state}_hists{year}_tr_ph_fc_e{energy_point}_{version}.root"
-            output_path = f"{output_dir}/{prefix}fs{final_state}_cut{year}_tr_ph_fc_e{energy_point}_{version}.root"
-
-            analysis = IntermediateAnalysis(
-                input_path,
-                analysis_path = hists_path,
-                output_path = output_path,
-            )
-            analysis.addCutNew(
-                f'finalstate-id_{final_state}',
-                lambda: analysis.Variables["finalstate_id"].Content != final_state
-            )
-            analysis.addHistogram('h_tptot_tdedx')
-            analysis.addHistogram('h_phen')
-            analysis.addHistogram('h_phth')
-            analysis.addHistogram('h_KpKmPipPimLklhd')
-            analysis.addHistogram('h_TotalP_DeltaE')
-            analysis.addHistogram('h_TotalP_DeltaEKKPiPi')
-            analysis.addHistogram('h_PiPiPiMissMass2')
-            analysis.addHistogram('h_KPiPiMissMass2')
-            analysis.addHistogram('h_PiPiPiPiMissMass2')
-            analysis.addHistogram('h_KPiPiPiMissMass2')
-            analysis.addHistogram('h_KKPiPiMissMass2')
-            analysis.addHistogram('h_KKMissMass')
-            analysis.addHistogram('h_PiPiMissMass')
-            analysis.loop()
-            analysis.dumpToFile()
-            analysis.close()
-
-
-def process_all(is_sim_included = True, is_multihad_included = True):
+
+def process_all(is_sim_included = True, is_multihad_included = True, is_forced = False, report_path = None, failed_report_path = None, skim = False):
     path_info = "/home/idpershin/analysis/kpkmpippim/data_info_cmd3.json"
     with open(path_info, 'r') as file_info:
         json_info = json.load(file_info)
 
-    with ProcessPoolExecutor(max_workers = 10) as executor:
-        futures = []
-        for version in json_info:
-            for year in json_info[version]["years"]:
-                for elabel in json_info[version]["years"][year]["elabels"]:
-                    elabel_data = json_info[version]["years"][year]["elabels"][elabel]
-                    energy_point = elabel_data["scan-energy-point"]
-
-                    futures.append(
-                        executor.submit(
-                            process_single,
-                            version,
-                            year,
-                            energy_point,
-                            is_sim = False, is_multihad = False
-                        )
-                    )
-
-                    if is_sim_included:
-                        futures.append(
-                            executor.submit(
-                                process_single,
-                                version,
-                                year,
-                                energy_point,
-                                is_sim = True, is_multihad = False
-                            )
-                        )
-   
-                    if is_multihad_included:
-                        futures.append(
-                            executor.submit(
-                                process_single,
-                                version,
-                                year,
-                                energy_point,
-                                is_sim = False, is_multihad = True
-                            )
-                        )
-        wait(futures)
+    ## energy points with up-to-date outputs are skipped, see StageCache
+    pipeline = Pipeline(max_workers = 10, is_forced = is_forced, report_path = report_path)
+    for version in json_info:
+        for year in json_info[version]["years"]:
+            for elabel in json_info[version]["years"][year]["elabels"]:
+                elabel_data = json_info[version]["years"][year]["elabels"][elabel]
+                energy_point = elabel_data["scan-energy-point"]
+
+                pipeline.addTask(get_task(version, year, energy_point, is_sim = False, is_multihad = False, skim = skim))
+                if is_sim_included:
+                    pipeline.addTask(get_task(version, year, energy_point, is_sim = True, is_multihad = False, skim = skim))
+                if is_multihad_included:
+                    pipeline.addTask(get_task(version, year, energy_point, is_sim = False, is_multihad = True, skim = skim))
+    ## failed_report_path: report of a previous run, only its failed energy points are reprocessed
+    pipeline.run(Pipeline.loadFailedTasks(failed_report_path) if failed_report_path else None)
+    pipeline.close()
+    if pipeline.getTasks('failed'): raise RuntimeError(f"Failed tasks: {[task.Name for task in pipeline.getTasks('failed')]}")
     
     
 if __name__ == '__main__':
@@ -218,14 +165,19 @@ if __name__ == '__main__':
     parser_single.add_argument('--energy', required = True)
     parser_single.add_argument('--is-sim', action = 'store_true')
     parser_single.add_argument('--is-multihad', action = 'store_true')
+    parser_single.add_argument('--skim', action = 'store_true', help = 'Write outputs as skims of the input: entry numbers and new branches only')
 
     parser_all = subparsers.add_parser('all', help = "Process all available energy points")
     parser_all.add_argument('--is-sim-included', action = 'store_true')
     parser_all.add_argument('--is-multihad-included', action = 'store_true')
+    parser_all.add_argument('--force', action = 'store_true', help = 'Reprocess energy points with up-to-date outputs')
+    parser_all.add_argument('--report', help = 'Path of JSON report with status, wall time and traceback of every energy point')
+    parser_all.add_argument('--rerun-failed', help = 'Path of JSON report of a previous run, only its failed energy points are reprocessed')
+    parser_all.add_argument('--skim', action = 'store_true', help = 'Write outputs as skims of the input: entry numbers and new branches only')
     args = parser.parse_args()
 
     if args.mode == 'single':
-        process_single(args.version, args.year, args.energy, args.is_sim, args.is_multihad)
+        process_single(args.version, args.year, args.energy, args.is_sim, args.is_multihad, skim = args.skim)
 
     if args.mode == 'all':
-        process_all(args.is_sim_included, args.is_multihad_included)
+        process_all(args.is_sim_included, args.is_multihad_included, args.force, args.report, args.rerun_failed, skim = args.skim)
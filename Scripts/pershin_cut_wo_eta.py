@@ -6,23 +6,43 @@ from argparse import ArgumentParser
 
 import os
 import subprocess
-from concurrent.futures import ProcessPoolExecutor, wait
 
 from Analyses.IntermediateAnalysis import IntermediateAnalysis
+from Base.Pipeline import Task, Pipeline
+from Base.StageCache import BASE_SOURCES
+from Base.Manifest import get_root, get_sample_name, get_point_path
+
+def get_paths(version, year, energy_point, is_sim, is_multihad, roots = None):
+    input_dir = get_root(roots, 'pershin_cut_2')
+    output_dir = get_root(roots, 'pershin_cut_wo_eta')
+    sample_name = get_sample_name(is_sim, is_multihad)
+
+    return {
+        'input': get_point_path(input_dir, 'cut', version, year, energy_point, sample_name),
+        'hists': get_point_path(output_dir, 'hists', version, year, energy_point, sample_name),
+        'output': get_point_path(output_dir, 'cut', version, year, energy_point, sample_name),
+    }
+
+
+def get_task(version, year, energy_point, is_sim, is_multihad, roots = None):
+    paths = get_paths(version, year, energy_point, is_sim, is_multihad, roots)
+    sample_name = get_sample_name(is_sim, is_multihad)
+    return Task(
+        f"pershin_cut_wo_eta_{sample_name}_{version}_y{year}_e{energy_point}", process_single,
+        args = (version, year, energy_point, is_sim, is_multihad),
+        kwargs = {'roots': roots},
+        inputs = [paths['input']],
+        outputs = [paths['hists'], paths['output']],
+        sources = BASE_SOURCES + ["Scripts.pershin_cut_wo_eta", "Analyses.IntermediateAnalysis", "Containers.PreliminaryContainer"],
+        plan = {'stage': 'pershin_cut_wo_eta', 'version': version, 'year': year, 'energy-point': energy_point, 'sample': sample_name},
+    )
 
-def process_single(version, year, energy_point, is_sim, is_multihad):
-    input_dir = "/store11/idpershin/kpkmpippim/pershin_cut_w_TotalP-DeltaE-2"
-    output_dir = "/store11/idpershin/kpkmpippim/pershin_cut_w_TotalP-DeltaE-2_wo_eta"
-
-    prefix = ''
-    if is_sim:
-        prefix = 'sim_'
-    elif is_multihad:
-        prefix = 'multihad_'
 
-    input_path = f"{input_dir}/{prefix}cut{year}_tr_ph_fc_e{energy_point}_{version}.root"
-    hists_path = f"{output_dir}/{prefix}hists{year}_tr_ph_fc_e{energy_point}_{version}.root"
-    output_path = f"{output_dir}/{prefix}cut{year}_tr_ph_fc_e{energy_point}_{version}.root"
+def process_single(version, year, energy_point, is_sim, is_multihad, roots = None):
+    paths = get_paths(version, year, energy_point, is_sim, is_multihad, roots)
+    input_path = paths['input']
+    hists_path = paths['hists']
+    output_path = paths['output']
     if not os.path.exists(input_path): raise OSError(f"Input path does not exist: {input_path}")
 
     analysis = IntermediateAnalysis(
@@ -59,46 +79,21 @@ def process_all(is_sim_included = True, is_multihad_included = True):
     with open(path_info, 'r') as file_info:
         json_info = json.load(file_info)
 
-    with ProcessPoolExecutor(max_workers = 10) as executor:
-        futures = []
-        for version in json_info:
-            for year in json_info[version]["years"]:
-                for elabel in json_info[version]["years"][year]["elabels"]:
-                    elabel_data = json_info[version]["years"][year]["elabels"][elabel]
-                    energy_point = elabel_data["scan-energy-point"]
-
-                    futures.append(
-                        executor.submit(
-                            process_single,
-                            version,
-                            year,
-                            energy_point,
-                            is_sim = False, is_multihad = False
-                        )
-                    )
-
-                    if is_sim_included:
-                        futures.append(
-                            executor.submit(
-                                process_single,
-                                version,
-                                year,
-                                energy_point,
-                                is_sim = True, is_multihad = False
-                            )
-                        )
-   
-                    if is_multihad_included:
-                        futures.append(
-                            executor.submit(
-                                process_single,
-                                version,
-                                year,
-                                energy_point,
-                                is_sim = False, is_multihad = True
-                            )
-                        )
-        wait(futures)
+    pipeline = Pipeline(max_workers = 10)
+    for version in json_info:
+        for year in json_info[version]["years"]:
+            for elabel in json_info[version]["years"][year]["elabels"]:
+                elabel_data = json_info[version]["years"][year]["elabels"][elabel]
+                energy_point = elabel_data["scan-energy-point"]
+
+                pipeline.addTask(get_task(version, year, energy_point, is_sim = False, is_multihad = False))
+                if is_sim_included:
+                    pipeline.addTask(get_task(version, year, energy_point, is_sim = True, is_multihad = False))
+                if is_multihad_included:
+                    pipeline.addTask(get_task(version, year, energy_point, is_sim = False, is_multihad = True))
+    pipeline.run()
+    pipeline.close()
+    if pipeline.getTasks('failed'): raise RuntimeError(f"Failed tasks: {[task.Name for task in pipeline.getTasks('failed')]}")
     
     
 if __name__ == '__main__':
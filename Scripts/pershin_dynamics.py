@@ -5,22 +5,45 @@ import json
 from argparse import ArgumentParser
 
 import os
-from concurrent.futures import ProcessPoolExecutor, wait
 
 from Analyses.DynamicsAnalysis import DynamicsAnalysis
+from Base.Pipeline import Task, Pipeline
+from Base.StageCache import BASE_SOURCES
+from Base.Manifest import get_root, get_sample_name, get_point_path
+
+def get_paths(version, year, energy_point, is_sim, roots = None):
+    input_dir = get_root(roots, 'final_cut')
+    hists_dir = get_root(roots, 'pershin_dynamics')
+    sample_name = get_sample_name(is_sim)
+
+    return {
+        'input': get_point_path(input_dir, 'final_cut', version, year, energy_point, sample_name),
+        'hists': get_point_path(hists_dir, 'dynamics', version, year, energy_point, sample_name),
+    }
+
+
+def get_task(version, year, energy_point, is_sim, roots = None):
+    paths = get_paths(version, year, energy_point, is_sim, roots)
+    sample_name = get_sample_name(is_sim)
+    return Task(
+        f"pershin_dynamics_{sample_name}_{version}_y{year}_e{energy_point}", process_single,
+        args = (version, year, energy_point, is_sim),
+        kwargs = {'roots': roots},
+        inputs = [paths['input']],
+        outputs = [paths['hists']],
+        sources = BASE_SOURCES + ["Scripts.pershin_dynamics", "Analyses.DynamicsAnalysis", "Containers.FinalContainer"],
+        plan = {'stage': 'pershin_dynamics', 'version': version, 'year': year, 'energy-point': energy_point, 'sample': sample_name},
+    )
+
 
-def process_single(version, year, energy_point, is_sim):
-    input_dir = "/store11/idpershin/kpkmpippim/final_cuts_new"
-    hists_dir = "/store11/idpershin/kpkmpippim/dynamics/pershin"
+def process_single(version, year, energy_point, is_sim, roots = None):
+    paths = get_paths(version, year, energy_point, is_sim, roots)
+    input_dir, hists_dir = os.path.dirname(paths['input']), os.path.dirname(paths['hists'])
     if not os.path.exists(input_dir): raise OSError(f"Input directory does not exist: {input_dir}")
     if not os.path.exists(hists_dir): raise OSError(f"Histograms directory does not exist: {hists_dir}")
 
-    prefix = ''
-    if is_sim:
-        prefix = 'sim_'
-
-    input_path = f"{input_dir}/{prefix}final_cut{year}_tr_ph_fc_e{energy_point}_{version}.root"
-    hists_path = f"{hists_dir}/{prefix}dynamics{year}_tr_ph_fc_e{energy_point}_{version}.root"
+    input_path = paths['input']
+    hists_path = paths['hists']
     if not os.path.exists(input_path): raise OSError(f"Input path does not exist: {input_path}")
 
     dynamics_analysis = DynamicsAnalysis(
@@ -43,34 +66,18 @@ def process_all(is_sim_included = True):
     with open(path_info, 'r') as file_info:
         json_info = json.load(file_info)
         
-    with ProcessPoolExecutor(max_workers = 8) as executor:
-        futures = []
-        for version in json_info:
-            for year in json_info[version]:
-                for elabel in json_info[version][year]["elabels"]:
-                    energy_point = json_info[version][year]["elabels"][elabel]["scan-energy-point"]
-
-                    futures.append(
-                        executor.submit(
-                            process_single,
-                            version,
-                            year,
-                            energy_point,
-                            is_sim = False
-                        )
-                    )
-
-                    if is_sim_included:
-                        futures.append(
-                            executor.submit(
-                                process_single,
-                                version,
-                                year,
-                                energy_point,
-                                is_sim = True
-                            )
-                        )
-        wait(futures)
+    pipeline = Pipeline(max_workers = 8)
+    for version in json_info:
+        for year in json_info[version]:
+            for elabel in json_info[version][year]["elabels"]:
+                energy_point = json_info[version][year]["elabels"][elabel]["scan-energy-point"]
+
+                pipeline.addTask(get_task(version, year, energy_point, is_sim = False))
+                if is_sim_included:
+                    pipeline.addTask(get_task(version, year, energy_point, is_sim = True))
+    pipeline.run()
+    pipeline.close()
+    if pipeline.getTasks('failed'): raise RuntimeError(f"Failed tasks: {[task.Name for task in pipeline.getTasks('failed')]}")
 
     
 if __name__ == '__main__':
@@ -0,0 +1,220 @@
+from datetime import date
+
+import json
+
+from argparse import ArgumentParser
+
+import os
+from fnmatch import fnmatch
+from functools import partial
+
+from Base.Pipeline import Pipeline, measure_read_bandwidth, get_volume_limits
+from Base.WorkerPool import WorkerPool
+from Base.WorkQueue import WorkQueueExecutor
+from Base.MemoryGuard import MemoryHistory
+from Base.Manifest import Manifest
+from Base.CostModel import CostModel, estimate_run
+
+from Scripts import prelim_cut
+from Scripts import pershin_cut
+from Scripts import pershin_cut_2
+from Scripts import pershin_cut_wo_eta
+from Scripts import kinfit_analysis
+from Scripts import pershin_dynamics
+import kkpipimissmass_fit
+
+def add_point_tasks(pipeline, manifest, version, year, elabel_data):
+    energy_point = elabel_data["scan-energy-point"]
+    roots = manifest.Roots
+
+    for sample in manifest.Samples:
+        is_sim, is_multihad = sample == 'sim', sample == 'multihad'
+        if manifest.hasStage('prelim_cut') and is_multihad:
+            pipeline.addTask(prelim_cut.get_task(version, year, energy_point, roots, slim = manifest.IsSlim, layout = manifest.OutputLayout))
+        if manifest.hasStage('pershin_cut'):
+            pipeline.addTask(pershin_cut.get_task(version, year, energy_point, is_sim, is_multihad, roots))
+        if manifest.hasStage('pershin_cut_2'):
+            pipeline.addTask(pershin_cut_2.get_task(version, year, energy_point, is_sim, is_multihad, roots, skim = manifest.IsSkim, layout = manifest.OutputLayout))
+        if manifest.hasStage('pershin_cut_wo_eta'):
+            pipeline.addTask(pershin_cut_wo_eta.get_task(version, year, energy_point, is_sim, is_multihad, roots))
+        if manifest.hasStage('kinfit_analysis'):
+            pipeline.addTask(kinfit_analysis.get_task(version, year, energy_point, is_sim, is_multihad, manifest.KinfitType, manifest.KinfitEngine, roots))
+        if manifest.hasStage('pershin_dynamics') and not is_multihad:
+            pipeline.addTask(pershin_dynamics.get_task(version, year, energy_point, is_sim, roots))
+    if manifest.hasStage('kkpipimissmass_fit') and manifest.hasSample('data'):
+        pipeline.addTask(kkpipimissmass_fit.get_task(version, year, elabel_data, roots))
+
+
+def parse_volume_options(options):
+    ## ['/store11=3', ...] -> {'/store11': 3.0, ...}
+    return {prefix: float(value) for prefix, value in (option.rsplit('=', 1) for option in options)}
+
+
+def measure_volume_limits(pipeline, volumes, task_bandwidth):
+    ## Read bandwidth of every volume is measured on the biggest existing input of the pipeline tasks on it
+    volume_bandwidths = {}
+    for volume in volumes:
+        inputs = [
+            path for task in pipeline.Tasks.values() for path in task.Inputs
+            if path.startswith(volume.rstrip('/') + '/') and os.path.exists(path)
+        ]
+        if not inputs: continue
+        volume_bandwidths[volume] = measure_read_bandwidth(max(inputs, key = os.path.getsize))
+        pipeline.Logger.info(f"Volume '{volume}': {volume_bandwidths[volume]:.0f} MB/s")
+    return get_volume_limits(volume_bandwidths, task_bandwidth)
+
+
+def build_pipeline(
+        manifest, json_info, fit_data, max_workers,
+        is_forced = False, worker_memory_limit = None, volume_limits = None, memory_budget = None,
+        queue_dir = None, profile_dir = None, profile_rate = None, is_timed = False, metrics_dir = None, report_path = None, log_path = None
+):
+    ## Workers with ROOT and the dE/dx library preloaded take many tasks, they are recycled after exceeding the memory limit
+    ## Tasks are admitted by memory predicted from peaks of the previous runs, see MemoryHistory
+    ## With queue_dir tasks are run by workers of several hosts started with Scripts/pipeline_worker.py
+    executor_factory = partial(WorkerPool, memory_limit = worker_memory_limit) if worker_memory_limit else None
+    if queue_dir: executor_factory = partial(WorkQueueExecutor, queue_dir)
+    pipeline = Pipeline(
+        max_workers = max_workers, is_forced = is_forced, executor_factory = executor_factory, volume_limits = volume_limits,
+        memory_budget = memory_budget, memory_history = MemoryHistory(f"{manifest.WorkDir}/pipeline_memory.json"),
+        profile_dir = profile_dir, profile_rate = profile_rate, is_timed = is_timed, metrics_dir = metrics_dir,
+        report_path = report_path, logpath = log_path
+    )
+    for version, year, elabel in manifest.getPoints(json_info):
+        elabel_data = fit_data[version]["years"][year]["elabels"][elabel]
+        add_point_tasks(pipeline, manifest, version, year, elabel_data)
+    return pipeline
+
+
+def select_tasks(pipeline, only = None, failed_report_path = None, resume_report_path = None):
+    ## only: glob patterns of task names, e.g. 'kinfit_analysis_sim_*'
+    ## failed_report_path: report of a previous run, only its failed tasks are rerun
+    ## resume_report_path: report of an interrupted run, its done tasks are not checked again
+    if not (only or failed_report_path or resume_report_path): return None
+    task_names = list(pipeline.Tasks)
+    if only:
+        task_names = [name for name in task_names if any(fnmatch(name, pattern) for pattern in only)]
+    if failed_report_path:
+        failed_tasks = set(Pipeline.loadFailedTasks(failed_report_path))
+        task_names = [name for name in task_names if name in failed_tasks]
+    if resume_report_path and os.path.exists(resume_report_path):
+        done_tasks = set(Pipeline.loadReportTasks(resume_report_path, ('done',)))
+        task_names = [name for name in task_names if name not in done_tasks]
+    return task_names
+
+
+def run_pipeline(pipeline, fit_data, task_names = None, cost_model = None):
+    ## Throughput of the run tasks calibrates the estimates of the next dry runs
+    results = pipeline.run(task_names)
+    if cost_model:
+        cost_model.addRun(pipeline)
+        cost_model.save()
+    pipeline.close()
+
+    ## Merging missing mass fit results of every energy point into the fit data
+    for version in fit_data:
+        for year in fit_data[version]["years"]:
+            for elabel, elabel_data in fit_data[version]["years"][year]["elabels"].items():
+                task_name = f"kkpipimissmass_fit_{version}_y{year}_e{elabel_data['scan-energy-point']}"
+                if task_name in results: elabel_data.update(results[task_name])
+
+    failed_tasks = pipeline.getTasks('failed')
+    if failed_tasks: raise RuntimeError(f"{len(failed_tasks)} tasks failed: {[task.Name for task in failed_tasks]}")
+
+
+if __name__ == '__main__':
+    ##Parsing input arguments
+    parser = ArgumentParser()
+    parser.add_argument('--manifest', help = 'JSON run manifest: samples, stages, points, output roots, see Base/Manifest.py')
+    parser.add_argument('--is-sim-included', action = 'store_true')
+    parser.add_argument('--is-multihad-included', action = 'store_true')
+    parser.add_argument('--kinfit-type', choices = ("Permut", "DCLklhd"))
+    parser.add_argument('--kinfit-engine', choices = ("external", "native", "native-cached"), default = "external", help = 'Run kinfit executables or fit in-process, native-cached reads fit inputs from a column cache of the input')
+    parser.add_argument('--slim', action = 'store_true', help = 'Drop the branches not read by later stages from preliminary outputs, needs a native kinfit engine')
+    parser.add_argument('--skim', action = 'store_true', help = 'Write pershin_cut_2 outputs as skims referencing their inputs')
+    parser.add_argument('--jobs', '--max-workers', dest = 'max_workers', type = int, default = 10, help = 'Number of worker processes shared by all stages')
+    parser.add_argument('--only', action = 'append', default = [], help = 'Glob pattern of task names to run, e.g. "kinfit_analysis_*_y2019_*"')
+    parser.add_argument('--resume', action = 'store_true', help = 'Skip tasks done in the previous run of the manifest without checking their records')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'Only list the tasks that would be run with predicted wall time and memory')
+    parser.add_argument('--calibrate', action = 'store_true', help = 'Rerun the selected tasks (e.g. --only of one energy point) to measure throughput of their stages')
+    parser.add_argument('--profile', action = 'store_true', help = 'Save cProfile statistics of every task to <work dir>/profiles')
+    parser.add_argument('--profile-rate', type = float, help = 'HZ: sample stacks of every task instead of cProfile, folded stacks for flame graphs are saved to <work dir>/profiles/<task>.folded')
+    parser.add_argument('--timing', action = 'store_true', help = 'Time cuts, TriggerVariable functions, histograms and I/O in analysis loops, saved to the "timing" string of every analysis file')
+    parser.add_argument('--metrics', action = 'store_true', help = 'Append progress records of analysis loops to <work dir>/metrics/<task>.metrics.jsonl')
+    parser.add_argument('--force', action = 'store_true', help = 'Rerun stages whose outputs are up to date')
+    parser.add_argument('--worker-memory-limit', type = float, default = 4., help = 'Memory in GB after which a long-lived worker is recycled, 0 starts a fresh process pool instead')
+    parser.add_argument('--rerun-failed', help = 'Path of JSON report of a previous run, only its failed tasks are rerun')
+    parser.add_argument('--volume-limit', action = 'append', default = [], help = 'PREFIX=N: at most N reading tasks on the volume at the same time, e.g. /store11=3')
+    parser.add_argument('--volume-bandwidth', action = 'append', default = [], help = 'PREFIX=MBPS: read bandwidth of the volume, limit is derived with --task-bandwidth')
+    parser.add_argument('--measure-volumes', action = 'append', default = [], help = 'PREFIX: measure read bandwidth of the volume before the run')
+    parser.add_argument('--task-bandwidth', type = float, default = 100., help = 'MB/s read by one I/O-bound task')
+    parser.add_argument('--queue-dir', help = 'Directory of the work queue shared by hosts running Scripts/pipeline_worker.py, --jobs is then their total number')
+    parser.add_argument('--memory-budget', type = float, default = 0., help = 'Memory in GB shared by the running tasks, 0 disables memory admission')
+    subparsers = parser.add_subparsers(dest = 'mode')
+
+    parser_single = subparsers.add_parser('single', help = "Process all stages of one energy point")
+    parser_single.add_argument('--version', default = 'v9', choices = ['v9'], help = 'Version of CMD-3 data tree')
+    parser_single.add_argument('--year', choices = ['2019', '2020', '2021', '2022', '2023'], required = True)
+    parser_single.add_argument('--elabel', required = True)
+
+    parser_all = subparsers.add_parser('all', help = "Process all stages of all available energy points")
+    args = parser.parse_args()
+
+    if args.manifest:
+        manifest = Manifest.load(args.manifest)
+    else:
+        ## Manifest of the command line options
+        if not args.kinfit_type: parser.error("--kinfit-type is required without --manifest")
+        manifest = Manifest({
+            "info": "/spoolA/idpershin/analysis/kpkmpippim/data_info_cmd3.json",
+            "fit-data": "/home/idpershin/analysis/kpkmpippim/data_kkpipimissmass_fit.json",
+            "points": {args.version: {args.year: [args.elabel]}} if args.mode == 'single' else None,
+            "samples": ["data"] + (["sim"] if args.is_sim_included else []) + (["multihad"] if args.is_multihad_included else []),
+            "kinfit-type": args.kinfit_type,
+            "kinfit-engine": args.kinfit_engine,
+            "slim": args.slim,
+            "skim": args.skim,
+            "work-dir": "/spoolA/idpershin/analysis/kpkmpippim",
+        })
+
+    with open(manifest.InfoPath, 'r') as file_info:
+        json_info = json.load(file_info)
+    with open(manifest.FitDataPath, 'r') as file_fit_data:
+        fit_data = json.load(file_fit_data)
+
+    log_path = f"{manifest.WorkDir}/pipeline_%s.log" % date.today().isoformat()
+    report_path = f"{manifest.WorkDir}/pipeline_report.json" ## latest status of every task of the manifest, used by --resume
+    profile_dir = f"{manifest.WorkDir}/profiles" if args.profile or args.profile_rate else None
+    metrics_dir = f"{manifest.WorkDir}/metrics" if args.metrics and not args.dry_run else None
+    cost_model = CostModel(f"{manifest.WorkDir}/pipeline_costs.json")
+    if profile_dir: os.makedirs(profile_dir, exist_ok = True)
+    if metrics_dir: os.makedirs(metrics_dir, exist_ok = True)
+    pipeline = build_pipeline(
+        manifest, json_info, fit_data,
+        args.max_workers,
+        is_forced = args.force or args.calibrate,
+        worker_memory_limit = int(args.worker_memory_limit * (1 << 30)),
+        memory_budget = int(args.memory_budget * (1 << 30)),
+        queue_dir = args.queue_dir,
+        profile_dir = profile_dir,
+        profile_rate = args.profile_rate,
+        is_timed = args.timing,
+        metrics_dir = metrics_dir,
+        report_path = None if args.dry_run else report_path,
+        log_path = None if args.dry_run else log_path, ## dry run lists the tasks on the terminal
+    )
+    task_names = select_tasks(pipeline, args.only, args.rerun_failed, report_path if args.resume else None)
+
+    if args.dry_run:
+        estimate_run(pipeline, pipeline.plan(task_names), cost_model, args.max_workers)
+        pipeline.close()
+    else:
+        pipeline.VolumeLimits.update(get_volume_limits(parse_volume_options(args.volume_bandwidth), args.task_bandwidth))
+        pipeline.VolumeLimits.update(measure_volume_limits(pipeline, args.measure_volumes, args.task_bandwidth))
+        pipeline.VolumeLimits.update({prefix: int(limit) for prefix, limit in parse_volume_options(args.volume_limit).items()})
+        pipeline.Logger.info(f"Volume limits: {pipeline.VolumeLimits}")
+        try:
+            run_pipeline(pipeline, fit_data, task_names, cost_model)
+        finally:
+            with open(manifest.FitDataPath, 'w') as file_fit_data:
+                json.dump(fit_data, file_fit_data, indent = 4)
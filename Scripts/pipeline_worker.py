@@ -0,0 +1,29 @@
+from argparse import ArgumentParser
+
+import multiprocessing
+
+from Base.WorkQueue import run_worker
+
+def run_workers(queue_path, n_workers, **kwargs):
+    ## Worker processes of one host, every one takes tasks from the queue on its own
+    processes = [multiprocessing.Process(target = run_worker, args = (queue_path,), kwargs = kwargs) for _ in range(n_workers)]
+    for process in processes: process.start()
+    for process in processes: process.join()
+
+
+if __name__ == '__main__':
+    ##Parsing input arguments
+    parser = ArgumentParser(description = "Worker processes of the file-based work queue, started on every host sharing the queue directory")
+    parser.add_argument('--queue-dir', required = True, help = 'Queue directory on a file system shared by the hosts, the same as in pipeline.py')
+    parser.add_argument('--workers', type = int, default = 10, help = 'Number of worker processes on this host')
+    parser.add_argument('--idle-timeout', type = float, default = None, help = 'Seconds without tasks after which a worker exits, by default it runs until killed')
+    parser.add_argument('--heartbeat-interval', type = float, default = 10.)
+    parser.add_argument('--heartbeat-timeout', type = float, default = 60., help = 'Seconds without heartbeats after which tasks of a worker are reclaimed')
+    args = parser.parse_args()
+
+    run_workers(
+        args.queue_dir, args.workers,
+        heartbeat_interval = args.heartbeat_interval,
+        heartbeat_timeout = args.heartbeat_timeout,
+        idle_timeout = args.idle_timeout,
+    )
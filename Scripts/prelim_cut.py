@@ -6,24 +6,61 @@ from argparse import ArgumentParser
 
 import os
 import subprocess
-from concurrent.futures import ProcessPoolExecutor, wait
+import sys
 
-from Analyses.PreliminaryAnalysis import PreliminaryAnalysis
+from Analyses.PreliminaryAnalysis import PreliminaryAnalysis, DEDX_HEADER_PATH
 from Analyses.IntermediateAnalysis import IntermediateAnalysis
+from Analyses.KinfitAnalysis import KinfitAnalysis
+from Base.Pipeline import Task, Pipeline
+from Base.StageCache import BASE_SOURCES
+from Base.Manifest import get_root, get_sample_name, get_point_path
+from Base.Validation import ValidationReport, run_analysis
+from Containers.PreliminaryContainer import SLIM_DROP
+
+## Histograms of IntermediateAnalysis filled by the stage before and after the likelihood cut
+IntermediateHistograms = [
+    'h_KpKmPipPimLklhd', 'h_TotalP_DeltaE', 'h_TotalP_DeltaEKKPiPi', 'h_PiPiPiMissMass2', 'h_KPiPiMissMass2',
+    'h_PiPiPiPiMissMass2', 'h_KKPiPiMissMass2', 'h_KKMissMass', 'h_PiPiMissMass', 'h_finalstate_id',
+]
+
+def get_paths(version, year, energy_point, roots = None):
+    input_dir = get_root(roots, 'multihadron')
+    output_dir = get_root(roots, 'prelim_cut')
+    cut_dir = get_root(roots, 'pershin_cut')
+
+    return {
+        'input': get_point_path(input_dir, 'multihad', version, year, energy_point),
+        'output': get_point_path(output_dir, 'prelim_cut', version, year, energy_point, 'multihad'),
+        'cut': get_point_path(cut_dir, 'cut', version, year, energy_point),
+        'hists': get_point_path(cut_dir, 'hists', version, year, energy_point),
+    }
+
+
+def get_task(version, year, energy_point, roots = None, slim = False, layout = None):
+    paths = get_paths(version, year, energy_point, roots)
+    return Task(
+        f"prelim_cut_{version}_y{year}_e{energy_point}", process_single,
+        args = (version, year, energy_point),
+        kwargs = {'roots': roots, 'slim': slim, 'layout': layout},
+        inputs = [paths['input']],
+        outputs = [paths['output'], paths['cut'], paths['hists']],
+        sources = BASE_SOURCES + [
+            "Scripts.prelim_cut",
+            "Analyses.PreliminaryAnalysis", "Analyses.IntermediateAnalysis",
+            "Containers.CMD3ContainerV9", "Containers.PreliminaryContainer",
+            DEDX_HEADER_PATH,
+        ],
+        plan = {'stage': 'prelim_cut', 'version': version, 'year': year, 'energy-point': energy_point, 'slim': slim, 'layout': layout},
+    )
 
-def process_single(version, year, energy_point):
-    input_dir = "/store11/idpershin/simulation/multihadron"
-    output_dir = "/store11/idpershin/kpkmpippim/prelim_cuts_new"
-    if not os.path.exists(input_dir): raise OSError(f"Input directory does not exist: {input_dir}")
-    if not os.path.exists(output_dir): raise OSError(f"Output directory does not exist: {output_dir}")
-
-    input_path = f"{input_dir}/multihad{year}_tr_ph_fc_e{energy_point}_{version}.root"
-    output_path = f"{output_dir}/multihad_prelim_cut{year}_tr_ph_fc_e{energy_point}_{version}.root"
-    if not os.path.exists(input_path): raise OSError(f"Input path does not exist: {input_path}")
 
+def run_preliminary(input_path, output_path, *, slim = False, layout = None, log_path = None):
     analysis = PreliminaryAnalysis(
         input_path,
         output_path = output_path,
+        log_path = log_path,
+        output_drop = SLIM_DROP if slim else None,
+        output_layout = layout,
     )
     analysis.addCut('nt')
     analysis.addCut('tcharge')
@@ -37,70 +74,83 @@ def process_single(version, year, energy_point):
     analysis.dumpToFile()
     analysis.close()
 
-    input_dir = "/store11/idpershin/kpkmpippim/prelim_cuts_new"
-    output_dir = "/store11/idpershin/kpkmpippim/pershin_cut_wo_TotalP-DeltaE"
-    if not os.path.exists(output_dir): raise OSError(f"Output directory does not exist: {output_dir}")
 
-    input_path = f"{input_dir}/multihad_prelim_cut{year}_tr_ph_fc_e{energy_point}_{version}.root"
-    output_path = f"{output_dir}/cut{year}_tr_ph_fc_e{energy_point}_{version}.root"
-    hists_path = f"{output_dir}/hists{year}_tr_ph_fc_e{energy_point}_{version}.root"
+def make_kinfit_analysis(input_path, *, analysis_path, log_path):
+    ## In-process kinfit of a preliminary tree, as kinfit_analysis with a native engine
+    return KinfitAnalysis(input_path, None, None, analysis_path, log_path)
+
+
+def check_slim(input_path, work_dir):
+    """
+    Writes the preliminary tree of input_path full and slim and runs the later stages on both:
+    IntermediateAnalysis (selection, values and histograms of this stage) and the in-process kinfit
+    Returns {stage name: ValidationReport of the slim output against the full one}
+    """
+    results = {'intermediate': [], 'kinfit': []}
+    for name, slim in (('full', False), ('slim', True)):
+        output_dir = f"{work_dir}/{name}"
+        os.makedirs(output_dir, exist_ok = True)
+        output_path = f"{output_dir}/prelim_cut.root"
+        run_preliminary(input_path, output_path, slim = slim, log_path = f"{output_dir}/PreliminaryAnalysis.log")
+        results['intermediate'].append(run_analysis(IntermediateAnalysis, output_path, {
+            'cuts': ['KpKmPipPimLklhd'],
+            'values': ['KpKmPipPimLklhd', 'TotalP', 'DeltaE', 'DeltaEKKPiPi', 'KKPiPiMissMass2', 'TrackPiLklhds', 'TrackKLklhds'],
+            'histograms': IntermediateHistograms,
+        }, output_dir))
+        results['kinfit'].append(run_analysis(make_kinfit_analysis, output_path, {
+            'values': ['KpKmPipPimKinfitChi2', 'KpKmPipPimKinfitTrackMomenta', 'PipPimPipPimKinfitChi2'],
+        }, output_dir))
+    return {stage_name: ValidationReport(*stage_results) for stage_name, stage_results in results.items()}
+
+
+def process_single(version, year, energy_point, roots = None, slim = False, layout = None):
+    paths = get_paths(version, year, energy_point, roots)
+    for path in paths.values():
+        if not os.path.exists(os.path.dirname(path)): raise OSError(f"Directory does not exist: {os.path.dirname(path)}")
+
+    input_path = paths['input']
+    output_path = paths['output']
+    if not os.path.exists(input_path): raise OSError(f"Input path does not exist: {input_path}")
+
+    run_preliminary(input_path, output_path, slim = slim, layout = layout)
+
+    input_path = paths['output']
+    output_path = paths['cut']
+    hists_path = paths['hists']
     
     analysis = IntermediateAnalysis(
         input_path,
         output_path = output_path,
         analysis_path = hists_path,
+        output_layout = layout,
     )
-    analysis.addHistogram('h_KpKmPipPimLklhd')
-    analysis.addHistogram('h_TotalP_DeltaE')
-    analysis.addHistogram('h_TotalP_DeltaEKKPiPi')
-    analysis.addHistogram('h_PiPiPiMissMass2')
-    analysis.addHistogram('h_KPiPiMissMass2')
-    analysis.addHistogram('h_PiPiPiPiMissMass2')
-    analysis.addHistogram('h_KKPiPiMissMass2')
-    analysis.addHistogram('h_KKMissMass')
-    analysis.addHistogram('h_PiPiMissMass')
-    analysis.addHistogram('h_finalstate_id')
+    for hist_name in IntermediateHistograms: analysis.addHistogram(hist_name)
     analysis.loop()
     
     analysis.addCut('KpKmPipPimLklhd')
-    analysis.addHistogram('h_KpKmPipPimLklhd')
-    analysis.addHistogram('h_TotalP_DeltaE')
-    analysis.addHistogram('h_TotalP_DeltaEKKPiPi')
-    analysis.addHistogram('h_PiPiPiMissMass2')
-    analysis.addHistogram('h_KPiPiMissMass2')
-    analysis.addHistogram('h_PiPiPiPiMissMass2')
-    analysis.addHistogram('h_KKPiPiMissMass2')
-    analysis.addHistogram('h_KKMissMass')
-    analysis.addHistogram('h_PiPiMissMass')
-    analysis.addHistogram('h_finalstate_id')
+    for hist_name in IntermediateHistograms: analysis.addHistogram(hist_name)
     analysis.loop()
     
     analysis.dumpToFile()
     analysis.close()
 
 
-def process_all():
+def process_all(slim = False):
     path_info = "/spoolA/idpershin/analysis/kpkmpippim/data_info_cmd3.json"
     with open(path_info, 'r') as file_info:
         json_info = json.load(file_info)
 
-    with ProcessPoolExecutor(max_workers = 10) as executor:
-        futures = []
-        for version in json_info:
-            for year in json_info[version]["years"]:
-                for elabel in json_info[version]["years"][year]["elabels"]:
-                    elabel_data = json_info[version]["years"][year]["elabels"][elabel]
-                    energy_point = elabel_data["scan-energy-point"]
-
-                    futures.append(
-                        executor.submit(
-                            process_single,
-                            version,
-                            year,
-                            energy_point,
-                        )
-                    )
-        wait(futures)
+    pipeline = Pipeline(max_workers = 10)
+    for version in json_info:
+        for year in json_info[version]["years"]:
+            for elabel in json_info[version]["years"][year]["elabels"]:
+                elabel_data = json_info[version]["years"][year]["elabels"][elabel]
+                energy_point = elabel_data["scan-energy-point"]
+
+                pipeline.addTask(get_task(version, year, energy_point, slim = slim))
+    pipeline.run()
+    pipeline.close()
+    if pipeline.getTasks('failed'): raise RuntimeError(f"Failed tasks: {[task.Name for task in pipeline.getTasks('failed')]}")
     
     
 if __name__ == '__main__':
@@ -112,12 +162,24 @@ if __name__ == '__main__':
     parser_single.add_argument('--version', default = 'v9', choices = ['v9'], help = 'Version of CMD-3 data tree')
     parser_single.add_argument('--year', choices = ['2019', '2020', '2021', '2022', '2023'], required = True)
     parser_single.add_argument('--energy', required = True)
+    parser_single.add_argument('--slim', action = 'store_true', help = 'Drop the branches not read by later stages, see Containers/PreliminaryContainer.py')
 
     parser_all = subparsers.add_parser('all', help = "Process all available energy points")
+    parser_all.add_argument('--slim', action = 'store_true', help = 'Drop the branches not read by later stages, see Containers/PreliminaryContainer.py')
+
+    parser_check = subparsers.add_parser('check-slim', help = "Check that later stages give the same results on slim and full outputs of one input")
+    parser_check.add_argument('--input', required = True, help = 'CMD-3 tree, e.g. made by Scripts/generate_sample.py')
+    parser_check.add_argument('--work-dir', default = '/tmp/kpkmpippim_check_slim', help = 'Directory of the full and slim outputs')
     args = parser.parse_args()
 
     if args.mode == 'single':
-        process_single(args.version, args.year, args.energy)
+        process_single(args.version, args.year, args.energy, slim = args.slim)
 
     if args.mode == 'all':
-        process_all()
+        process_all(slim = args.slim)
+
+    if args.mode == 'check-slim':
+        reports = check_slim(args.input, args.work_dir)
+        for stage_name, report in reports.items():
+            for line in report.formLines(): print(f"{stage_name}: {line}")
+        sys.exit(0 if all(report.isEqual() for report in reports.values()) else 1)
@@ -0,0 +1,58 @@
+from argparse import ArgumentParser
+from importlib import import_module
+
+import sys
+
+from Base.Analysis import Analysis
+from Base.Validation import get_analysis_engine, validate
+
+## Reference analyses of one input tree, run by the per-entry Analysis.loop
+ReferenceAnalyses = {
+    'preliminary': ("Analyses.PreliminaryAnalysis", "PreliminaryAnalysis"),
+    'intermediate': ("Analyses.IntermediateAnalysis", "IntermediateAnalysis"),
+    'dynamics': ("Analyses.DynamicsAnalysis", "DynamicsAnalysis"),
+}
+
+def load_engine(name):
+    ## 'module:name' of an Analysis subclass (e.g. with a vectorized calculateKpKmPipPimLklhd) or of an engine function
+    module_name, object_name = name.split(':')
+    engine = getattr(import_module(module_name), object_name)
+    if isinstance(engine, type) and issubclass(engine, Analysis): return get_analysis_engine(engine)
+    return engine
+
+
+def parse_tolerances(tolerance_options):
+    ## NAME=REL or NAME=REL,ABS -> {name: (rel_tol, abs_tol)}
+    tolerances = {}
+    for option in tolerance_options:
+        name, values = option.split('=')
+        rel_tol, abs_tol = (list(map(float, values.split(','))) + [0.])[:2]
+        tolerances[name] = (rel_tol, abs_tol)
+    return tolerances
+
+
+if __name__ == '__main__':
+    ##Parsing input arguments
+    parser = ArgumentParser(description = "Compare an optimized engine with the per-entry analysis on the same input")
+    parser.add_argument('--analysis', choices = list(ReferenceAnalyses), required = True, help = 'Reference analysis')
+    parser.add_argument('--candidate', required = True, help = 'MODULE:NAME of an Analysis subclass or of an engine function (input_path, spec, work_dir) -> results')
+    parser.add_argument('--input', required = True, help = 'Input tree of the analysis, e.g. made by Scripts/generate_sample.py')
+    parser.add_argument('--cut', action = 'append', default = [], help = 'Cut applied by both engines')
+    parser.add_argument('--value', action = 'append', default = [], help = 'Variable compared on the selected entries, e.g. KpKmPipPimLklhd')
+    parser.add_argument('--histogram', action = 'append', default = [], help = 'Histogram compared bin by bin')
+    parser.add_argument('--tolerance', action = 'append', default = [], help = 'NAME=REL[,ABS]: tolerance of a variable or histogram')
+    parser.add_argument('--default-tolerance', default = '1e-6,1e-9', help = 'REL,ABS: tolerance of the other variables and histograms')
+    parser.add_argument('--work-dir', default = '/tmp/kpkmpippim_validation', help = 'Directory of the outputs of both engines')
+    args = parser.parse_args()
+
+    module_name, class_name = ReferenceAnalyses[args.analysis]
+    reference_engine = get_analysis_engine(getattr(import_module(module_name), class_name))
+    report = validate(
+        reference_engine, load_engine(args.candidate), args.input,
+        {'cuts': args.cut, 'values': args.value, 'histograms': args.histogram},
+        args.work_dir,
+        tolerances = parse_tolerances(args.tolerance),
+        default_tolerance = tuple(map(float, args.default_tolerance.split(','))),
+    )
+    for line in report.formLines(): print(line)
+    sys.exit(0 if report.isEqual() else 1)
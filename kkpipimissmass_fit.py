@@ -3,17 +3,52 @@ from math import sqrt, pi
 import json
 
 from argparse import ArgumentParser
-from concurrent.futures import ProcessPoolExecutor
 
 import ROOT
 from ROOT import TH1F, TF1, TFile, TCanvas
 from ROOT import gROOT
 
-def process_single(version, year, elabel_data):
+from Base.Pipeline import Task, Pipeline
+from Base.Manifest import get_root
+
+## Fields of an energy point filled by the fit, the only ones merged back into the fit data
+FitKeys = ["signal-events-number", "signal-events-number-error", "background-events-number", "background-events-number-error"]
+
+def get_paths(version, year, energy_point, roots = None):
+    input_dir = get_root(roots, 'pershin_cut_2')
+    output_dir = get_root(roots, 'kkpipimissmass_fit', f"{input_dir}/kkpipimissmass_fit")
+    return {
+        'input': f"{input_dir}/hists{year}_tr_ph_fc_e{energy_point}_{version}.root",
+        'output': f"{output_dir}/y{year}_e{energy_point}_{version}.root",
+    }
+
+
+def get_task(version, year, elabel_data, roots = None):
+    paths = get_paths(version, year, elabel_data["scan-energy-point"], roots)
+    return Task(
+        f"kkpipimissmass_fit_{version}_y{year}_e{elabel_data['scan-energy-point']}", fit_single,
+        args = (version, year, elabel_data),
+        kwargs = {'roots': roots},
+        inputs = [paths['input']],
+        outputs = [paths['output']],
+        sources = ["kkpipimissmass_fit"],
+        plan = {'stage': 'kkpipimissmass_fit', 'version': version, 'year': year, 'energy-point': elabel_data["scan-energy-point"]},
+        is_io_bound = False,
+    )
+
+
+def fit_single(version, year, elabel_data, roots = None):
+    ## elabel_data is filled in a worker process, so the fit results are returned to be merged into the fit data
+    process_single(version, year, elabel_data, roots)
+    return {key: elabel_data[key] for key in FitKeys}
+
+
+def process_single(version, year, elabel_data, roots = None):
     energy_point = elabel_data["scan-energy-point"]
 
-    input_path = f"/home/idpershin/analysis/kpkmpippim/pershin_cut_w_TotalP-DeltaE-2/hists{year}_tr_ph_fc_e{energy_point}_{version}.root"
-    output_path = f"/home/idpershin/analysis/kpkmpippim/pershin_cut_w_TotalP-DeltaE-2/kkpipimissmass_fit/y{year}_e{energy_point}_{version}.root"
+    paths = get_paths(version, year, energy_point, roots)
+    input_path = paths['input']
+    output_path = paths['output']
 
     f_missmass = TFile(input_path, "read")
     h_missmass = f_missmass.GetDirectory("2_TotalP-DeltaE-2").Get("h_KKPiPiMissMass2")
@@ -72,21 +107,20 @@ def process_single(version, year, elabel_data):
     
 
 def process_all(version, version_data):
-    with ProcessPoolExecutor(max_workers = 10) as executor:
-        futures = []
-        for year in version_data["years"]:
-            for elabel in version_data["years"][year]["elabels"]:
-                elabel_data = version_data["years"][year]["elabels"][elabel]
-
-                futures.append(
-                    executor.submit(
-                        process_single,
-                        version,
-                        year,
-                        elabel_data,
-                    )
-                )
-        wait(futures) 
+    ## fit results are filled in worker processes and merged back into version_data
+    pipeline = Pipeline(max_workers = 10)
+    for year in version_data["years"]:
+        for elabel in version_data["years"][year]["elabels"]:
+            elabel_data = version_data["years"][year]["elabels"][elabel]
+            pipeline.addTask(get_task(version, year, elabel_data))
+    results = pipeline.run()
+    pipeline.close()
+
+    for year in version_data["years"]:
+        for elabel_data in version_data["years"][year]["elabels"].values():
+            task_name = f"kkpipimissmass_fit_{version}_y{year}_e{elabel_data['scan-energy-point']}"
+            if task_name in results: elabel_data.update(results[task_name])
+    if pipeline.getTasks('failed'): raise RuntimeError(f"Failed tasks: {[task.Name for task in pipeline.getTasks('failed')]}")
     
 if __name__ == '__main__':
     ##Parsing input arguments
@@ -99,14 +99,14 @@ def fill_data_info_sim_cuts(data_info):
     prelim_hists_paths = filter(
         lambda path: path.find('sim') != -1,
         filter(
-            lambda path: path.find('hists') != -1,
+            lambda path: path.find('hists') != -1 and path.endswith('.root'),
             os.listdir(prelim_dir)
         )
     )
     final_hists_paths = filter(
         lambda path: path.find('sim') != -1,
         filter(
-            lambda path: path.find('hists') != -1,
+            lambda path: path.find('hists') != -1 and path.endswith('.root'),
             os.listdir(final_dir)
         )
     )
@@ -190,14 +190,14 @@ def fill_data_info_multihad_cuts(data_info):
     prelim_hists_paths = filter(
         lambda path: path.find('multihad') != -1,
         filter(
-            lambda path: path.find('hists') != -1,
+            lambda path: path.find('hists') != -1 and path.endswith('.root'),
             os.listdir(prelim_dir)
         )
     )
     final_hists_paths = filter(
         lambda path: path.find('multihad') != -1,
         filter(
-            lambda path: path.find('hists') != -1,
+            lambda path: path.find('hists') != -1 and path.endswith('.root'),
             os.listdir(final_dir)
         )
     )
@@ -282,14 +282,14 @@ def fill_data_info_scan_cuts(data_info):
     prelim_hists_paths = filter(
         lambda path: path.find('sim') == -1 and path.find('multihad') == -1,
         filter(
-            lambda path: path.find('hists') != -1,
+            lambda path: path.find('hists') != -1 and path.endswith('.root'),
             os.listdir(prelim_dir)
         )
     )
     final_hists_paths = filter(
         lambda path: path.find('sim') == -1 and path.find('multihad') == -1,
         filter(
-            lambda path: path.find('hists') != -1,
+            lambda path: path.find('hists') != -1 and path.endswith('.root'),
             os.listdir(final_dir)
         )
     )